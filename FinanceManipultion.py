@@ -1,48 +1,613 @@
+import time
+STARTED_AT = time.perf_counter()
+import queue
 import sys
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
+import threading
+from PyQt5.QtWidgets import (QAbstractItemView, QApplication, QCheckBox, QComboBox, QDialog, QDoubleSpinBox,
+                             QFileDialog, QGridLayout, QHBoxLayout, QHeaderView, QInputDialog, QLabel, QLineEdit,
+                             QListWidget, QListWidgetItem, QMainWindow, QMessageBox, QProgressBar, QPushButton,
+                             QStyle, QStyleOptionButton, QStyledItemDelegate, QTabWidget, QTableView, QTableWidget,
+                             QTableWidgetItem, QTextEdit, QVBoxLayout, QWidget)
+from PyQt5.QtCore import (QAbstractTableModel, QCoreApplication, QEvent, QModelIndex, QObject, QPointF, QRectF, QSize,
+                          QTimer, Qt, pyqtSignal, pyqtSlot)
+from PyQt5.QtGui import QColor, QKeySequence, QPainter, QPalette, QPen, QPolygonF
 from datetime import datetime
-import json
-import os
-def to_normal_readly_type(number):
-    integer_part = int(abs(number))
-    decimal_part = abs(number) - integer_part
+from finance_core import BackgroundFlusher, BudgetTracker, Ledger, parse_amount, to_normal_readly_type
+# Сам по себе легкий: cProfile и tracemalloc он импортирует, только когда замеры включают
+from finance_profile import Profiler
+# Выгрузка, импорт, прогноз и список учетов импортируются там, где нужны:
+# окну с итогами из кэша они не нужны, и первая отрисовка их не ждет
+
+RECURRENCE_TITLES = {'day': 'Каждый день', 'week': 'Каждую неделю', 'month': 'Каждый месяц', 'year': 'Каждый год'}
+# Замеры обработчиков окна (панель «Диагностика» в настройках)
+PROFILER = Profiler()
+
+class OperationsTableModel(QAbstractTableModel):
+    """Модель таблицы операций: строки запрашиваются у хранилища страницами,
+    и только те, что видны на экране"""
+    
+    ACTUAL_HEADERS = ['Тип', 'Название', 'Сумма', 'Валюта', 'Дата и время', 'Комментарий']
+    PENDING_HEADERS = ['Статус', 'Название', 'Сумма', 'Валюта', 'Дата и время', 'Комментарий', 'Действия']
+    PAGE_SIZE = 256
+    MAX_PAGES = 16
+    
+    def __init__(self, store, pending=False, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.pending = pending
+        self.headers = self.PENDING_HEADERS if pending else self.ACTUAL_HEADERS
+        self.filters = {}
+        self.count = 0
+        self.pages = {}
+        
+    def set_store(self, store):
+        self.beginResetModel()
+        self.store = store
+        self.count = store.count(self.pending, **self.filters)
+        self.pages = {}
+        self.endResetModel()
+        
+    def set_filters(self, **filters):
+        """Фильтры хранилища (op_type, currency, start, end, min_amount, max_amount, text);
+        None — без фильтра"""
+        self.filters = {key: value for key, value in filters.items() if value is not None}
+        self.set_store(self.store)
+        
+    def insert_operation(self, position, op_id):
+        # Под фильтром позиция среди всех операций не совпадает со строкой таблицы
+        if self.filters:
+            self.set_store(self.store)
+            return
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.count += 1
+        self.pages = {}
+        self.endInsertRows()
+        
+    def append_operation(self, op_id):
+        self.insert_operation(self.count, op_id)
+        
+    def remove_row(self, row):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.count -= 1
+        self.pages = {}
+        self.endRemoveRows()
+        
+    def operation_id(self, row):
+        """id операции в строке или None, если ее уже нет (см. operation)"""
+        op = self.operation(row)
+        return None if op is None else op['id']
+    
+    def operation(self, row):
+        number, offset = divmod(row, self.PAGE_SIZE)
+        page = self.pages.get(number)
+        if page is None:
+            if len(self.pages) >= self.MAX_PAGES:
+                self.pages = {}
+            page = self.pages[number] = self.store.page(self.pending, number * self.PAGE_SIZE,
+                                                        self.PAGE_SIZE, **self.filters)
+        # Операции могли измениться в другом окне раньше, чем обновилась таблица
+        return page[offset] if offset < len(page) else None
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count
+    
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+    
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return super().headerData(section, orientation, role)
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        op = self.operation(index.row())
+        if op is None:
+            return None
+        column = index.column()
+        
+        if role == Qt.DisplayRole:
+            if column == 0:
+                if self.pending:
+                    return 'Ожидает'
+                return 'Доход' if op['type'] == 'income' else 'Расход'
+            if column == 1:
+                return op['name']
+            if column == 2:
+                # Столько знаков, сколько их у валюты (у некоторых три или больше)
+                return f"{op['amount']:.{self.store.digits(op['currency'])}f}"
+            if column == 3:
+                return op['currency']
+            if column == 4:
+                return op['datetime']
+            if column == 5:
+                return op['comment']
+            if column == 6:
+                return 'Подтвердить'
+        elif role == Qt.ForegroundRole and column == 0:
+            if self.pending:
+                return QColor('#FF9800')
+            return QColor('#4CAF50') if op['type'] == 'income' else QColor('#f44336')
+        return None
+
+
+class ConfirmButtonDelegate(QStyledItemDelegate):
+    """Рисует кнопку "Подтвердить" в ячейке вместо отдельного виджета на каждую строку"""
+    
+    clicked = pyqtSignal(int)
+    
+    def paint(self, painter, option, index):
+        button = QStyleOptionButton()
+        button.rect = option.rect.adjusted(2, 2, -2, -2)
+        button.text = index.data()
+        button.state = QStyle.State_Enabled
+        button.palette = QPalette(option.palette)
+        button.palette.setColor(QPalette.Button, QColor('#4CAF50'))
+        button.palette.setColor(QPalette.ButtonText, Qt.white)
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawControl(QStyle.CE_PushButton, button, painter, option.widget)
+        
+    def sizeHint(self, option, index):
+        return QSize(option.fontMetrics.horizontalAdvance(index.data() or '') + 20, 28)
+        
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and option.rect.contains(event.pos()):
+            self.clicked.emit(index.row())
+            return True
+        return super().editorEvent(event, model, option, index)
+
+
+class FilterBar(QWidget):
+    """Строка поиска и фильтры над таблицей операций.
+    
+    Ищет и фильтрует само хранилище через model.set_filters при каждом
+    изменении поля; нераспознанные сумма или дата просто не учитываются.
+    """
+    
+    def __init__(self, model, currencies, with_type=True, parent=None):
+        super().__init__(parent)
+        self.model = model
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        
+        top = QHBoxLayout()
+        self.search = QLineEdit()
+        self.search.setPlaceholderText('Поиск по названию и комментарию')
+        self.search.setClearButtonEnabled(True)
+        self.search.textChanged.connect(self.apply)
+        top.addWidget(self.search)
+        self.found_label = QLabel()
+        top.addWidget(self.found_label)
+        layout.addLayout(top)
+        
+        bottom = QHBoxLayout()
+        self.type_combo = None
+        if with_type:
+            self.type_combo = QComboBox()
+            self.type_combo.addItem('Все операции', None)
+            self.type_combo.addItem('Доходы', 'income')
+            self.type_combo.addItem('Расходы', 'expense')
+            self.type_combo.currentIndexChanged.connect(self.apply)
+            bottom.addWidget(self.type_combo)
+        
+        self.currency_combo = QComboBox()
+        self.currency_combo.addItem('Все валюты', None)
+        for currency in sorted(currencies):
+            self.currency_combo.addItem(currency, currency)
+        self.currency_combo.currentIndexChanged.connect(self.apply)
+        bottom.addWidget(self.currency_combo)
+        
+        self.min_amount = self.add_edit(bottom, 'Сумма от')
+        self.max_amount = self.add_edit(bottom, 'до')
+        self.start_date = self.add_edit(bottom, 'Дата с')
+        self.end_date = self.add_edit(bottom, 'по')
+        for edit in (self.start_date, self.end_date):
+            edit.setToolTip('Дата в формате ГГГГ-ММ-ДД')
+        layout.addLayout(bottom)
+        
+        for signal in (model.modelReset, model.rowsInserted, model.rowsRemoved):
+            signal.connect(self.update_found)
+        self.update_found()
+        
+    def add_edit(self, layout, placeholder):
+        edit = QLineEdit()
+        edit.setPlaceholderText(placeholder)
+        edit.textChanged.connect(self.apply)
+        layout.addWidget(edit)
+        return edit
+    
+    @staticmethod
+    def amount(edit):
+        try:
+            return parse_amount(edit.text()) if edit.text().strip() else None
+        except ValueError:
+            return None
+        
+    @staticmethod
+    def date(edit, time_of_day):
+        try:
+            day = datetime.strptime(edit.text().strip(), '%Y-%m-%d')
+        except ValueError:
+            return None
+        return f'{day:%Y-%m-%d} {time_of_day}'
+    
+    def filters(self):
+        return {
+            'op_type': self.type_combo.currentData() if self.type_combo else None,
+            'currency': self.currency_combo.currentData(),
+            'min_amount': self.amount(self.min_amount),
+            'max_amount': self.amount(self.max_amount),
+            'start': self.date(self.start_date, '00:00:00'),
+            'end': self.date(self.end_date, '23:59:59'),
+            'text': self.search.text().strip() or None
+        }
+    
+    def apply(self):
+        # Недописанная сумма или дата не меняет фильтр — таблицу не перечитываем
+        filters = {key: value for key, value in self.filters().items() if value is not None}
+        if filters != self.model.filters:
+            self.model.set_filters(**filters)
+            
+    def update_found(self):
+        self.found_label.setText(f'Найдено: {self.model.rowCount()}')
+
+
+class BarChart(QWidget):
+    """Простая столбчатая диаграмма: несколько рядов значений по общим подписям.
+    
+    Рисует только то, что ей передали, поэтому время отрисовки не зависит
+    от длины истории. horizontal=True — полосы слева направо (для категорий).
+    """
+    
+    def __init__(self, horizontal=False, parent=None):
+        super().__init__(parent)
+        self.horizontal = horizontal
+        self.labels = []
+        self.series = []
+        self.setMinimumHeight(180)
+        
+    def set_data(self, labels, series):
+        """series — список (название, цвет, значения)"""
+        self.labels = labels
+        self.series = series
+        self.update()
+        
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        metrics = painter.fontMetrics()
+        values = [abs(value) for _, _, series_values in self.series for value in series_values]
+        peak = max(values, default=0)
+        if not self.labels or peak == 0:
+            painter.drawText(self.rect(), Qt.AlignCenter, 'Нет данных за этот период')
+            return
+        
+        legend_height = metrics.height() + 6
+        x = 0
+        for title, color, _ in self.series:
+            painter.fillRect(x, 4, 12, 12, QColor(color))
+            painter.drawText(x + 16, 4 + metrics.ascent(), title)
+            x += metrics.horizontalAdvance(title) + 32
+        area = self.rect().adjusted(0, legend_height, 0, 0)
+        
+        if self.horizontal:
+            label_width = max(metrics.horizontalAdvance(label) for label in self.labels) + 8
+            row_height = area.height() / len(self.labels)
+            bar_height = max(row_height / len(self.series) - 2, 1)
+            texts = [[to_normal_readly_type(round(value)) for value in series_values]
+                     for _, _, series_values in self.series]
+            value_width = max(metrics.horizontalAdvance(text) for row in texts for text in row) + 8
+            width = area.width() - label_width - value_width
+            for i, label in enumerate(self.labels):
+                top = area.top() + i * row_height
+                painter.drawText(QRectF(0, top, label_width - 4, row_height), Qt.AlignRight | Qt.AlignVCenter, label)
+                for j, (_, color, series_values) in enumerate(self.series):
+                    value = series_values[i]
+                    length = width * abs(value) / peak
+                    bar = QRectF(label_width, top + j * (bar_height + 2), length, bar_height)
+                    painter.fillRect(bar, QColor(color))
+                    painter.drawText(QRectF(label_width + length + 4, bar.top(), value_width, bar_height),
+                                     Qt.AlignLeft | Qt.AlignVCenter, texts[j][i])
+            return
+        
+        label_height = metrics.height() + 4
+        height = area.height() - label_height
+        column_width = area.width() / len(self.labels)
+        bar_width = max((column_width - 4) / len(self.series), 1)
+        # Подписи прореживаются, чтобы не налезали друг на друга
+        step = max(1, int((max(metrics.horizontalAdvance(label) for label in self.labels) + 8) // column_width) + 1)
+        for i, label in enumerate(self.labels):
+            left = area.left() + i * column_width
+            for j, (_, color, series_values) in enumerate(self.series):
+                length = height * abs(series_values[i]) / peak
+                painter.fillRect(QRectF(left + 2 + j * bar_width, area.top() + height - length, bar_width, length),
+                                 QColor(color))
+            if i % step == 0:
+                text_width = metrics.horizontalAdvance(label)
+                text_left = min(max(left + (column_width - text_width) / 2, 0), area.right() - text_width)
+                painter.drawText(QRectF(text_left, area.bottom() - label_height + 4, text_width + 1, label_height),
+                                 Qt.AlignLeft, label)
+
+
+class BandChart(QWidget):
+    """График прогноза: полосы между процентилями и линия медианы по месяцам"""
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.labels = []
+        self.bands = []
+        self.line = []
+        self.setMinimumHeight(180)
+    
+    def set_data(self, labels, bands, line):
+        """bands — список (нижние значения, верхние значения, цвет) от широкой полосы к узкой"""
+        self.labels = labels
+        self.bands = bands
+        self.line = line
+        self.update()
+    
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        metrics = painter.fontMetrics()
+        if not self.labels:
+            painter.drawText(self.rect(), Qt.AlignCenter, 'Недостаточно истории для прогноза')
+            return
+        
+        values = [value for low, high, _ in self.bands for value in low + high] + self.line + [0]
+        bottom, top = min(values), max(values)
+        if top == bottom:
+            top = bottom + 1
+        texts = [to_normal_readly_type(round(top)), to_normal_readly_type(round(bottom))]
+        value_width = max(metrics.horizontalAdvance(text) for text in texts) + 8
+        label_height = metrics.height() + 4
+        area = QRectF(value_width, 4, self.width() - value_width - 8, self.height() - label_height - 8)
+        column_width = area.width() / max(len(self.labels) - 1, 1)
+        
+        def point(i, value):
+            return QPointF(area.left() + i * column_width,
+                           area.top() + area.height() * (top - value) / (top - bottom))
+        
+        painter.drawText(QRectF(0, area.top() - 2, value_width - 4, label_height), Qt.AlignRight, texts[0])
+        painter.drawText(QRectF(0, area.bottom() - label_height + 2, value_width - 4, label_height),
+                         Qt.AlignRight, texts[1])
+        painter.setPen(QPen(QColor('#999'), 1, Qt.DashLine))
+        painter.drawLine(point(0, 0), point(len(self.labels) - 1, 0))
+        
+        painter.setPen(Qt.NoPen)
+        for low, high, color in self.bands:
+            polygon = [point(i, value) for i, value in enumerate(high)]
+            polygon += [point(i, value) for i, value in reversed(list(enumerate(low)))]
+            painter.setBrush(QColor(color))
+            painter.drawPolygon(QPolygonF(polygon))
+        painter.setPen(QPen(QColor('#1565C0'), 2))
+        painter.drawPolyline(QPolygonF([point(i, value) for i, value in enumerate(self.line)]))
+        
+        painter.setPen(QPen(self.palette().text().color()))
+        step = max(1, int((max(metrics.horizontalAdvance(label) for label in self.labels) + 8) // column_width) + 1)
+        for i, label in enumerate(self.labels):
+            if i % step == 0:
+                text_width = metrics.horizontalAdvance(label)
+                text_left = min(max(point(i, 0).x() - text_width / 2, 0), self.width() - text_width)
+                painter.drawText(QRectF(text_left, area.bottom() + 4, text_width + 1, label_height),
+                                 Qt.AlignLeft, label)
+
+
+class RefreshScheduler(QObject):
+    """Отложенные обновления окна: обработчики только помечают «грязные» области,
+    а каждая область обновляется один раз за проход цикла событий.
     
-    formatted_integer = f"{integer_part:,}".replace(",", " ")
+    Области с задержкой (запись на диск) копятся дольше, но не больше delay мс.
+    requested и performed считают пометки и реальные обновления — их разница
+    показывает, сколько лишних обновлений удалось не делать.
+    """
     
-    sign = "-" if number < 0 else ""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.regions = {}
+        self.dirty = set()
+        self.requested = {}
+        self.performed = {}
+        self.timers = {}
+        
+    def add_region(self, name, refresh, delay=0):
+        """Области обновляются в порядке добавления"""
+        self.regions[name] = (refresh, delay)
+        self.requested[name] = 0
+        self.performed[name] = 0
+        if delay not in self.timers:
+            timer = QTimer(self)
+            timer.setSingleShot(True)
+            timer.setInterval(delay)
+            timer.timeout.connect(lambda delay=delay: self.flush(delay))
+            self.timers[delay] = timer
+            
+    def mark(self, *names):
+        for name in names:
+            self.requested[name] += 1
+            self.dirty.add(name)
+            timer = self.timers[self.regions[name][1]]
+            if not timer.isActive():
+                timer.start()
+                
+    def flush(self, delay=None):
+        """Выполняет накопленные обновления; delay=None — все сразу (например, при выходе)"""
+        for name, (refresh, region_delay) in self.regions.items():
+            if name in self.dirty and (delay is None or region_delay == delay):
+                self.dirty.discard(name)
+                self.performed[name] += 1
+                refresh()
+                
+    def avoided(self):
+        return sum(self.requested[name] - self.performed[name] for name in self.regions)
+    
+    def report(self):
+        lines = [f'Обновления окна (пропущено лишних: {self.avoided()}):']
+        for name in self.regions:
+            lines.append(f'  {name:<12} запрошено {self.requested[name]:6}  выполнено {self.performed[name]:6}')
+        return '\n'.join(lines)
+
+
+class StartupTimings:
+    """Отметки времени запуска: импорт, загрузка, первая отрисовка и т.д."""
     
-    if decimal_part > 0:
-        decimal_str = f"{decimal_part:.2f}".lstrip("0")
-        return f"{sign}{formatted_integer}{decimal_str}"
-    else:
-        return f"{sign}{formatted_integer}"
+    def __init__(self, started_at=STARTED_AT):
+        self.started_at = started_at
+        self.marks = []
+        self.enabled = False
+        
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+        
+    def report(self):
+        lines = ['Время запуска:']
+        previous = self.started_at
+        for name, moment in self.marks:
+            lines.append(f'  {name:<28} {(moment - previous) * 1000:8.1f} мс  '
+                         f'(с начала {(moment - self.started_at) * 1000:8.1f} мс)')
+            previous = moment
+        return '\n'.join(lines)
+
+
+class BackgroundTasks(QObject):
+    """Рабочий поток окна: загрузка учета и запись снапшотов идут в нем, чтобы
+    окно не замирало на большом учете.
+    
+    Задачи выполняются по одной в порядке submit, поэтому записи на диск не
+    обгоняют друг друга. Результат передается done уже в потоке окна, ошибка —
+    сигналом failed. wait() дожидается всего поставленного, например перед
+    закрытием учета, чтобы начатая запись не оборвалась. Задача сообщает о
+    своем ходе, испуская progress прямо из рабочего потока.
+    """
+    
+    started = pyqtSignal(str)
+    failed = pyqtSignal(str, str)
+    idle = pyqtSignal()
+    # (текст, сделано, всего; всего 0 — без процентов)
+    progress = pyqtSignal(str, int, int)
+    # Из рабочего потока в поток окна: (заголовок) и (заголовок, done, результат, ошибка)
+    task_started = pyqtSignal(str)
+    task_done = pyqtSignal(str, object, object, object)
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.queue = queue.Queue()
+        self.pending = 0
+        self.task_started.connect(self.started)
+        self.task_done.connect(self.deliver)
+        self.thread = threading.Thread(target=self.run, name='finance-tasks', daemon=True)
+        self.thread.start()
+        
+    def submit(self, title, function, *args, done=None):
+        self.pending += 1
+        self.queue.put((title, function, args, done))
+        
+    def run(self):
+        while True:
+            title, function, args, done = self.queue.get()
+            self.task_started.emit(title)
+            try:
+                result, error = function(*args), None
+            except Exception as exception:
+                result, error = None, exception
+            self.task_done.emit(title, done, result, error)
+            self.queue.task_done()
+            
+    # Слот объявлен явно: тогда результат адресован самому объекту и wait()
+    # доставляет его через sendPostedEvents(self)
+    @pyqtSlot(str, object, object, object)
+    def deliver(self, title, done, result, error):
+        self.pending -= 1
+        if error is not None:
+            self.failed.emit(title, str(error))
+        elif done is not None:
+            done(result)
+        if not self.pending:
+            self.idle.emit()
+            
+    def wait(self):
+        """Выполняет все поставленные задачи (и те, что поставят их done) до конца"""
+        while self.pending:
+            self.queue.join()
+            QCoreApplication.sendPostedEvents(self)
+
 
 class FinanceApp(QMainWindow):
-    def __init__(self):
+    # Что устаревает после изменения операций
+    BALANCE_REGIONS = ('totals', 'currencies', 'budgets', 'analytics', 'forecast', 'history', 'ledgers', 'disk')
+    # Изменения и обновления окна, которые видны в диагностике
+    PROFILED = (
+        'add_operation', 'confirm_pending_income', 'confirm_selected_pending', 'delete_selected_pending',
+        'delete_selected_operation', 'clear_all_operations', 'import_statement', 'export_operations',
+        'import_rates_file', 'run_recurring', 'delete_selected_recurring', 'change_base_currency',
+        'update_budget', 'update_exchange_rate', 'undo_change', 'redo_change', 'switch_ledger', 'add_ledger',
+        'toggle_amount_visibility', 'ledger_loaded', 'operations_replaced', 'ensure_tab_built',
+        'update_operations_table', 'update_pending_table', 'update_amounts_display',
+        'calculate_total_in_base_currency', 'update_currency_lists', 'update_budgets', 'update_analytics',
+        'update_forecast', 'update_recurring_list', 'update_history_buttons', 'update_consolidated',
+        'check_outside_changes', 'flush_to_disk', 'save_data', 'close_ledger',
+    )
+    
+    def __init__(self, timings=None, ledger_name=None):
+        from finance_ledgers import DEFAULT_LEDGER, ledger_path
         super().__init__()
-        self.operations = []
-        self.currencies = {}  
-        self.pending_currencies = {} 
+        self.timings = timings or StartupTimings()
+        self.data_loaded = False
+        self.loading = False
+        self.ledger_name = ledger_name or DEFAULT_LEDGER
+        self.ledger = Ledger(ledger_path(self.ledger_name))
         self.is_amount_hidden = False
-        self.base_currency = 'RUB'  
-        self.exchange_rates = { 
-            'USD': 90.0,
-            'EUR': 100.0,
-            'RUB': 1.0,
-            'KZT': 0.2,
-            'UAH': 2.3,
-            'BYN': 28.0
-        }
-        self.predefined_expense_names = ['Ашан', 'Аптека', 'Вайлдберриз', 'Магнит', 'Пятерочка', 'Такси', 'Кафе', 'Другое']
-        self.predefined_income_names = ['Зарплата', 'Фриланс', 'Инвестиции', 'Подарок', 'Возврат долга', 'Другое']
-        
-        self.load_data()
+        self.operations_model = None
+        self.pending_model = None
+        self.flow_chart = None
+        self.forecast_chart = None
+        self.flusher = None
+        
+        # Обработчики помечают, что устарело, а обновление делается одно на проход цикла событий
+        self.scheduler = RefreshScheduler(self)
+        self.scheduler.add_region('operations', self.update_operations_table)
+        self.scheduler.add_region('pending', self.update_pending_table)
+        self.scheduler.add_region('totals', self.update_amounts_display)
+        self.scheduler.add_region('currencies', self.update_currency_lists)
+        self.scheduler.add_region('budgets', self.update_budgets)
+        self.scheduler.add_region('analytics', self.update_analytics)
+        # Прогноз считается дольше остальной аналитики, поэтому копит изменения
+        self.scheduler.add_region('forecast', self.update_forecast, delay=300)
+        self.scheduler.add_region('recurring', self.update_recurring_list)
+        self.scheduler.add_region('history', self.update_history_buttons)
+        self.scheduler.add_region('disk', self.flush_to_disk, delay=500)
+        # Сводка читает кэши итогов других учетов с диска — после записи своего
+        self.scheduler.add_region('ledgers', self.update_consolidated, delay=500)
+        
+        # Наступившие повторения проверяются раз в минуту (и сразу после загрузки)
+        self.recurring_timer = QTimer(self)
+        self.recurring_timer.setInterval(60 * 1000)
+        self.recurring_timer.timeout.connect(self.run_recurring)
+        # Тот же таймер замечает смену месяца: счетчики бюджетов сдвигаются при обновлении
+        self.recurring_timer.timeout.connect(lambda: self.scheduler.mark('budgets'))
+        self.recurring_list = None
+        
+        # Изменения того же учета из другого окна или командной строки
+        self.outside_timer = QTimer(self)
+        self.outside_timer.setInterval(2000)
+        self.outside_timer.timeout.connect(self.check_outside_changes)
+        
+        # Загрузка и снапшоты — в рабочем потоке, их ход — в строке состояния
+        self.tasks = BackgroundTasks(self)
+        self.tasks.started.connect(self.show_task)
+        self.tasks.idle.connect(self.hide_task)
+        self.tasks.failed.connect(self.task_failed)
+        self.tasks.progress.connect(self.show_progress)
+        
+        # Сначала показываем итоги из маленького кэша, полные данные грузим после первой отрисовки
+        self.ledger.load_summary()
+        self.timings.mark('кэш итогов')
         self.initUI()
+        self.timings.mark('главная вкладка')
         
     def initUI(self):
-        self.setWindowTitle('Finance Manager')
+        self.update_window_title()
         self.setGeometry(100, 100, 900, 700)
         
         main_widget = QWidget()
@@ -52,6 +617,24 @@ class FinanceApp(QMainWindow):
         top_panel = QWidget()
         top_layout = QVBoxLayout(top_panel)
         
+        from finance_ledgers import ledger_names
+        ledger_layout = QHBoxLayout()
+        ledger_layout.addWidget(QLabel('Учет:'))
+        self.ledger_combo = QComboBox()
+        self.ledger_combo.addItems(ledger_names())
+        self.ledger_combo.setCurrentText(self.ledger_name)
+        self.ledger_combo.currentTextChanged.connect(self.switch_ledger)
+        ledger_layout.addWidget(self.ledger_combo)
+        new_ledger_btn = QPushButton('Новый учет...')
+        new_ledger_btn.clicked.connect(self.add_ledger)
+        ledger_layout.addWidget(new_ledger_btn)
+        ledger_layout.addStretch()
+        # Сводка появляется после загрузки, если учетов больше одного
+        self.consolidated_label = QLabel()
+        self.consolidated_label.setVisible(False)
+        ledger_layout.addWidget(self.consolidated_label)
+        top_layout.addLayout(ledger_layout)
+        
         self.total_label = QLabel('Общая сумма (с ожидаемыми): 0.00 RUB')
         self.total_label.setStyleSheet('font-size: 16px; font-weight: bold; color: #FF9800;')
         self.total_label.setAlignment(Qt.AlignCenter)
@@ -63,11 +646,29 @@ class FinanceApp(QMainWindow):
         top_layout.addWidget(self.total_label)
         top_layout.addWidget(self.actual_label)
         
+        self.missing_rates_label = QLabel()
+        self.missing_rates_label.setStyleSheet('color: #f44336;')
+        self.missing_rates_label.setAlignment(Qt.AlignCenter)
+        self.missing_rates_label.setVisible(False)
+        top_layout.addWidget(self.missing_rates_label)
+        
         hide_layout = QHBoxLayout()
         self.hide_button = QPushButton('Скрыть суммы')
         self.hide_button.clicked.connect(self.toggle_amount_visibility)
+        
+        # Отмена и повтор изменений операций (Ctrl+Z / Ctrl+Shift+Z)
+        self.undo_button = QPushButton('Отменить')
+        self.undo_button.setShortcut(QKeySequence.Undo)
+        self.undo_button.clicked.connect(self.undo_change)
+        self.redo_button = QPushButton('Повторить')
+        self.redo_button.setShortcut(QKeySequence.Redo)
+        self.redo_button.clicked.connect(self.redo_change)
+        self.update_history_buttons()
+        
         hide_layout.addStretch()
+        hide_layout.addWidget(self.undo_button)
         hide_layout.addWidget(self.hide_button)
+        hide_layout.addWidget(self.redo_button)
         hide_layout.addStretch()
         top_layout.addLayout(hide_layout)
         
@@ -79,26 +680,147 @@ class FinanceApp(QMainWindow):
         self.setup_main_tab()
         self.tab_widget.addTab(self.main_tab, "Главная")
         
+        # Остальные вкладки строятся при первом открытии
         self.operations_tab = QWidget()
-        self.setup_operations_tab()
         self.tab_widget.addTab(self.operations_tab, "Операции")
         
         self.pending_tab = QWidget()
-        self.setup_pending_tab()
         self.tab_widget.addTab(self.pending_tab, "Ожидаемые доходы")
         
         self.analytics_tab = QWidget()
-        self.setup_analytics_tab()
         self.tab_widget.addTab(self.analytics_tab, "Аналитика")
         
         self.settings_tab = QWidget()
-        self.setup_settings_tab()
         self.tab_widget.addTab(self.settings_tab, "Настройки")
         
+        self.tab_builders = {
+            self.operations_tab: self.setup_operations_tab,
+            self.pending_tab: self.setup_pending_tab,
+            self.analytics_tab: self.setup_analytics_tab,
+            self.settings_tab: self.setup_settings_tab,
+        }
+        self.tab_widget.currentChanged.connect(self.ensure_tab_built)
+        
         layout.addWidget(self.tab_widget)
         
+        self.task_label = QLabel()
+        self.task_progress = QProgressBar()
+        # Без процентов: просто видно, что работа идет
+        self.task_progress.setRange(0, 0)
+        self.task_progress.setMaximumWidth(120)
+        self.statusBar().addPermanentWidget(self.task_label)
+        self.statusBar().addPermanentWidget(self.task_progress)
+        self.hide_task()
+        
         self.update_amounts_display()
-        self.update_operations_table()
+        self.update_currency_lists()
+        self.total_label.installEventFilter(self)
+        
+    def eventFilter(self, obj, event):
+        if obj is self.total_label and event.type() == QEvent.Paint:
+            # Итоги на экране — теперь можно загружать полные данные
+            self.total_label.removeEventFilter(self)
+            self.timings.mark('первая отрисовка')
+            QTimer.singleShot(0, self.start_loading)
+        return super().eventFilter(obj, event)
+    
+    def start_loading(self):
+        """Полные данные грузятся в рабочем потоке; пока — итоги из кэша"""
+        from finance_ledgers import ledger_path
+        if self.data_loaded or self.loading:
+            return
+        self.loading = True
+        self.tasks.submit('Загрузка учета', self.load_data, ledger_path(self.ledger_name), done=self.ledger_loaded)
+        
+    def finish_startup(self):
+        """Загрузка без возврата в цикл событий: учет готов, когда метод вернулся"""
+        self.start_loading()
+        self.tasks.wait()
+        
+    def ledger_loaded(self, ledger):
+        self.loading = False
+        self.ledger = ledger
+        self.ledger.background = self.write_in_background
+        self.data_loaded = True
+        self.timings.mark('загрузка данных')
+        
+        for button in self.data_buttons:
+            button.setEnabled(True)
+        self.ensure_tab_built(self.tab_widget.currentIndex())
+        
+        # fsync журнала — в фоновом потоке, не позже чем через секунду после изменения
+        self.flusher = BackgroundFlusher(self.ledger.storage)
+        self.flusher.start()
+        
+        self.run_recurring()
+        self.recurring_timer.start()
+        self.outside_timer.start()
+        self.scheduler.mark('recurring')
+        self.operations_replaced()
+        
+        if self.timings.enabled:
+            print(self.timings.report())
+            
+    def write_in_background(self, function, *args, done=None):
+        """Запись снапшота учета — в рабочем потоке (см. Ledger.background)"""
+        self.tasks.submit('Запись на диск', function, *args, done=done)
+        
+    def show_task(self, title):
+        self.task_label.setText(title + '...')
+        self.task_label.setVisible(True)
+        self.task_progress.setVisible(True)
+        
+    def show_progress(self, text, done, total):
+        self.task_label.setText(text)
+        self.task_progress.setRange(0, total)
+        self.task_progress.setValue(done)
+        
+    def hide_task(self):
+        self.task_label.setVisible(False)
+        self.task_progress.setVisible(False)
+        self.task_progress.setRange(0, 0)
+        
+    def run_locked(self, title, function, *args, done):
+        """Импорт и выгрузка — в рабочем потоке. Пока они идут, окно учет не трогает:
+        вкладки, таймеры и отложенные обновления стоят, а снапшот (если импорт
+        его потребует) пишется прямо там же. done(результат, ошибка) — в потоке окна."""
+        self.scheduler.flush()
+        self.centralWidget().setEnabled(False)
+        self.recurring_timer.stop()
+        self.outside_timer.stop()
+        background, self.ledger.background = self.ledger.background, None
+        
+        def run():
+            try:
+                return function(*args), None
+            except Exception as error:
+                return None, error
+            
+        def finished(result):
+            self.ledger.background = background
+            self.centralWidget().setEnabled(True)
+            self.recurring_timer.start()
+            self.outside_timer.start()
+            done(*result)
+            
+        self.tasks.submit(title, run, done=finished)
+        
+    def task_failed(self, title, message):
+        self.loading = False
+        QMessageBox.warning(self, title, f'Не удалось: {message}')
+        
+    def ensure_tab_built(self, index):
+        """Строит вкладку при первом открытии (таблицы — только после загрузки данных)"""
+        tab = self.tab_widget.widget(index)
+        builder = self.tab_builders.get(tab)
+        if builder is None or not self.data_loaded:
+            return
+        del self.tab_builders[tab]
+        builder()
+        self.timings.mark(f'вкладка «{self.tab_widget.tabText(index)}»')
+        if self.timings.enabled and self.timings.marks:
+            name, moment = self.timings.marks[-1]
+            print(f'{name}: построена за {(moment - self.timings.marks[-2][1]) * 1000:.1f} мс')
         
     def setup_main_tab(self):
         layout = QVBoxLayout(self.main_tab)
@@ -118,6 +840,11 @@ class FinanceApp(QMainWindow):
         expense_btn.clicked.connect(lambda: self.add_operation('expense'))
         layout.addWidget(expense_btn)
         
+        # До загрузки полных данных добавлять операции и переключать учет нельзя
+        self.data_buttons = [income_btn, pending_income_btn, expense_btn, self.ledger_combo]
+        for button in self.data_buttons:
+            button.setEnabled(self.data_loaded)
+        
         show_ops_btn = QPushButton('Показать таблицу операций')
         show_ops_btn.clicked.connect(lambda: self.tab_widget.setCurrentIndex(1))
         layout.addWidget(show_ops_btn)
@@ -140,18 +867,26 @@ class FinanceApp(QMainWindow):
         self.pending_list = QListWidget()
         layout.addWidget(self.pending_list)
         
+        budgets_label = QLabel('Бюджеты на месяц:')
+        budgets_label.setStyleSheet('font-weight: bold; margin-top: 20px;')
+        layout.addWidget(budgets_label)
+        
+        self.budgets_list = QListWidget()
+        self.budgets_list.setToolTip('Лимиты задаются во вкладке «Настройки»')
+        layout.addWidget(self.budgets_list)
+        
         layout.addStretch()
         
     def setup_operations_tab(self):
         layout = QVBoxLayout(self.operations_tab)
         
-        self.operations_table = QTableWidget()
-        self.operations_table.setColumnCount(6)
-        self.operations_table.setHorizontalHeaderLabels([
-            'Тип', 'Название', 'Сумма', 'Валюта', 'Дата и время', 'Комментарий'
-        ])
-        self.operations_table.horizontalHeader().setStretchLastSection(True)
+        self.operations_model = OperationsTableModel(self.ledger.operations, pending=False, parent=self)
+        self.operations_table = self.create_operations_view(self.operations_model)
+        self.ledger.operations.prepare_search()
+        self.operations_filter = FilterBar(self.operations_model, self.filter_currencies())
+        layout.addWidget(self.operations_filter)
         layout.addWidget(self.operations_table)
+        self.update_operations_table()
         
         btn_layout = QHBoxLayout()
         
@@ -163,18 +898,30 @@ class FinanceApp(QMainWindow):
         clear_btn.clicked.connect(self.clear_all_operations)
         btn_layout.addWidget(clear_btn)
         
+        import_btn = QPushButton('Импорт выписки...')
+        import_btn.clicked.connect(self.import_statement)
+        import_btn.setEnabled(self.data_loaded)
+        self.data_buttons.append(import_btn)
+        btn_layout.addWidget(import_btn)
+        
+        export_btn = QPushButton('Выгрузить...')
+        export_btn.clicked.connect(self.export_operations)
+        btn_layout.addWidget(export_btn)
+        
         layout.addLayout(btn_layout)
         
     def setup_pending_tab(self):
         layout = QVBoxLayout(self.pending_tab)
         
-        self.pending_table = QTableWidget()
-        self.pending_table.setColumnCount(7)
-        self.pending_table.setHorizontalHeaderLabels([
-            'Статус', 'Название', 'Сумма', 'Валюта', 'Дата и время', 'Комментарий', 'Действия'
-        ])
-        self.pending_table.horizontalHeader().setStretchLastSection(True)
+        self.pending_model = OperationsTableModel(self.ledger.operations, pending=True, parent=self)
+        self.pending_table = self.create_operations_view(self.pending_model)
+        self.confirm_delegate = ConfirmButtonDelegate(self.pending_table)
+        self.confirm_delegate.clicked.connect(self.confirm_pending_income)
+        self.pending_table.setItemDelegateForColumn(6, self.confirm_delegate)
+        self.pending_filter = FilterBar(self.pending_model, self.filter_currencies(), with_type=False)
+        layout.addWidget(self.pending_filter)
         layout.addWidget(self.pending_table)
+        self.update_pending_table()
         
         confirm_layout = QHBoxLayout()
         confirm_btn = QPushButton('Подтвердить выбранный доход')
@@ -187,15 +934,152 @@ class FinanceApp(QMainWindow):
         delete_pending_btn.setStyleSheet('background-color: #f44336; color: white;')
         confirm_layout.addWidget(delete_pending_btn)
         
+        export_pending_btn = QPushButton('Выгрузить...')
+        export_pending_btn.clicked.connect(self.export_operations)
+        confirm_layout.addWidget(export_pending_btn)
+        
         layout.addLayout(confirm_layout)
         
+    def create_operations_view(self, model):
+        table = QTableView()
+        table.setModel(model)
+        table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        table.setSelectionMode(QAbstractItemView.SingleSelection)
+        table.horizontalHeader().setStretchLastSection(True)
+        # Ширину колонок подбираем по первым строкам, а не по всей таблице
+        table.horizontalHeader().setResizeContentsPrecision(50)
+        table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        return table
+        
+    ANALYTICS_PERIODS = [('Дни', 'day', 30), ('Недели', 'week', 26), ('Месяцы', 'month', 12)]
+    CATEGORY_PERIODS = [('Последний месяц', 1), ('3 месяца', 3), ('12 месяцев', 12)]
+    FORECAST_PERIODS = [('6 месяцев', 6), ('12 месяцев', 12), ('24 месяца', 24)]
+    FORECAST_SCENARIOS = [('Обычный разброс расходов', 1.0), ('Вдвое больший разброс', 2.0)]
+    
     def setup_analytics_tab(self):
         layout = QVBoxLayout(self.analytics_tab)
         
-        label = QLabel('Аналитика\n\nЭта вкладка находится в разработке.\nЗдесь будет отображаться графическая аналитика ваших финансов.')
-        label.setAlignment(Qt.AlignCenter)
-        label.setStyleSheet('font-size: 16px; color: #666;')
-        layout.addWidget(label)
+        flow_layout = QHBoxLayout()
+        flow_label = QLabel('Доходы и расходы')
+        flow_label.setStyleSheet('font-weight: bold;')
+        flow_layout.addWidget(flow_label)
+        flow_layout.addStretch()
+        self.period_combo = QComboBox()
+        for title, unit, count in self.ANALYTICS_PERIODS:
+            self.period_combo.addItem(title, (unit, count))
+        self.period_combo.setCurrentIndex(2)
+        self.period_combo.currentIndexChanged.connect(self.update_analytics)
+        flow_layout.addWidget(self.period_combo)
+        layout.addLayout(flow_layout)
+        
+        self.flow_chart = BarChart()
+        layout.addWidget(self.flow_chart, 2)
+        
+        category_layout = QHBoxLayout()
+        category_label = QLabel('Расходы по категориям')
+        category_label.setStyleSheet('font-weight: bold;')
+        category_layout.addWidget(category_label)
+        category_layout.addStretch()
+        self.category_period_combo = QComboBox()
+        for title, months in self.CATEGORY_PERIODS:
+            self.category_period_combo.addItem(title, months)
+        self.category_period_combo.currentIndexChanged.connect(self.update_analytics)
+        category_layout.addWidget(self.category_period_combo)
+        layout.addLayout(category_layout)
+        
+        self.category_chart = BarChart(horizontal=True)
+        layout.addWidget(self.category_chart, 2)
+        
+        trends_label = QLabel('Изменение по валютам за месяц')
+        trends_label.setStyleSheet('font-weight: bold;')
+        layout.addWidget(trends_label)
+        self.trends_table = QTableWidget()
+        self.trends_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.trends_table, 1)
+        
+        forecast_layout = QHBoxLayout()
+        forecast_label = QLabel('Прогноз баланса')
+        forecast_label.setStyleSheet('font-weight: bold;')
+        forecast_layout.addWidget(forecast_label)
+        forecast_layout.addStretch()
+        self.forecast_scenario_combo = QComboBox()
+        for title, volatility in self.FORECAST_SCENARIOS:
+            self.forecast_scenario_combo.addItem(title, volatility)
+        self.forecast_scenario_combo.currentIndexChanged.connect(self.update_forecast)
+        forecast_layout.addWidget(self.forecast_scenario_combo)
+        self.forecast_period_combo = QComboBox()
+        for title, months in self.FORECAST_PERIODS:
+            self.forecast_period_combo.addItem(title, months)
+        self.forecast_period_combo.setCurrentIndex(1)
+        self.forecast_period_combo.currentIndexChanged.connect(self.update_forecast)
+        forecast_layout.addWidget(self.forecast_period_combo)
+        layout.addLayout(forecast_layout)
+        
+        self.forecast_chart = BandChart()
+        layout.addWidget(self.forecast_chart, 2)
+        self.forecast_note = QLabel()
+        self.forecast_note.setStyleSheet('color: #666;')
+        self.forecast_note.setWordWrap(True)
+        layout.addWidget(self.forecast_note)
+        
+        self.update_analytics()
+        self.update_forecast()
+        
+    def update_analytics(self):
+        """Перерисовывает аналитику по готовым итогам, без прохода по операциям"""
+        if self.flow_chart is None:
+            return
+        rollups = self.ledger.get_rollups()
+        converter = self.ledger.get_converter()
+        currency = self.ledger.base_currency
+        
+        unit, count = self.period_combo.currentData()
+        buckets, income, expense, missing = rollups.flow_series(unit, count, converter, currency)
+        labels = [bucket[5:] if unit != 'month' else bucket for bucket in buckets]
+        self.flow_chart.set_data(labels, [(f'Доходы, {currency}', '#4CAF50', income),
+                                          (f'Расходы, {currency}', '#f44336', expense)])
+        
+        months = rollups.buckets('month', self.category_period_combo.currentData())
+        spending, category_missing = rollups.category_spending(months, converter, currency)
+        spending = spending[:10]
+        self.category_chart.set_data([name for name, _ in spending],
+                                     [(f'Расходы, {currency}', '#f44336', [amount for _, amount in spending])])
+        self.category_chart.setMinimumHeight(40 + 24 * len(spending))
+        
+        months, trends = rollups.currency_trends(6)
+        currencies = sorted(trends)
+        self.trends_table.setRowCount(len(months))
+        self.trends_table.setColumnCount(len(currencies))
+        self.trends_table.setHorizontalHeaderLabels(currencies)
+        self.trends_table.setVerticalHeaderLabels(months)
+        for column, trend_currency in enumerate(currencies):
+            for row, amount in enumerate(trends[trend_currency]):
+                item = QTableWidgetItem(f'{amount:+.2f}' if amount else '0')
+                item.setForeground(QColor('#4CAF50') if amount > 0 else QColor('#f44336') if amount < 0 else QColor('#666'))
+                self.trends_table.setItem(row, column, item)
+        
+        missing = sorted(set(missing) | set(category_missing))
+        self.flow_chart.setToolTip(f'Без курса не учтены: {", ".join(missing)}' if missing else '')
+        
+    def update_forecast(self):
+        """Прогноз баланса по истории категорий и повторяющимся операциям (10 000 случайных путей)"""
+        from finance_forecast import project
+        if self.forecast_chart is None:
+            return
+        forecast = project(self.ledger, self.forecast_period_combo.currentData(),
+                           volatility=self.forecast_scenario_combo.currentData())
+        labels = forecast.months
+        bands = [(forecast.percentiles[5], forecast.percentiles[95], '#BBDEFB'),
+                 (forecast.percentiles[25], forecast.percentiles[75], '#90CAF9')]
+        self.forecast_chart.set_data(labels, bands, forecast.percentiles[50])
+        currency = forecast.currency
+        note = (f'К {labels[-1]}: скорее всего {to_normal_readly_type(round(forecast.percentiles[50][-1]))} {currency}, '
+                f'в 9 случаях из 10 — от {to_normal_readly_type(round(forecast.percentiles[5][-1]))} '
+                f'до {to_normal_readly_type(round(forecast.percentiles[95][-1]))}.\n'
+                'Темная полоса — половина сценариев, светлая — 90%.')
+        if forecast.missing:
+            note += f'\nБез курса не учтены: {", ".join(forecast.missing)}'
+        self.forecast_note.setText(note)
         
     def setup_settings_tab(self):
         layout = QVBoxLayout(self.settings_tab)
@@ -205,7 +1089,7 @@ class FinanceApp(QMainWindow):
         
         self.base_currency_combo = QComboBox()
         self.base_currency_combo.addItems(['USD', 'EUR', 'RUB', 'KZT', 'UAH', 'BYN'])
-        self.base_currency_combo.setCurrentText(self.base_currency)
+        self.base_currency_combo.setCurrentText(self.ledger.base_currency)
         self.base_currency_combo.currentTextChanged.connect(self.change_base_currency)
         layout.addWidget(self.base_currency_combo)
         
@@ -223,7 +1107,7 @@ class FinanceApp(QMainWindow):
             spinbox = QDoubleSpinBox()
             spinbox.setMinimum(0.01)
             spinbox.setMaximum(10000)
-            spinbox.setValue(self.exchange_rates.get(currency, 1.0))
+            spinbox.setValue(self.ledger.exchange_rates.get(currency, 1.0))
             spinbox.valueChanged.connect(lambda val, c=currency: self.update_exchange_rate(c, val))
             hbox.addWidget(label)
             hbox.addWidget(spinbox)
@@ -233,7 +1117,60 @@ class FinanceApp(QMainWindow):
             self.rate_inputs[currency] = spinbox
             
         layout.addWidget(self.rates_widget)
-        layout.addStretch()
+        
+        history_label = QLabel('Новый курс действует с сегодняшнего дня: операции прошлых дней в аналитике\n'
+                               'пересчитываются по курсам, действовавшим в день операции.')
+        history_label.setStyleSheet('color: #666;')
+        layout.addWidget(history_label)
+        
+        import_rates_btn = QPushButton('Импорт курсов по датам (CSV)...')
+        import_rates_btn.clicked.connect(self.import_rates_file)
+        layout.addWidget(import_rates_btn)
+        
+        recurring_label = QLabel('Повторяющиеся операции:')
+        recurring_label.setStyleSheet('font-weight: bold; margin-top: 20px;')
+        layout.addWidget(recurring_label)
+        
+        self.recurring_list = QListWidget()
+        layout.addWidget(self.recurring_list)
+        delete_rule_btn = QPushButton('Больше не повторять')
+        delete_rule_btn.clicked.connect(self.delete_selected_recurring)
+        layout.addWidget(delete_rule_btn)
+        self.update_recurring_list()
+        
+        budgets_label = QLabel('Бюджеты на месяц (0 — без лимита):')
+        budgets_label.setStyleSheet('font-weight: bold; margin-top: 20px;')
+        layout.addWidget(budgets_label)
+        
+        budgets_widget = QWidget()
+        budgets_layout = QGridLayout(budgets_widget)
+        for row, name in enumerate(self.ledger.predefined_expense_names):
+            budget = self.ledger.budgets.get(name, {})
+            currency = budget.get('currency', self.ledger.base_currency)
+            spinbox = QDoubleSpinBox()
+            spinbox.setMaximum(1e9)
+            spinbox.setDecimals(0)
+            spinbox.setValue(budget.get('limit', 0))
+            spinbox.valueChanged.connect(lambda val, n=name, c=currency: self.update_budget(n, val, c))
+            budgets_layout.addWidget(QLabel(name), row // 2, (row % 2) * 3)
+            budgets_layout.addWidget(spinbox, row // 2, (row % 2) * 3 + 1)
+            budgets_layout.addWidget(QLabel(currency), row // 2, (row % 2) * 3 + 2)
+        layout.addWidget(budgets_widget)
+        
+        diagnostics_label = QLabel('Диагностика:')
+        diagnostics_label.setStyleSheet('font-weight: bold; margin-top: 20px;')
+        layout.addWidget(diagnostics_label)
+        
+        diagnostics_layout = QHBoxLayout()
+        profile_check = QCheckBox('Замерять обработчики окна (окно работает медленнее)')
+        profile_check.setChecked(PROFILER.enabled)
+        profile_check.toggled.connect(self.toggle_profiling)
+        diagnostics_layout.addWidget(profile_check)
+        diagnostics_btn = QPushButton('Диагностика...')
+        diagnostics_btn.clicked.connect(self.show_diagnostics)
+        diagnostics_layout.addWidget(diagnostics_btn)
+        diagnostics_layout.addStretch()
+        layout.addLayout(diagnostics_layout)
     
     def add_operation(self, op_type):
         if op_type == 'pending_income':
@@ -254,63 +1191,39 @@ class FinanceApp(QMainWindow):
                 'is_pending': is_pending
             }
             
-            self.operations.append(operation)
+            op_id = self.ledger.add(operation)
             
-            if op_type == 'pending_income' or is_pending:
-                if currency in self.pending_currencies:
-                    self.pending_currencies[currency] += amount
-                else:
-                    self.pending_currencies[currency] = amount
-            else:
-                if op_type == 'income':
-                    if currency in self.currencies:
-                        self.currencies[currency] += amount
-                    else:
-                        self.currencies[currency] = amount
-                else:  
-                    if currency in self.currencies:
-                        self.currencies[currency] -= amount
-                    else:
-                        self.currencies[currency] = -amount
+            model = self.pending_model if is_pending else self.operations_model
+            if model is not None:
+                model.append_operation(op_id)
+            
+            every = dialog.get_recurrence()
+            if every:
+                self.ledger.add_recurring(operation, every)
+                self.scheduler.mark('recurring')
             
-            self.update_amounts_display()
-            self.update_operations_table()
-            self.update_pending_table()
-            self.update_currency_lists()
-            self.save_data()
+            self.scheduler.mark(*self.BALANCE_REGIONS)
     
     def calculate_total_in_base_currency(self, currency_dict):
-        """Рассчитывает сумму в основной валюте"""
-        total = 0.0
-        
-        for currency, amount in currency_dict.items():
-            if currency == self.base_currency:
-                total += amount
-            else:
-                if currency in self.exchange_rates and self.base_currency == 'RUB':
-                    total += amount * self.exchange_rates[currency]
-                elif self.base_currency in self.exchange_rates and currency == 'RUB':
-                    total += amount / self.exchange_rates[self.base_currency]
-                else:
-                    if currency in self.exchange_rates and self.base_currency in self.exchange_rates:
-                        amount_in_rub = amount * self.exchange_rates[currency]
-                        total += amount_in_rub / self.exchange_rates[self.base_currency]
-        
-        return total
-    
-
+        """Рассчитывает сумму в основной валюте и возвращает ее вместе с валютами без курса"""
+        return self.ledger.total(currency_dict)
 
     def update_amounts_display(self):
-        actual_total = self.calculate_total_in_base_currency(self.currencies)
-        pending_total = self.calculate_total_in_base_currency(self.pending_currencies)
+        actual_total, missing = self.calculate_total_in_base_currency(self.ledger.balances.actual)
+        pending_total, pending_missing = self.calculate_total_in_base_currency(self.ledger.balances.pending)
         total_with_pending = actual_total + pending_total
         
+        missing = sorted(set(missing) | set(pending_missing))
+        if missing:
+            self.missing_rates_label.setText(f'Нет курса для {", ".join(missing)} — эти суммы не учтены')
+        self.missing_rates_label.setVisible(bool(missing))
+        
         if self.is_amount_hidden:
-            self.total_label.setText(f'Общая сумма (с ожидаемыми): ****** {self.base_currency}')
-            self.actual_label.setText(f'Фактическая сумма: ****** {self.base_currency}')
+            self.total_label.setText(f'Общая сумма (с ожидаемыми): ****** {self.ledger.base_currency}')
+            self.actual_label.setText(f'Фактическая сумма: ****** {self.ledger.base_currency}')
         else:
-            self.total_label.setText(f'Общая сумма (с ожидаемыми): {to_normal_readly_type(total_with_pending)} {self.base_currency}')
-            self.actual_label.setText(f'Фактическая сумма: {to_normal_readly_type(actual_total)} {self.base_currency}')
+            self.total_label.setText(f'Общая сумма (с ожидаемыми): {to_normal_readly_type(total_with_pending)} {self.ledger.base_currency}')
+            self.actual_label.setText(f'Фактическая сумма: {to_normal_readly_type(actual_total)} {self.ledger.base_currency}')
             
     def toggle_amount_visibility(self):
         self.is_amount_hidden = not self.is_amount_hidden
@@ -318,67 +1231,145 @@ class FinanceApp(QMainWindow):
             self.hide_button.setText('Показать суммы')
         else:
             self.hide_button.setText('Скрыть суммы')
-        self.update_amounts_display()
-        
-    def update_operations_table(self):
-        actual_operations = [op for op in self.operations if not op.get('is_pending', False)]
-        self.operations_table.setRowCount(len(actual_operations))
-        
-        for row, op in enumerate(actual_operations):
-            type_text = 'Доход' if op['type'] == 'income' else 'Расход'
-            type_item = QTableWidgetItem(type_text)
-            type_item.setForeground(QColor('#4CAF50') if op['type'] == 'income' else QColor('#f44336'))
+        self.scheduler.mark('totals', 'budgets', 'ledgers')
+        
+    def update_history_buttons(self):
+        undo_title, redo_title = self.ledger.history.titles()
+        self.undo_button.setEnabled(undo_title is not None)
+        self.undo_button.setToolTip(f'Отменить: {undo_title}' if undo_title else 'Нечего отменять')
+        self.redo_button.setEnabled(redo_title is not None)
+        self.redo_button.setToolTip(f'Повторить: {redo_title}' if redo_title else 'Нечего повторять')
+        
+    def undo_change(self):
+        if self.ledger.undo() is not None:
+            self.operations_replaced()
+            
+    def redo_change(self):
+        if self.ledger.redo() is not None:
+            self.operations_replaced()
             
-            name_item = QTableWidgetItem(op['name'])
-            amount_item = QTableWidgetItem(f"{op['amount']:.2f}")
-            currency_item = QTableWidgetItem(op['currency'])
-            datetime_item = QTableWidgetItem(op['datetime'])
-            comment_item = QTableWidgetItem(op['comment'])
+    def operations_replaced(self):
+        """Операции поменялись пачкой (очистка, отмена, повтор): таблицы обновляются
+        сразу, иначе до обновления они перерисовали бы строки, которых уже нет"""
+        self.scheduler.mark('operations', 'pending', *self.BALANCE_REGIONS)
+        self.scheduler.flush(0)
+        
+    def table_outdated(self):
+        """Выбранной строки уже нет: операции изменили в другом окне раньше, чем
+        обновилась таблица. Изменения подхватываются, таблицы строятся заново"""
+        self.ledger.refresh()
+        self.operations_replaced()
+        
+    def update_window_title(self):
+        from finance_ledgers import DEFAULT_LEDGER
+        if self.ledger_name == DEFAULT_LEDGER:
+            self.setWindowTitle('Finance Manager')
+        else:
+            self.setWindowTitle(f'Finance Manager — {self.ledger_name}')
+            
+    def switch_ledger(self, name):
+        """Закрывает текущий учет и открывает другой в том же окне"""
+        if not self.data_loaded or not name or name == self.ledger_name:
+            return
+        self.close_ledger()
+        self.flusher = None
+        self.data_loaded = False
+        for button in self.data_buttons:
+            button.setEnabled(False)
+        
+        # Пока новый учет грузится, видны итоги из его кэша
+        from finance_ledgers import ledger_path
+        self.ledger_name = name
+        self.ledger = Ledger(ledger_path(name))
+        self.ledger.load_summary()
+        self.reset_settings_tab()
+        self.update_window_title()
+        self.operations_replaced()
+        self.start_loading()
+        
+    def add_ledger(self):
+        from finance_ledgers import create_ledger, ledger_names
+        name, ok = QInputDialog.getText(self, 'Новый учет', 'Название (например, «Семья» или «Работа»):')
+        if not ok or not name.strip():
+            return
+        try:
+            name = create_ledger(name)
+        except (OSError, ValueError) as error:
+            QMessageBox.warning(self, 'Новый учет', f'Не удалось создать учет: {error}')
+            return
+        self.ledger_combo.blockSignals(True)
+        self.ledger_combo.clear()
+        self.ledger_combo.addItems(ledger_names())
+        self.ledger_combo.blockSignals(False)
+        self.ledger_combo.setCurrentText(name)
+        
+    def reset_settings_tab(self):
+        """Настройки другого учета: вкладка строится заново при следующем открытии"""
+        index = self.tab_widget.indexOf(self.settings_tab)
+        current = self.tab_widget.currentIndex() == index
+        self.tab_widget.removeTab(index)
+        self.settings_tab.deleteLater()
+        self.recurring_list = None
+        self.settings_tab = QWidget()
+        self.tab_widget.insertTab(index, self.settings_tab, 'Настройки')
+        self.tab_builders[self.settings_tab] = self.setup_settings_tab
+        if current:
+            self.tab_widget.setCurrentIndex(index)
+            self.ensure_tab_built(index)
             
-            self.operations_table.setItem(row, 0, type_item)
-            self.operations_table.setItem(row, 1, name_item)
-            self.operations_table.setItem(row, 2, amount_item)
-            self.operations_table.setItem(row, 3, currency_item)
-            self.operations_table.setItem(row, 4, datetime_item)
-            self.operations_table.setItem(row, 5, comment_item)
+    def update_consolidated(self):
+        """Сумма по всем учетам по их кэшам итогов (когда учетов больше одного)"""
+        if not self.data_loaded or self.ledger_combo.count() < 2:
+            self.consolidated_label.setVisible(False)
+            return
+        from finance_ledgers import consolidated
+        currency = self.ledger.base_currency
+        rows, actual, pending = consolidated(currency, self.ledger_name, self.ledger)
+        if self.is_amount_hidden:
+            self.consolidated_label.setText(f'Все учеты: ****** {currency}')
+        else:
+            self.consolidated_label.setText(f'Все учеты: {to_normal_readly_type(round(actual))} {currency}')
+        lines = []
+        for name, ledger_actual, ledger_pending, missing in rows:
+            line = (f'{name}: {to_normal_readly_type(round(ledger_actual))} {currency}, '
+                    f'ожидается {to_normal_readly_type(round(ledger_pending))}')
+            if missing:
+                line += f' (без курса: {", ".join(missing)})'
+            lines.append(line)
+        lines.append(f'С ожидаемыми: {to_normal_readly_type(round(actual + pending))} {currency}')
+        self.consolidated_label.setToolTip('\n'.join(lines) if not self.is_amount_hidden else '')
+        self.consolidated_label.setVisible(True)
+        
+    def check_outside_changes(self):
+        # Другие учеты тоже могли измениться — сводку обновляем заодно
+        self.scheduler.mark('ledgers')
+        if self.ledger.refresh():
+            self.scheduler.mark('recurring')
+            self.operations_replaced()
             
+    def update_operations_table(self):
+        if self.operations_model is None:
+            return
+        self.operations_model.set_store(self.ledger.operations)
         self.operations_table.resizeColumnsToContents()
     
+    def filter_currencies(self):
+        return set(self.ledger.exchange_rates) | set(self.ledger.balances.actual) | set(self.ledger.balances.pending)
+    
+
     def update_pending_table(self):
-        pending_operations = [op for op in self.operations if op.get('is_pending', False)]
-        self.pending_table.setRowCount(len(pending_operations))
-        
-        for row, op in enumerate(pending_operations):
-            status_item = QTableWidgetItem('Ожидает')
-            status_item.setForeground(QColor('#FF9800'))
-            
-            name_item = QTableWidgetItem(op['name'])
-            amount_item = QTableWidgetItem(f"{op['amount']:.2f}")
-            currency_item = QTableWidgetItem(op['currency'])
-            datetime_item = QTableWidgetItem(op['datetime'])
-            comment_item = QTableWidgetItem(op['comment'])
-            
-            confirm_btn = QPushButton('Подтвердить')
-            confirm_btn.clicked.connect(lambda checked, r=row: self.confirm_pending_income(r))
-            confirm_btn.setStyleSheet('background-color: #4CAF50; color: white; padding: 5px;')
-            
-            self.pending_table.setItem(row, 0, status_item)
-            self.pending_table.setItem(row, 1, name_item)
-            self.pending_table.setItem(row, 2, amount_item)
-            self.pending_table.setItem(row, 3, currency_item)
-            self.pending_table.setItem(row, 4, datetime_item)
-            self.pending_table.setItem(row, 5, comment_item)
-            self.pending_table.setCellWidget(row, 6, confirm_btn)
-            
+        if self.pending_model is None:
+            return
+        self.pending_model.set_store(self.ledger.operations)
         self.pending_table.resizeColumnsToContents()
         
     def update_currency_lists(self):
         # Обновляем список фактических балансов
         self.currencies_list.clear()
         
-        for currency, amount in sorted(self.currencies.items()):
+        for currency, amount in sorted(self.ledger.balances.actual.items()):
             if amount != 0:
-                item_text = f"{currency}: {amount:.2f}"
+                item_text = f"{currency}: {amount:.{self.ledger.operations.digits(currency)}f}"
                 item = QListWidgetItem(item_text)
                 if amount > 0:
                     item.setForeground(QColor('#4CAF50'))
@@ -388,138 +1379,261 @@ class FinanceApp(QMainWindow):
         
         self.pending_list.clear()
         
-        for currency, amount in sorted(self.pending_currencies.items()):
+        for currency, amount in sorted(self.ledger.balances.pending.items()):
             if amount != 0:
-                item_text = f"{currency}: {amount:.2f}"
+                item_text = f"{currency}: {amount:.{self.ledger.operations.digits(currency)}f}"
                 item = QListWidgetItem(item_text)
                 item.setForeground(QColor('#FF9800'))
                 self.pending_list.addItem(item)
     
+    def update_budgets(self):
+        """Бюджеты главной вкладки: остаток, предупреждение с 80% и превышение"""
+        self.budgets_list.clear()
+        if not self.data_loaded:
+            return
+        for name, limit, spent, previous, currency, missing in self.ledger.budget_status():
+            share = spent / limit
+            if self.is_amount_hidden:
+                text = f'{name}: потрачено {share:.0%} бюджета'
+            elif spent > limit:
+                text = (f'{name}: {to_normal_readly_type(round(spent))} из {to_normal_readly_type(limit)} {currency}, '
+                        f'превышен на {to_normal_readly_type(round(spent - limit))}')
+            else:
+                text = (f'{name}: {to_normal_readly_type(round(spent))} из {to_normal_readly_type(limit)} {currency}, '
+                        f'осталось {to_normal_readly_type(round(limit - spent))}')
+            item = QListWidgetItem(text)
+            if share > 1:
+                item.setForeground(QColor('#f44336'))
+            elif share >= BudgetTracker.WARNING_SHARE:
+                item.setForeground(QColor('#FF9800'))
+            tooltip = f'В прошлом месяце: {to_normal_readly_type(round(previous))} {currency}'
+            if missing:
+                tooltip += f'\nБез курса не учтены: {", ".join(missing)}'
+            item.setToolTip(tooltip)
+            self.budgets_list.addItem(item)
+        
     def confirm_pending_income(self, row_index):
-        pending_ops = [op for op in self.operations if op.get('is_pending', False)]
-        if row_index < len(pending_ops):
-            pending_op = pending_ops[row_index]
-            for i, op in enumerate(self.operations):
-                if op == pending_op:
-                    currency = op['currency']
-                    amount = op['amount']
-                    
-                    if currency in self.pending_currencies:
-                        self.pending_currencies[currency] -= amount
-                        if self.pending_currencies[currency] == 0:
-                            del self.pending_currencies[currency]
-                    
-                    if currency in self.currencies:
-                        self.currencies[currency] += amount
-                    else:
-                        self.currencies[currency] = amount
-                    
-                    op['is_pending'] = False
-                    
-                    self.update_amounts_display()
-                    self.update_operations_table()
-                    self.update_pending_table()
-                    self.update_currency_lists()
-                    self.save_data()
-                    break
+        if row_index < self.pending_model.rowCount():
+            op_id = self.pending_model.operation_id(row_index)
+            if op_id is None:
+                self.table_outdated()
+                return
+            
+            # Подтвержденная операция встает в таблицу на свое место по порядку
+            position = self.ledger.confirm(op_id)
+            self.pending_model.remove_row(row_index)
+            if self.operations_model is not None:
+                self.operations_model.insert_operation(position, op_id)
+            
+            self.scheduler.mark(*self.BALANCE_REGIONS)
     
     def confirm_selected_pending(self):
-        selected = self.pending_table.currentRow()
+        selected = self.pending_table.currentIndex().row()
         if selected >= 0:
             self.confirm_pending_income(selected)
     
     def delete_selected_pending(self):
-        selected = self.pending_table.currentRow()
+        selected = self.pending_table.currentIndex().row()
         if selected >= 0:
-            pending_ops = [op for op in self.operations if op.get('is_pending', False)]
-            if selected < len(pending_ops):
-                pending_op = pending_ops[selected]
-                
-                currency = pending_op['currency']
-                amount = pending_op['amount']
+            if selected < self.pending_model.rowCount():
+                op_id = self.pending_model.operation_id(selected)
+                if op_id is None:
+                    self.table_outdated()
+                    return
                 
-                if currency in self.pending_currencies:
-                    self.pending_currencies[currency] -= amount
-                    if self.pending_currencies[currency] == 0:
-                        del self.pending_currencies[currency]
+                self.ledger.delete(op_id)
+                self.pending_model.remove_row(selected)
                 
-                self.operations.remove(pending_op)
-                
-                self.update_amounts_display()
-                self.update_pending_table()
-                self.update_currency_lists()
-                self.save_data()
+                self.scheduler.mark(*self.BALANCE_REGIONS)
                 
     def delete_selected_operation(self):
-        selected = self.operations_table.currentRow()
+        selected = self.operations_table.currentIndex().row()
         if selected >= 0:
-            actual_ops = [op for op in self.operations if not op.get('is_pending', False)]
-            if selected < len(actual_ops):
-                op = actual_ops[selected]
-                
-                if op['type'] == 'income':
-                    self.currencies[op['currency']] -= op['amount']
-                else:
-                    self.currencies[op['currency']] += op['amount']
+            if selected < self.operations_model.rowCount():
+                op_id = self.operations_model.operation_id(selected)
+                if op_id is None:
+                    self.table_outdated()
+                    return
                 
-                self.operations.remove(op)
+                self.ledger.delete(op_id)
+                self.operations_model.remove_row(selected)
                 
-                self.update_amounts_display()
-                self.update_operations_table()
-                self.update_currency_lists()
-                self.save_data()
+                self.scheduler.mark(*self.BALANCE_REGIONS)
                 
     def clear_all_operations(self):
         reply = QMessageBox.question(self, 'Подтверждение', 
-                                   'Вы уверены, что хотите удалить все операции?',
+                                   'Вы уверены, что хотите удалить все операции?\n'
+                                   'Удаление можно отменить кнопкой «Отменить».',
                                    QMessageBox.Yes | QMessageBox.No)
         
         if reply == QMessageBox.Yes:
-            self.operations.clear()
-            self.currencies.clear()
-            self.pending_currencies.clear()
-            
-            self.update_amounts_display()
-            self.update_operations_table()
-            self.update_pending_table()
-            self.update_currency_lists()
-            self.save_data()
+            self.ledger.clear()
+            self.operations_replaced()
     
+    def import_statement(self):
+        from finance_import import import_file
+        path, _ = QFileDialog.getOpenFileName(self, 'Импорт выписки', '',
+                                              'Выписки (*.csv *.json *.jsonl *.ndjson);;Все файлы (*)')
+        if not path:
+            return
+        
+        def report(stats):
+            self.tasks.progress.emit(f'Импорт выписки: {stats.imported:,} операций'.replace(',', ' '), 0, 0)
+            
+        self.run_locked('Импорт выписки', lambda: import_file(self.ledger, path, progress=report),
+                        done=self.statement_imported)
+        
+    def statement_imported(self, stats, error):
+        # Пачки до ошибки уже добавлены, поэтому окно обновляется в любом случае
+        self.scheduler.mark('operations', 'pending', *self.BALANCE_REGIONS)
+        if error is not None:
+            QMessageBox.warning(self, 'Импорт выписки', f'Не удалось импортировать файл: {error}')
+            return
+        message = stats.summary()
+        if stats.errors:
+            message += '\n\n' + '\n'.join(f'строка {number}: {error}' for number, error in stats.errors)
+        QMessageBox.information(self, 'Импорт выписки', message)
+        
+    def export_operations(self):
+        """Выгружает операции открытой вкладки (фактические или ожидаемые) под
+        фильтрами ее таблицы или отчет по месяцам по ним же"""
+        from finance_export import export_operations, export_report
+        pending = self.tab_widget.currentWidget() is self.pending_tab
+        filter_bar = self.pending_filter if pending else self.operations_filter
+        report_filter = 'Отчет по месяцам (*.csv *.xlsx)'
+        path, selected = QFileDialog.getSaveFileName(
+            self, 'Выгрузка ожидаемых операций' if pending else 'Выгрузка операций', '',
+            f'CSV (*.csv);;Excel (*.xlsx);;JSON (*.json);;JSON Lines (*.jsonl);;{report_filter}')
+        if not path:
+            return
+        filters = {key: value for key, value in filter_bar.filters().items() if value is not None}
+        total = self.ledger.operations.count(pending, **filters)
+        
+        def report(stats):
+            self.tasks.progress.emit(f'Выгрузка: {stats.operations:,} из {total:,}'.replace(',', ' '),
+                                     stats.operations, total)
+            
+        if selected == report_filter:
+            export = lambda: export_report(self.ledger, path, progress=report, pending=pending, **filters)
+        else:
+            export = lambda: (export_operations(self.ledger, path, progress=report, pending=pending, **filters), [])
+        self.run_locked('Выгрузка операций', export, done=self.operations_exported)
+        
+    def operations_exported(self, result, error):
+        if error is not None:
+            QMessageBox.warning(self, 'Выгрузка операций', f'Не удалось выгрузить: {error}')
+            return
+        stats, missing = result
+        message = stats.summary()
+        if missing:
+            message += f'\n\nНет курса для {", ".join(missing)} — эти суммы не учтены в строках «все в ...»'
+        QMessageBox.information(self, 'Выгрузка операций', message)
+        
+    def import_rates_file(self):
+        from finance_import import import_rates
+        path, _ = QFileDialog.getOpenFileName(self, 'Импорт курсов', '', 'CSV (*.csv);;Все файлы (*)')
+        if not path:
+            return
+        try:
+            count = import_rates(self.ledger, path)
+        except (OSError, ValueError) as error:
+            QMessageBox.warning(self, 'Импорт курсов', f'Не удалось импортировать курсы: {error}')
+            return
+        for currency, spinbox in self.rate_inputs.items():
+            spinbox.blockSignals(True)
+            spinbox.setValue(self.ledger.exchange_rates.get(currency, 1.0))
+            spinbox.blockSignals(False)
+        self.scheduler.mark('totals', 'analytics', 'forecast')
+        QMessageBox.information(self, 'Импорт курсов', f'Добавлено курсов: {count}')
+        
+    def run_recurring(self):
+        """Добавляет наступившие повторения (после перерыва — все пропущенные одной пачкой)"""
+        if self.ledger.run_schedule():
+            self.scheduler.mark('operations', 'pending', 'recurring', *self.BALANCE_REGIONS)
+            
+    def update_recurring_list(self):
+        if self.recurring_list is None:
+            return
+        self.recurring_list.clear()
+        schedule = self.ledger.get_schedule()
+        for rule in self.ledger.recurring:
+            operation = rule['operation']
+            upcoming = schedule.upcoming(rule['id'])
+            kind = 'ожидаемый доход' if operation['is_pending'] else 'доход' if operation['type'] == 'income' else 'расход'
+            item = QListWidgetItem(f'{operation["name"]}: {to_normal_readly_type(operation["amount"], self.ledger.operations.digits(operation["currency"]))} '
+                                   f'{operation["currency"]} ({kind}), {RECURRENCE_TITLES[rule["every"]].lower()}, '
+                                   f'следующий раз {upcoming[:10] if upcoming else "—"}')
+            item.setData(Qt.UserRole, rule['id'])
+            self.recurring_list.addItem(item)
+            
+    def delete_selected_recurring(self):
+        item = self.recurring_list.currentItem()
+        if item is not None:
+            self.ledger.remove_recurring(item.data(Qt.UserRole))
+            self.scheduler.mark('recurring', 'forecast')
+        
     def change_base_currency(self, currency):
-        self.base_currency = currency
-        self.update_amounts_display()
-        self.save_data()
+        # На диск настройки уйдут одной записью вместе с остальными изменениями
+        self.ledger.set_base_currency(currency, defer=True)
+        self.scheduler.mark('totals', 'analytics', 'forecast', 'disk')
     
+    def update_budget(self, name, limit, currency):
+        self.ledger.set_budget(name, limit, currency, defer=True)
+        self.scheduler.mark('budgets', 'disk')
+        
     def update_exchange_rate(self, currency, rate):
-        self.exchange_rates[currency] = rate
-        self.update_amounts_display()
-        self.save_data()
-            
-    def save_data(self):
-        data = {
-            'operations': self.operations,
-            'currencies': self.currencies,
-            'pending_currencies': self.pending_currencies,
-            'base_currency': self.base_currency,
-            'exchange_rates': self.exchange_rates,
-            'predefined_expense_names': self.predefined_expense_names,
-            'predefined_income_names': self.predefined_income_names
-        }
+        self.ledger.set_rate(currency, rate, defer=True)
+        self.scheduler.mark('totals', 'analytics', 'forecast', 'disk')
         
-        with open('finance_data.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    def toggle_profiling(self, enabled):
+        if enabled:
+            PROFILER.start()
+        else:
+            PROFILER.stop()
             
-    def load_data(self):
-        if os.path.exists('finance_data.json'):
-            with open('finance_data.json', 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                self.operations = data.get('operations', [])
-                self.currencies = data.get('currencies', {})
-                self.pending_currencies = data.get('pending_currencies', {})
-                self.base_currency = data.get('base_currency', 'RUB')
-                self.exchange_rates = data.get('exchange_rates', self.exchange_rates)
-                self.predefined_expense_names = data.get('predefined_expense_names', self.predefined_expense_names)
-                self.predefined_income_names = data.get('predefined_income_names', self.predefined_income_names)
+    def show_diagnostics(self):
+        DiagnosticsDialog(PROFILER, self).exec_()
+        
+    def flush_to_disk(self):
+        self.ledger.save_settings()
+        if self.data_loaded:
+            self.ledger.save_summary()
+        if self.flusher is not None:
+            self.flusher.request()
+    
+    def save_data(self):
+        self.ledger.snapshot()
+        
+    @staticmethod
+    def load_data(path):
+        """Выполняется в рабочем потоке: загружает учет и строит его итоги"""
+        ledger = Ledger(path)
+        ledger.load()
+        ledger.prepare()
+        return ledger
+    
+    def close_ledger(self):
+        """Дописывает все в текущий учет и закрывает его: сначала загрузку и
+        поставленные в очередь снапшоты, потом отложенное окном, последним — fsync"""
+        self.tasks.wait()
+        self.ledger.background = None
+        self.recurring_timer.stop()
+        self.outside_timer.stop()
+        self.scheduler.flush()
+        if self.flusher is not None:
+            self.flusher.stop()
+        self.ledger.close()
+    
+    def closeEvent(self, event):
+        # Все отложенное — до закрытия хранилища
+        self.close_ledger()
+        if self.timings.enabled:
+            print(self.scheduler.report())
+            if self.flusher is not None:
+                print(f'Сброс на диск: запрошено {self.flusher.requests}, выполнено {self.flusher.flushes}')
+        super().closeEvent(event)
+
+PROFILER.instrument(FinanceApp, FinanceApp.PROFILED)
 
 class OperationDialog(QDialog):
     def __init__(self, op_type, parent=None, is_pending=False):
@@ -547,9 +1661,9 @@ class OperationDialog(QDialog):
         
         self.name_combo = QComboBox()
         if self.op_type == 'expense':
-            self.name_combo.addItems(self.parent.predefined_expense_names)
+            self.name_combo.addItems(self.parent.ledger.predefined_expense_names)
         else:
-            self.name_combo.addItems(self.parent.predefined_income_names)
+            self.name_combo.addItems(self.parent.ledger.predefined_income_names)
         
         self.name_combo.setEditable(False)
         self.name_combo.currentTextChanged.connect(self.on_name_changed)
@@ -572,6 +1686,8 @@ class OperationDialog(QDialog):
         self.currency_input.addItems(['RUB', 'USD', 'EUR', 'KZT', 'UAH', 'BYN'])
         self.currency_input.setCurrentText('RUB')  # RUB по умолчанию
         self.currency_input.setEditable(True)
+        self.currency_input.currentTextChanged.connect(self.on_currency_changed)
+        self.on_currency_changed(self.currency_input.currentText())
         layout.addWidget(self.currency_input)
         
         layout.addWidget(QLabel('Комментарий:'))
@@ -579,6 +1695,13 @@ class OperationDialog(QDialog):
         self.comment_input.setMaximumHeight(100)
         layout.addWidget(self.comment_input)
         
+        layout.addWidget(QLabel('Повторять:'))
+        self.recurrence_input = QComboBox()
+        self.recurrence_input.addItem('Не повторять', None)
+        for unit, title in RECURRENCE_TITLES.items():
+            self.recurrence_input.addItem(title, unit)
+        layout.addWidget(self.recurrence_input)
+        
         btn_layout = QHBoxLayout()
         ok_btn = QPushButton('Добавить')
         ok_btn.clicked.connect(self.accept)
@@ -596,6 +1719,12 @@ class OperationDialog(QDialog):
         else:
             self.custom_name_input.setVisible(False)
     
+    def on_currency_changed(self, currency):
+        """Сумму можно ввести с точностью валюты: до копеек, у иены — целую"""
+        digits = self.parent.ledger.operations.digits(currency)
+        self.amount_input.setDecimals(digits)
+        self.amount_input.setMinimum(10 ** -digits)
+    
     def get_data(self):
         if self.name_combo.currentText() == 'Другое' and self.custom_name_input.text():
             name = self.custom_name_input.text()
@@ -609,8 +1738,107 @@ class OperationDialog(QDialog):
             self.comment_input.toPlainText(),
             self.is_pending
         )
+    
+    def get_recurrence(self):
+        """Период повторения ('day', 'week', 'month', 'year') или None"""
+        return self.recurrence_input.currentData()
+
+class DiagnosticsDialog(QDialog):
+    """Замеры обработчиков окна и функции, на которые ушло больше всего времени"""
+    
+    HANDLER_COLUMNS = ('Обработчик', 'Вызовов', 'Всего, мс', 'Среднее, мс', 'Максимум, мс', 'Память, КБ')
+    FUNCTION_COLUMNS = ('Функция', 'Вызовов', 'Собственное, мс', 'С вложенными, мс')
+    
+    def __init__(self, profiler, parent=None):
+        super().__init__(parent)
+        self.profiler = profiler
+        self.setWindowTitle('Диагностика')
+        self.resize(900, 650)
+        
+        layout = QVBoxLayout(self)
+        self.state_label = QLabel()
+        layout.addWidget(self.state_label)
+        self.handlers_table = self.create_table(self.HANDLER_COLUMNS)
+        layout.addWidget(self.handlers_table)
+        layout.addWidget(QLabel('Больше всего собственного времени (cProfile, поток окна):'))
+        self.functions_table = self.create_table(self.FUNCTION_COLUMNS)
+        layout.addWidget(self.functions_table)
+        
+        btn_layout = QHBoxLayout()
+        for title, handler in (('Обновить', self.refresh), ('Сбросить', self.reset),
+                               ('Сохранить профиль...', self.save_profile)):
+            button = QPushButton(title)
+            button.clicked.connect(handler)
+            btn_layout.addWidget(button)
+        btn_layout.addStretch()
+        close_btn = QPushButton('Закрыть')
+        close_btn.clicked.connect(self.accept)
+        btn_layout.addWidget(close_btn)
+        layout.addLayout(btn_layout)
+        self.refresh()
+        
+    @staticmethod
+    def create_table(columns):
+        table = QTableWidget(0, len(columns))
+        table.setHorizontalHeaderLabels(columns)
+        table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        table.verticalHeader().setVisible(False)
+        return table
+    
+    @staticmethod
+    def fill_table(table, rows):
+        table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                table.setItem(row, column, item)
+        table.resizeColumnsToContents()
+        
+    def refresh(self):
+        from finance_profile import PROFILE_ENV
+        if self.profiler.enabled:
+            state = 'Замеры включены.'
+        else:
+            state = f'Замеры выключены: включите их в настройках или переменной {PROFILE_ENV}=1.'
+        self.state_label.setText(f'{state} Время обработчика включает вложенные вызовы, '
+                                 f'память — прирост занятого за вызов.')
+        self.fill_table(self.handlers_table, [
+            (name, str(stats.calls), f'{stats.seconds * 1000:.1f}', f'{stats.average * 1000:.2f}',
+             f'{stats.max_seconds * 1000:.1f}', f'{stats.memory / 1024:+.1f}')
+            for name, stats in self.profiler.rows()])
+        self.fill_table(self.functions_table, [
+            (name, str(calls), f'{own * 1000:.1f}', f'{total * 1000:.1f}')
+            for name, calls, own, total in self.profiler.functions()])
+        
+    def reset(self):
+        self.profiler.reset()
+        self.refresh()
+        
+    def save_profile(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Сохранить профиль', 'finance.prof', 'Профиль cProfile (*.prof)')
+        if not path:
+            return
+        try:
+            self.profiler.dump(path)
+        except (OSError, ValueError) as error:
+            QMessageBox.warning(self, 'Диагностика', f'Не удалось сохранить профиль: {error}')
+            return
+        QMessageBox.information(self, 'Диагностика', f'Профиль сохранен в {path}.\n'
+                                f'Открыть его можно командой python -m pstats или в snakeviz.')
 
 def main():
+    from finance_ledgers import DEFAULT_LEDGER, create_ledger, ledger_names
+    from finance_profile import profile_setting
+    # FINANCE_PROFILE=1 — замеры с самого запуска, FINANCE_PROFILE=файл.prof — еще и профиль при выходе
+    profiling, profile_path = profile_setting()
+    if profiling:
+        PROFILER.start()
+    timings = StartupTimings()
+    timings.enabled = '--startup-timings' in sys.argv
+    timings.mark('импорт модулей')
+    
     app = QApplication(sys.argv)
     
     app.setStyle('Fusion')
@@ -631,9 +1859,19 @@ def main():
     palette.setColor(QPalette.HighlightedText, Qt.black)
     app.setPalette(palette)
     
-    window = FinanceApp()
+    # python FinanceManipultion.py --ledger Семья — сразу открыть другой учет
+    ledger_name = DEFAULT_LEDGER
+    if '--ledger' in sys.argv[:-1]:
+        ledger_name = sys.argv[sys.argv.index('--ledger') + 1]
+        if ledger_name not in ledger_names():
+            ledger_name = create_ledger(ledger_name)
+    window = FinanceApp(timings, ledger_name)
     window.show()
-    sys.exit(app.exec_())
+    code = app.exec_()
+    if profile_path:
+        PROFILER.dump(profile_path)
+        print(PROFILER.report())
+    sys.exit(code)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,321 @@
+"""Замеры Finance Manager на синтетических данных разного размера.
+
+    python finance_bench.py
+    python finance_bench.py --sizes 1000 100000 --output bench.json
+    python finance_bench.py --currencies RUB=0.6,USD=0.3,EUR=0.1 --pending 0.2 --backend sqlite
+    python finance_bench.py --compare bench_old.json bench.json
+
+Для каждого размера во временной папке генерируется finance_data.json (или
+база SQLite, или двоичный снапшот) и замеряются загрузка, сохранение, итоги в основной валюте,
+подтверждение и удаление ожидаемых операций, а также обновление таблиц окна
+(PyQt5 в режиме offscreen; без PyQt5 эти замеры пропускаются). Результат —
+JSON с версией кода и окружением, чтобы сравнивать прогоны разных коммитов.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from finance_core import BINARY_FILE, DATA_FILE, SQLITE_FILE, Ledger
+from finance_forecast import project
+
+SIZES = (1000, 100000, 1000000)
+CURRENCY_MIX = {'RUB': 0.6, 'USD': 0.25, 'EUR': 0.1, 'KZT': 0.05}
+PENDING_RATIO = 0.1
+# Сколько ожидаемых операций подтверждается и удаляется в замере
+PENDING_ACTIONS = 100
+MIN_COMPARED = 0.001
+NAMES = {
+    'expense': ['Ашан', 'Аптека', 'Вайлдберриз', 'Магнит', 'Пятерочка', 'Такси', 'Кафе', 'Другое'],
+    'income': ['Зарплата', 'Фриланс', 'Инвестиции', 'Подарок', 'Возврат долга', 'Другое'],
+}
+COMMENTS = ['', '', '', 'обед', 'подарок', 'такси домой', 'по карте']
+
+
+def parse_mix(text):
+    """'RUB=0.6,USD=0.4' -> {'RUB': 0.6, 'USD': 0.4}"""
+    mix = {}
+    for item in text.split(','):
+        currency, _, share = item.partition('=')
+        try:
+            mix[currency.strip().upper()] = float(share)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'ожидалось ВАЛЮТА=доля, получено {item!r}') from None
+    if not mix or sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError('доли валют должны быть положительными')
+    return mix
+
+
+def generate_operations(count, currency_mix=CURRENCY_MIX, pending_ratio=PENDING_RATIO, seed=1):
+    """Синтетические операции за последние три года, с id по порядку"""
+    rng = random.Random(seed)
+    currencies = list(currency_mix)
+    weights = list(currency_mix.values())
+    start = datetime(2022, 1, 1)
+    span = int((datetime(2025, 1, 1) - start).total_seconds())
+    moments = sorted(rng.randrange(span) for _ in range(count))
+    operations = []
+    for op_id, seconds in enumerate(moments, 1):
+        pending = rng.random() < pending_ratio
+        op_type = 'income' if pending or rng.random() < 0.3 else 'expense'
+        operations.append({
+            'id': op_id,
+            'type': op_type,
+            'name': rng.choice(NAMES[op_type]),
+            'amount': round(rng.lognormvariate(7, 1.2), 2),
+            'currency': rng.choices(currencies, weights)[0],
+            'comment': rng.choice(COMMENTS),
+            'datetime': (start + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S'),
+            'is_pending': pending
+        })
+    return operations
+
+
+def write_ledger(path, operations):
+    """Файл данных с готовыми операциями, как после долгой работы приложения"""
+    ledger = Ledger(path)
+    ledger.load()
+    ledger.operations.extend(operations)
+    ledger.balances = ledger.operations.balances()
+    ledger.snapshot()
+    ledger.close()
+
+
+class Timer:
+    """Замеры по именам: повторяет функцию repeat раз и хранит все времена"""
+
+    def __init__(self):
+        self.results = {}
+
+    def measure(self, name, function, repeat=1, per=1):
+        """per — на сколько действий делить время (среднее на одну операцию)"""
+        runs = []
+        result = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = function()
+            runs.append((time.perf_counter() - started) / per)
+        self.results[name] = {'seconds': statistics.median(runs), 'min': min(runs), 'runs': len(runs)}
+        return result
+
+    def skip(self, name, reason):
+        self.results[name] = {'skipped': reason}
+
+
+def bench_ledger(timer, path, repeat):
+    """Загрузка, сохранение, итоги и действия с ожидаемыми операциями без окна"""
+    def load():
+        ledger = Ledger(path)
+        ledger.load()
+        return ledger
+
+    ledger = timer.measure('load_data', load, repeat=1)
+    timer.measure('save_data', ledger.snapshot, repeat=1)
+    timer.measure('calculate_total_in_base_currency',
+                  lambda: (ledger.total(ledger.balances.actual), ledger.total(ledger.balances.pending)), repeat)
+    timer.measure('totals_by_month', lambda: ledger.totals('month'), repeat)
+    timer.measure('totals_by_month_historical', lambda: ledger.totals('month', historical=True), repeat)
+    timer.measure('balances_rebuild', ledger.operations.balances, repeat)
+    timer.measure('rollups_rebuild', lambda: setattr(ledger, 'rollups', None) or ledger.get_rollups(), repeat)
+    timer.measure('forecast_24_months', lambda: project(ledger, 24), repeat)
+    # Повторный поиск отдается из кэша, поэтому замеряется первый
+    timer.measure('search', lambda: ledger.operations.count(False, text='так', min_amount=100))
+
+    pending = list(ledger.operations.ids(True)[:2 * PENDING_ACTIONS])
+    confirm, delete = pending[:PENDING_ACTIONS], pending[PENDING_ACTIONS:]
+    if confirm:
+        timer.measure('confirm_pending', lambda: [ledger.confirm(op_id) for op_id in confirm], per=len(confirm))
+    if delete:
+        timer.measure('delete_pending', lambda: [ledger.delete(op_id) for op_id in delete], per=len(delete))
+    timer.measure('sync', ledger.sync)
+    ledger.close()
+
+
+def bench_window(timer, app, repeat):
+    """Окно в offscreen-режиме: запуск с загрузкой данных и обновление таблиц"""
+    from FinanceManipultion import FinanceApp
+
+    def start():
+        window = FinanceApp()
+        window.show()
+        app.processEvents()
+        window.finish_startup()
+        return window
+
+    window = timer.measure('window_startup', start)
+    for index, name in ((1, 'build_operations_tab'), (2, 'build_pending_tab'), (3, 'build_analytics_tab')):
+        timer.measure(name, lambda: (window.tab_widget.setCurrentIndex(index), app.processEvents()))
+    timer.measure('refresh_operations_table', lambda: (window.update_operations_table(), app.processEvents()), repeat)
+    timer.measure('refresh_pending_table', lambda: (window.update_pending_table(), app.processEvents()), repeat)
+    timer.measure('refresh_totals', lambda: (window.update_amounts_display(), app.processEvents()), repeat)
+    timer.measure('refresh_analytics', lambda: (window.update_analytics(), app.processEvents()), repeat)
+
+    def confirm_first():
+        window.confirm_pending_income(0)
+        app.processEvents()
+
+    def delete_first():
+        window.pending_table.setCurrentIndex(window.pending_model.index(0, 1))
+        window.delete_selected_pending()
+        app.processEvents()
+
+    if window.pending_model.rowCount():
+        timer.measure('window_confirm_pending', confirm_first)
+    if window.pending_model.rowCount():
+        timer.measure('window_delete_pending', delete_first)
+    timer.measure('window_search', lambda: (window.operations_filter.search.setText('так'), app.processEvents()))
+    # Снапшот из окна: в его потоке только копия данных, файл пишется в рабочем потоке
+    timer.measure('window_save_data', window.save_data)
+    timer.measure('window_close', window.close)
+
+
+def max_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты
+    return round(rss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    app = None
+    gui_error = None
+    if not args.no_gui:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        try:
+            from PyQt5.QtWidgets import QApplication
+            app = QApplication.instance() or QApplication([])
+        except ImportError as error:
+            gui_error = f'PyQt5 недоступен: {error}'
+
+    report = {
+        'commit': git_commit(),
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'backend': args.backend, 'currencies': args.currencies, 'pending': args.pending,
+                   'seed': args.seed, 'repeat': args.repeat},
+        'results': []
+    }
+    cwd = os.getcwd()
+    for size in args.sizes:
+        folder = tempfile.mkdtemp(prefix='finance_bench_')
+        try:
+            os.chdir(folder)
+            timer = Timer()
+            operations = timer.measure('generate', lambda: generate_operations(size, args.currencies,
+                                                                                args.pending, args.seed))
+            # Список передается аргументом по умолчанию: после записи он удаляется,
+            # чтобы не занимать память в замерах загрузки
+            timer.measure('write_json', lambda operations=operations: write_ledger(DATA_FILE, operations))
+            del operations
+            path = DATA_FILE
+            if args.backend == 'sqlite':
+                from finance_sqlite import migrate_json
+                timer.measure('migrate_sqlite', lambda: migrate_json(DATA_FILE, SQLITE_FILE))
+                path = SQLITE_FILE
+            elif args.backend == 'binary':
+                from finance_binary import convert_snapshot
+                timer.measure('convert_binary', lambda: convert_snapshot(DATA_FILE, BINARY_FILE))
+                path = BINARY_FILE
+            data_size = os.path.getsize(path)
+            bench_ledger(timer, path, args.repeat)
+            if app is not None:
+                bench_window(timer, app, args.repeat)
+            else:
+                timer.skip('window', gui_error or 'отключено --no-gui')
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(folder, ignore_errors=True)
+        report['results'].append({'size': size, 'file_bytes': data_size, 'max_rss_mb': max_rss_mb(),
+                                  'metrics': timer.results})
+        print_size(size, timer.results)
+    return report
+
+
+def print_size(size, metrics):
+    print(f'{size} операций:', file=sys.stderr)
+    for name, result in metrics.items():
+        value = f'{result["seconds"] * 1000:10.2f} мс' if 'seconds' in result else f'  пропущено: {result["skipped"]}'
+        print(f'  {name:<34}{value}', file=sys.stderr)
+
+
+def compare(base_path, new_path, threshold):
+    """Печатает отношение времен нового прогона к старому; 1, если что-то замедлилось сильнее threshold"""
+    with open(base_path, encoding='utf-8') as f:
+        base = {result['size']: result['metrics'] for result in json.load(f)['results']}
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)['results']
+    slower = 0
+    for result in new:
+        old_metrics = base.get(result['size'], {})
+        print(f'{result["size"]} операций:')
+        for name, metric in result['metrics'].items():
+            if 'seconds' not in metric:
+                continue
+            old_seconds = old_metrics.get(name, {}).get('seconds')
+            # Замера не было в старом отчете (добавлен позже или пропущен) — сравнивать не с чем
+            if not old_seconds:
+                print(f'  {name:<34}{"новый":>10}    -> {metric["seconds"] * 1000:10.2f} мс')
+                continue
+            # Доли миллисекунды — шум, а не регрессия
+            if max(old_seconds, metric['seconds']) < MIN_COMPARED:
+                continue
+            ratio = metric['seconds'] / old_seconds
+            mark = '  медленнее' if ratio > threshold else ''
+            slower += bool(mark)
+            print(f'  {name:<34}{old_seconds * 1000:10.2f} -> {metric["seconds"] * 1000:10.2f} мс  x{ratio:.2f}{mark}')
+    return 1 if slower else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Замеры Finance Manager на синтетических данных')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='число операций в прогонах')
+    parser.add_argument('--currencies', type=parse_mix, default=dict(CURRENCY_MIX),
+                        help='доли валют, например RUB=0.6,USD=0.3,EUR=0.1')
+    parser.add_argument('--pending', type=float, default=PENDING_RATIO, help='доля ожидаемых операций')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5, help='повторов для быстрых замеров (берется медиана)')
+    parser.add_argument('--backend', choices=['json', 'sqlite', 'binary'], default='json')
+    parser.add_argument('--no-gui', action='store_true', help='не замерять окно')
+    parser.add_argument('--output', help='файл для JSON (по умолчанию — stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('СТАРЫЙ', 'НОВЫЙ'), help='сравнить два JSON-отчета')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='для --compare: во сколько раз медленнее считается регрессией')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.compare:
+        return compare(*args.compare, args.threshold)
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
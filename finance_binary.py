@@ -0,0 +1,123 @@
+"""Двоичный снапшот finance_data.bin вместо JSON для очень большой истории.
+
+Файл — заголовок и колонки OperationStore как есть:
+
+    FMBIN001 | длина заголовка (8 байт) | заголовок JSON | колонки
+
+В заголовке настройки и балансы (то же, что в JSON-снапшоте, кроме операций),
+таблицы строк (типы, названия, валюты, комментарии — каждая строка один раз)
+и для каждой колонки — typecode, смещение и длина. Колонки — массивы
+фиксированной ширины, выровненные по 8 байт: id, суммы (целые в минимальных
+единицах валют, точность валют — в таблице minor_units; в снапшотах прежних
+версий — float, они переводятся при загрузке), секунды даты, коды строк, биты
+ожидаемых операций и готовые индексы по дате и сумме. При
+загрузке файл отображается в память (mmap), и колонки копируются в хранилище
+целыми кусками, без разбора операций; словари операций появляются только
+тогда, когда их читает таблица окна или итоги (OperationView).
+Изменения, как и у JSON, дописываются в журнал.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from finance_core import BINARY_EXTENSIONS, Ledger, OperationJournal, OperationStore, open_storage
+
+MAGIC = b'FMBIN001'
+ALIGN = 8
+
+
+class BinaryJournal(OperationJournal):
+    """OperationJournal, у которого снапшот — двоичный файл (см. описание модуля)"""
+
+    def read_snapshot(self):
+        if not os.path.exists(self.data_path) or not os.path.getsize(self.data_path):
+            return {'operations': OperationStore()}
+        with open(self.data_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                header = read_header(view)
+                views = {name: view[offset:offset + size] for name, (typecode, offset, size)
+                         in header['columns'].items()}
+                try:
+                    store = OperationStore.from_columns(
+                        header['tables'],
+                        {name: (header['columns'][name][0], views[name]) for name in views},
+                        byteswap=header['byteorder'] != sys.byteorder)
+                finally:
+                    for column in views.values():
+                        column.release()
+            finally:
+                view.release()
+        data = header['data']
+        data['operations'] = store
+        return data
+
+    def write_snapshot(self, data, path):
+        tables, columns = data['operations'].dump_columns()
+        offset = 0
+        layout = {}
+        for name, column in columns.items():
+            size = len(column) * column.itemsize
+            layout[name] = (column.typecode, offset, size)
+            offset += padded(size)
+        header = {
+            'byteorder': sys.byteorder,
+            'itemsizes': {column.typecode: column.itemsize for column in columns.values()},
+            'tables': tables,
+            'columns': layout,
+            'data': {key: value for key, value in data.items() if key != 'operations'}
+        }
+        header = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        start = padded(len(MAGIC) + 8 + len(header))
+        with open(path, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            f.write(bytes(start - f.tell()))
+            for name, column in columns.items():
+                column.tofile(f)
+                f.write(bytes(padded(layout[name][2]) - layout[name][2]))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def padded(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def read_header(view):
+    """Заголовок со смещениями колонок, отсчитанными от начала файла"""
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise ValueError('это не двоичный снапшот Finance Manager')
+    (length,) = struct.unpack('<Q', view[len(MAGIC):len(MAGIC) + 8])
+    header = json.loads(bytes(view[len(MAGIC) + 8:len(MAGIC) + 8 + length]).decode('utf-8'))
+    for typecode, itemsize in header['itemsizes'].items():
+        if array(typecode).itemsize != itemsize:
+            raise ValueError(f'снапшот записан на платформе с другим размером {typecode!r}')
+    start = padded(len(MAGIC) + 8 + length)
+    for name, (typecode, offset, size) in header['columns'].items():
+        if start + offset + size > len(view):
+            raise ValueError(f'снапшот обрезан: нет колонки {name}')
+        header['columns'][name] = (typecode, start + offset, size)
+    return header
+
+
+def convert_snapshot(source_path, target_path):
+    """Переписывает данные (снапшот вместе с журналом) из JSON в двоичный снапшот
+    или обратно; формат определяется по расширению. Возвращает число операций."""
+    kinds = {os.path.splitext(path)[1].lower() for path in (source_path, target_path)}
+    if len(kinds) != 2 or not kinds - {'.json'} <= set(BINARY_EXTENSIONS) or '.json' not in kinds:
+        raise ValueError('один из файлов должен быть .bin, другой — .json')
+    if os.path.exists(target_path):
+        raise ValueError(f'{target_path} уже существует')
+    source = Ledger(source_path)
+    source.load()
+    target = open_storage(target_path)
+    try:
+        target.snapshot(source.snapshot_data())
+        count = len(source.operations)
+    finally:
+        source.close()
+        target.close()
+    return count
@@ -0,0 +1,326 @@
+"""Командная строка Finance Manager: импорт, итоги и выгрузка без запуска окна.
+
+    python finance_cli.py totals [--by month] [--currency USD] [--pending | --actual] [--historical]
+    python finance_cli.py rates курсы.csv
+    python finance_cli.py forecast [--months 12] [--paths 10000] [--volatility 2]
+    python finance_cli.py import operations.json
+    python finance_cli.py import выписка.csv --preset tinkoff --skip-invalid
+    python finance_cli.py export operations.csv
+    python finance_cli.py export operations.xlsx --from 2024-01-01 --to 2024-12-31 --type expense --progress
+    python finance_cli.py report months.xlsx [--currency USD] [--actual]
+    python finance_cli.py migrate
+    python finance_cli.py convert finance_data.json finance_data.bin
+    python finance_cli.py --ledger Семья totals
+    python finance_cli.py ledgers [--create Работа] [--currency USD]
+
+Работает с теми же данными, что и приложение (finance_data.sqlite, если
+база создана командой migrate, finance_data.bin после convert, иначе
+finance_data.json с журналом);
+другой учет — через --ledger, другой файл данных — через --data. PyQt5 не импортируется.
+"""
+import argparse
+import sqlite3
+import sys
+
+from finance_core import DATA_FILE, OPERATION_FIELDS, SQLITE_FILE, Ledger, to_normal_readly_type
+
+# Модули команд импортируются в самих командах: totals не должен ждать
+# выгрузку в XLSX (xml.sax тянет urllib) или импорт выписок
+
+
+def build_mapping(args):
+    """Готовое сопоставление (--preset) или своё из --map поле=Колонка"""
+    from finance_import import PRESETS, ColumnMapping
+    if not args.map:
+        if args.preset and args.preset not in PRESETS:
+            raise ValueError(f'нет формата «{args.preset}», есть: {", ".join(sorted(PRESETS))}')
+        return PRESETS.get(args.preset)
+    columns = {}
+    for item in args.map:
+        field, _, column = item.partition('=')
+        if field not in OPERATION_FIELDS or not column:
+            raise ValueError(f'--map ждёт поле=Колонка, поле из: {", ".join(OPERATION_FIELDS)}')
+        columns[field] = column
+    return ColumnMapping('custom', columns, date_format=args.date_format, signed_amount=args.signed,
+                         delimiter=args.delimiter, encoding=args.encoding)
+
+
+def print_errors(stats):
+    for number, error in stats.errors:
+        print(f'строка {number}: {error}', file=sys.stderr)
+    if stats.invalid > len(stats.errors):
+        print(f'... и ещё {stats.invalid - len(stats.errors)}', file=sys.stderr)
+
+
+def cmd_import(ledger, args):
+    from finance_import import BATCH_SIZE, import_file, validate_file
+    try:
+        mapping = build_mapping(args)
+        if not args.skip_invalid:
+            # Отдельный проход без записи: файл может не помещаться в память
+            stats = validate_file(args.file, mapping)
+            if stats.invalid:
+                print_errors(stats)
+                print(f'Найдено ошибок: {stats.invalid}, ничего не импортировано '
+                      '(--skip-invalid пропустит их)', file=sys.stderr)
+                return 1
+        progress = None
+        if args.progress:
+            progress = lambda stats: print(f'\r{stats.imported} операций, {stats.rows_per_second:.0f} строк/с',
+                                           end='', file=sys.stderr, flush=True)
+        stats = import_file(ledger, args.file, mapping, args.batch_size or BATCH_SIZE, progress)
+    except (OSError, ValueError) as error:
+        print(f'Ошибка импорта: {error}', file=sys.stderr)
+        return 1
+    if args.progress:
+        print(file=sys.stderr)
+    print_errors(stats)
+    print(stats.summary())
+    return 0
+
+
+def cmd_totals(ledger, args):
+    currency = args.currency or ledger.base_currency
+    pending = True if args.pending else False if args.actual else None
+
+    if args.by:
+        totals, missing = ledger.totals(args.by, pending, currency, args.historical or args.interpolate,
+                                        args.interpolate)
+        for group, amount in totals.items():
+            print(f'{group}\t{to_normal_readly_type(round(amount, 2))} {currency}')
+    else:
+        balances = []
+        if pending is not True:
+            balances.append(('Фактическая сумма', ledger.balances.actual))
+        if pending is not False:
+            balances.append(('Ожидаемые доходы', ledger.balances.pending))
+        missing = []
+        for title, values in balances:
+            total, not_converted = ledger.total(values, currency)
+            missing += not_converted
+            print(f'{title}: {to_normal_readly_type(round(total, 2))} {currency}')
+
+    if missing:
+        print(f'Нет курса для {", ".join(sorted(set(missing)))} — эти суммы не учтены', file=sys.stderr)
+    return 0
+
+
+def cmd_rates(ledger, args):
+    from finance_import import import_rates
+    try:
+        count = import_rates(ledger, args.file)
+    except (OSError, ValueError) as error:
+        print(f'Ошибка импорта курсов: {error}', file=sys.stderr)
+        return 1
+    print(f'Добавлено курсов: {count}')
+    return 0
+
+
+def cmd_forecast(ledger, args):
+    from finance_forecast import PATHS, PERCENTILES, project
+    paths = args.paths or PATHS
+    forecast = project(ledger, args.months, paths, volatility=args.volatility)
+    print('месяц\t' + '\t'.join(f'{p}%' for p in PERCENTILES) + f'\t{forecast.currency}')
+    for i, month in enumerate(forecast.months):
+        print(month + '\t' + '\t'.join(to_normal_readly_type(round(forecast.percentiles[p][i]))
+                                        for p in PERCENTILES))
+    if forecast.missing:
+        print(f'Нет курса для {", ".join(forecast.missing)} — эти суммы не учтены', file=sys.stderr)
+    print(f'{paths} путей за {forecast.seconds * 1000:.0f} мс', file=sys.stderr)
+    return 0
+
+
+def export_filters(args):
+    """Фильтры выгрузки из аргументов; --to с одной датой включает весь день"""
+    end = args.end
+    if end and len(end) == 10:
+        end += ' 23:59:59'
+    return {
+        'pending': True if args.pending else False if args.actual else None,
+        'op_type': args.type,
+        'currency': args.currency,
+        'start': args.start,
+        'end': end,
+        'text': args.search
+    }
+
+
+def cmd_export(ledger, args):
+    from finance_export import CHUNK_SIZE, export_operations
+    progress = None
+    if args.progress:
+        progress = lambda stats: print(f'\r{stats.operations} операций, {stats.rows_per_second:.0f} строк/с',
+                                       end='', file=sys.stderr, flush=True)
+    try:
+        stats = export_operations(ledger, args.file, args.chunk_size or CHUNK_SIZE, progress,
+                                  **export_filters(args))
+    except (OSError, ValueError) as error:
+        print(f'Ошибка выгрузки: {error}', file=sys.stderr)
+        return 1
+    if args.progress:
+        print(file=sys.stderr)
+    print(stats.summary())
+    return 0
+
+
+def cmd_report(ledger, args):
+    from finance_export import export_report
+    try:
+        stats, missing = export_report(ledger, args.file, **export_filters(args))
+    except (OSError, ValueError) as error:
+        print(f'Ошибка выгрузки: {error}', file=sys.stderr)
+        return 1
+    print(stats.summary())
+    if missing:
+        print(f'Нет курса для {", ".join(missing)} — эти суммы не учтены в строках «все в ...»', file=sys.stderr)
+    return 0
+
+
+def cmd_migrate(args):
+    from finance_sqlite import migrate_json
+    source = args.data or DATA_FILE
+    try:
+        count = migrate_json(source, args.target)
+    except (OSError, ValueError, sqlite3.Error) as error:
+        print(f'Ошибка переноса: {error}', file=sys.stderr)
+        return 1
+    print(f'Перенесено операций: {count} из {source} в {args.target}')
+    return 0
+
+
+def cmd_ledgers(args):
+    from finance_ledgers import consolidated, create_ledger
+    if args.create:
+        try:
+            print(f'Создан учет «{create_ledger(args.create)}»')
+        except (OSError, ValueError) as error:
+            print(f'Ошибка: {error}', file=sys.stderr)
+            return 1
+    rows, actual, pending = consolidated(args.currency)
+    for name, ledger_actual, ledger_pending, missing in rows:
+        line = (f'{name}\t{to_normal_readly_type(round(ledger_actual, 2))}'
+                f'\t{to_normal_readly_type(round(ledger_pending, 2))} {args.currency}')
+        if missing:
+            line += f'\t(без курса: {", ".join(missing)})'
+        print(line)
+    print(f'Все учеты\t{to_normal_readly_type(round(actual, 2))}\t{to_normal_readly_type(round(pending, 2))} '
+          f'{args.currency}')
+    return 0
+
+
+def cmd_convert(args):
+    from finance_binary import convert_snapshot
+    try:
+        count = convert_snapshot(args.source, args.target)
+    except (OSError, ValueError) as error:
+        print(f'Ошибка преобразования: {error}', file=sys.stderr)
+        return 1
+    print(f'Перенесено операций: {count} из {args.source} в {args.target}')
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Finance Manager без графического интерфейса')
+    parser.add_argument('--data', help='файл данных: .json или .sqlite '
+                                       '(по умолчанию finance_data.sqlite, если есть, иначе finance_data.json)')
+    parser.add_argument('--ledger', help='название учета (см. команду ledgers); по умолчанию основной')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help='добавить операции из CSV, JSON или JSON Lines')
+    import_parser.add_argument('file')
+    import_parser.add_argument('--skip-invalid', action='store_true', help='пропускать строки с ошибками')
+    import_parser.add_argument('--preset', help='формат выписки: finance, tinkoff '
+                                                '(по умолчанию определяется по заголовку CSV)')
+    import_parser.add_argument('--map', action='append', metavar='ПОЛЕ=КОЛОНКА',
+                               help='своё сопоставление колонок, можно повторять')
+    import_parser.add_argument('--date-format', help='формат даты для --map, например %%d.%%m.%%Y')
+    import_parser.add_argument('--signed', action='store_true',
+                               help='для --map: тип по знаку суммы (минус — расход)')
+    import_parser.add_argument('--delimiter', help='разделитель CSV для --map')
+    import_parser.add_argument('--encoding', help='кодировка CSV для --map')
+    import_parser.add_argument('--batch-size', type=int, help='операций в одной пачке (по умолчанию 5000)')
+    import_parser.add_argument('--progress', action='store_true', help='показывать ход импорта')
+    import_parser.set_defaults(handler=cmd_import)
+
+    totals_parser = commands.add_parser('totals', help='итоги в основной валюте')
+    totals_parser.add_argument('--by', choices=['currency', 'name', 'type', 'month', 'day'],
+                               help='разбивка по группам')
+    totals_parser.add_argument('--currency', help='валюта итогов (по умолчанию основная)')
+    status = totals_parser.add_mutually_exclusive_group()
+    status.add_argument('--pending', action='store_true', help='только ожидаемые')
+    status.add_argument('--actual', action='store_true', help='только фактические')
+    totals_parser.add_argument('--historical', action='store_true',
+                               help='для --by: по курсам на дату каждой операции, а не по текущим')
+    totals_parser.add_argument('--interpolate', action='store_true',
+                               help='как --historical, но курс между датами меняется линейно')
+    totals_parser.set_defaults(handler=cmd_totals)
+
+    rates_parser = commands.add_parser('rates', help='добавить курсы по датам из CSV (дата, валюта, курс)')
+    rates_parser.add_argument('file')
+    rates_parser.set_defaults(handler=cmd_rates)
+
+    forecast_parser = commands.add_parser('forecast', help='прогноз баланса по месяцам (процентили сценариев)')
+    forecast_parser.add_argument('--months', type=int, default=12, help='на сколько месяцев вперед')
+    forecast_parser.add_argument('--paths', type=int, help='сколько случайных сценариев (по умолчанию 10000)')
+    forecast_parser.add_argument('--volatility', type=float, default=1.0,
+                                 help='множитель разброса расходов, например 2 — вдвое больше')
+    forecast_parser.set_defaults(handler=cmd_forecast)
+
+    export_parser = commands.add_parser('export', help='выгрузить операции в CSV, XLSX, JSON или JSON Lines '
+                                                       '(по расширению файла)')
+    export_parser.add_argument('file')
+    export_parser.add_argument('--chunk-size', type=int, help='операций в одной пачке (по умолчанию 10000)')
+    export_parser.add_argument('--progress', action='store_true', help='показывать ход выгрузки')
+    export_parser.set_defaults(handler=cmd_export)
+
+    report_parser = commands.add_parser('report', help='итоги по месяцам и валютам в CSV или XLSX')
+    report_parser.add_argument('file')
+    report_parser.set_defaults(handler=cmd_report)
+
+    for subparser in (export_parser, report_parser):
+        subparser.add_argument('--from', dest='start', metavar='ДАТА', help='с даты (ГГГГ-ММ-ДД)')
+        subparser.add_argument('--to', dest='end', metavar='ДАТА', help='по дату включительно')
+        subparser.add_argument('--type', choices=['income', 'expense'], help='только доходы или расходы')
+        subparser.add_argument('--currency', help='только в этой валюте')
+        subparser.add_argument('--search', help='слова названия или комментария')
+        status = subparser.add_mutually_exclusive_group()
+        status.add_argument('--pending', action='store_true', help='только ожидаемые')
+        status.add_argument('--actual', action='store_true', help='только фактические')
+
+    migrate_parser = commands.add_parser('migrate', help='перенести finance_data.json в базу SQLite')
+    migrate_parser.add_argument('target', nargs='?', default=SQLITE_FILE,
+                                help='файл базы (по умолчанию finance_data.sqlite)')
+    migrate_parser.set_defaults(handler=cmd_migrate)
+
+    convert_parser = commands.add_parser('convert', help='переписать данные из JSON в двоичный снапшот .bin '
+                                                         'или обратно')
+    convert_parser.add_argument('source', help='откуда: .json или .bin (вместе с журналом)')
+    convert_parser.add_argument('target', help='куда: файл с другим расширением, которого еще нет')
+    convert_parser.set_defaults(handler=cmd_convert)
+
+    ledgers_parser = commands.add_parser('ledgers', help='все учеты с суммами (фактической и ожидаемой) '
+                                                         'по кэшам итогов, без загрузки операций')
+    ledgers_parser.add_argument('--create', metavar='НАЗВАНИЕ', help='сначала создать новый учет')
+    ledgers_parser.add_argument('--currency', default='RUB', help='валюта сводки (по умолчанию RUB)')
+    ledgers_parser.set_defaults(handler=cmd_ledgers)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from finance_ledgers import ledger_names, ledger_path
+    if args.handler in (cmd_migrate, cmd_convert, cmd_ledgers):
+        return args.handler(args)
+    if args.ledger and args.ledger not in ledger_names():
+        print(f'Нет учета «{args.ledger}» (создать: ledgers --create)', file=sys.stderr)
+        return 1
+    ledger = Ledger(args.data or (ledger_path(args.ledger) if args.ledger else None))
+    ledger.load()
+    try:
+        return args.handler(ledger, args)
+    finally:
+        ledger.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2757 @@
+"""Учет Finance Manager без GUI: хранилище операций, балансы, курсы и хранение на диске.
+
+Модуль не зависит от PyQt5 и используется как окном приложения
+(FinanceManipultion.py), так и командной строкой (finance_cli.py).
+"""
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import ROUND_HALF_EVEN, Decimal
+import calendar
+import copy
+import heapq
+import json
+import os
+import re
+import shutil
+import threading
+
+DATA_FILE = 'finance_data.json'
+JOURNAL_FILE = 'finance_data.journal'
+SUMMARY_FILE = 'finance_summary.json'
+SQLITE_FILE = 'finance_data.sqlite'
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+BINARY_FILE = 'finance_data.bin'
+BINARY_EXTENSIONS = ('.bin',)
+SEARCH_WORD = re.compile(r'[^\W_]+')
+# Настройки учета: пишутся записями 'set' в журнал и целиком в снапшот
+SETTINGS = ('base_currency', 'exchange_rates', 'rate_history', 'recurring', 'budgets', 'predefined_expense_names',
+            'predefined_income_names')
+# С этой даты действует курс, который был до первого изменения в истории
+RATES_START = '1970-01-01'
+# Знаков после запятой у сумм валюты (ISO 4217), у остальных — DEFAULT_MINOR_UNITS
+MINOR_UNITS = {'JPY': 0, 'KRW': 0, 'VND': 0, 'CLP': 0, 'ISK': 0,
+               'BHD': 3, 'KWD': 3, 'OMR': 3, 'JOD': 3, 'TND': 3, 'IQD': 3, 'LYD': 3}
+DEFAULT_MINOR_UNITS = 2
+MAX_MINOR_UNITS = 8
+
+def to_normal_readly_type(number, digits=2):
+    """Сумма с пробелами между тысячами; дробная часть — только если она не нулевая
+    после округления до digits знаков (1.999 -> '2', 1234.5 -> '1 234.50')"""
+    text = f'{abs(number):,.{digits}f}'.replace(',', ' ')
+    integer, _, fraction = text.partition('.')
+    sign = '-' if number < 0 and text.strip('0. ') else ''
+    if fraction.strip('0'):
+        return f'{sign}{integer}.{fraction}'
+    return f'{sign}{integer}'
+
+
+def minor_units(currency):
+    """Сколько знаков после запятой у сумм валюты по умолчанию"""
+    return MINOR_UNITS.get(currency, DEFAULT_MINOR_UNITS)
+
+
+def minor_digits(amounts, digits=DEFAULT_MINOR_UNITS):
+    """Сколько знаков нужно суммам (число или массив), чтобы записать их целыми
+    без потерь: не меньше digits и не больше MAX_MINOR_UNITS. Погрешность float
+    (0.1 + 0.2 = 0.30000000000000004) лишним знаком не считается."""
+    import numpy as np
+    amounts = np.abs(np.asarray(amounts, dtype=np.float64))
+    while digits < MAX_MINOR_UNITS:
+        scaled = amounts * 10.0 ** digits
+        if (np.abs(scaled - np.rint(scaled)) <= scaled * 1e-12 + 1e-6).all():
+            break
+        digits += 1
+    return digits
+
+
+def exact_units(amount, digits=MAX_MINOR_UNITS):
+    """Сумма целым числом единиц 10**-digits. float переводится через свою
+    кратчайшую десятичную запись (repr), поэтому и у больших сумм не появляется
+    хвост двоичной дроби; середина округляется к четному"""
+    if isinstance(amount, int):
+        return amount * 10 ** digits
+    return int(Decimal(repr(float(amount))).scaleb(digits).to_integral_value(ROUND_HALF_EVEN))
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def parse_timestamp(value):
+    """'%Y-%m-%d %H:%M:%S' -> секунды от EPOCH (без учета часового пояса)"""
+    return int((datetime.fromisoformat(value) - EPOCH).total_seconds())
+
+
+def format_timestamp(seconds):
+    return (EPOCH + timedelta(seconds=seconds)).isoformat(' ')
+
+
+def format_timestamps(seconds):
+    """format_timestamp для целого массива секунд numpy — разом, без datetime на каждую"""
+    import numpy as np
+    return [text.replace('T', ' ') for text in np.datetime_as_string(seconds.astype('datetime64[s]')).tolist()]
+
+
+class Categories:
+    """Таблица строк: каждое значение хранится один раз, в колонках — его код"""
+    
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+        
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+    
+    def encode(self, values):
+        """Коды для целой колонки значений за один проход"""
+        codes = self.codes
+        setdefault = codes.setdefault
+        result = [setdefault(value, len(codes)) for value in values]
+        self.values = list(codes)
+        return result
+    
+    def __len__(self):
+        return len(self.values)
+
+
+def search_words(text):
+    """Слова поискового запроса в нижнем регистре; каждое ищется как начало слова"""
+    return [word.lower() for word in SEARCH_WORD.findall(text or '')]
+
+
+class TokenIndex:
+    """Инвертированный индекс слов по таблице строк (названия или комментарии).
+    
+    Слово указывает на коды строк, в которых оно встречается, поэтому индекс
+    растет с числом разных строк, а не операций. Новые строки дописываются в
+    индекс при следующем поиске; таблица строк только растет, так что
+    перестраивать уже разобранное не нужно.
+    """
+    
+    def __init__(self, categories):
+        self.categories = categories
+        self.postings = {}
+        self.tokens = []
+        self.indexed = 0
+        
+    def update(self):
+        values = self.categories.values
+        if self.indexed == len(values):
+            return
+        new_tokens = []
+        for code in range(self.indexed, len(values)):
+            for token in set(search_words(values[code])):
+                codes = self.postings.get(token)
+                if codes is None:
+                    codes = self.postings[token] = array('i')
+                    new_tokens.append(token)
+                codes.append(code)
+        self.indexed = len(values)
+        if len(new_tokens) > 64:
+            self.tokens = sorted(self.postings)
+        else:
+            for token in new_tokens:
+                insort(self.tokens, token)
+                
+    def matches(self, prefix):
+        """Маска по кодам строк: True, если в строке есть слово, начинающееся с prefix"""
+        import numpy as np
+        self.update()
+        mask = np.zeros(len(self.categories.values), dtype=bool)
+        lo = bisect_left(self.tokens, prefix)
+        hi = bisect_left(self.tokens, prefix + '\uffff', lo)
+        for token in self.tokens[lo:hi]:
+            mask[np.frombuffer(self.postings[token], dtype=np.int32)] = True
+        return mask
+
+
+class SortedIds:
+    """Отсортированный массив id (8 байт на операцию вместо объекта int в set)"""
+    
+    def __init__(self):
+        self.ids = array('q')
+        
+    def add(self, op_id):
+        if not self.ids or self.ids[-1] < op_id:
+            self.ids.append(op_id)
+            return len(self.ids) - 1
+        position = bisect_left(self.ids, op_id)
+        self.ids.insert(position, op_id)
+        return position
+    
+    def remove(self, op_id):
+        position = bisect_left(self.ids, op_id)
+        del self.ids[position]
+        return position
+    
+    def index(self, op_id):
+        return bisect_left(self.ids, op_id)
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __iter__(self):
+        return iter(self.ids)
+    
+    def __contains__(self, op_id):
+        position = bisect_left(self.ids, op_id)
+        return position < len(self.ids) and self.ids[position] == op_id
+
+
+class SortedIndex:
+    """Ключи по возрастанию (дата, сумма) и параллельный массив id для поиска по диапазону"""
+    
+    def __init__(self, typecode):
+        self.keys = array(typecode)
+        self.ids = array('q')
+        
+    def add(self, key, op_id):
+        position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.ids.insert(position, op_id)
+        
+    def remove(self, key, op_id):
+        position = bisect_left(self.keys, key)
+        while self.ids[position] != op_id:
+            position += 1
+        del self.keys[position]
+        del self.ids[position]
+        
+    def bounds(self, low, high):
+        """Позиции [lo, hi) ключей с low <= ключ <= high (None — без границы)"""
+        lo = 0 if low is None else bisect_left(self.keys, low)
+        hi = len(self.keys) if high is None else bisect_right(self.keys, high)
+        return lo, hi
+    
+    def between(self, low, high):
+        """id с low <= ключ <= high, в порядке ключей"""
+        lo, hi = self.bounds(low, high)
+        return self.ids[lo:hi]
+    
+    def rebuild(self, keys, ids):
+        """Строит индекс целиком одной сортировкой numpy"""
+        import numpy as np
+        keys = np.asarray(keys, dtype=self.keys.typecode)
+        order = np.argsort(keys, kind='stable')
+        self.keys = array(self.keys.typecode, keys[order].tobytes())
+        self.ids = array('q', np.asarray(ids, dtype=np.int64)[order].tobytes())
+        
+    def merge(self, keys, ids):
+        """Вливает пачку за один проход numpy вместо вставки по одной"""
+        import numpy as np
+        if not len(ids):
+            return
+        keys = np.asarray(keys, dtype=self.keys.typecode)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        current = np.frombuffer(self.keys, dtype=self.keys.typecode) if self.keys else keys[:0]
+        current_ids = np.frombuffer(self.ids, dtype=np.int64) if self.ids else np.array([], dtype=np.int64)
+        positions = np.searchsorted(current, keys, side='right')
+        self.keys = array(self.keys.typecode, np.insert(current, positions, keys).tobytes())
+        self.ids = array('q', np.insert(current_ids, positions, np.asarray(ids, dtype=np.int64)[order]).tobytes())
+        
+    def __len__(self):
+        return len(self.ids)
+
+
+class OperationView(Mapping):
+    """Словарь-представление одной операции поверх колонок OperationStore"""
+    
+    __slots__ = ('store', 'op_id')
+    KEYS = ('type', 'name', 'amount', 'currency', 'comment', 'datetime', 'is_pending', 'id')
+    
+    def __init__(self, store, op_id):
+        self.store = store
+        self.op_id = op_id
+        
+    def __getitem__(self, key):
+        return self.store.field(self.store.row(self.op_id), key)
+    
+    def __iter__(self):
+        return iter(self.KEYS)
+    
+    def __len__(self):
+        return len(self.KEYS)
+    
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class OperationStore:
+    """Операции в колоночном виде с уникальными id и вторичными индексами.
+    
+    Каждое поле — отдельная колонка: суммы — целые в минимальных единицах
+    валюты (копейках, центах; см. digits) в array('q'), дата — целые секунды,
+    тип, название, валюта и комментарий — коды в таблицах строк, признак
+    ожидаемой операции — битовая маска. Строки упорядочены по id, поэтому
+    строка операции ищется бинпоиском. Наружу операции отдаются как
+    OperationView, которые читаются так же, как прежние словари.
+    
+    Индексы: id фактических и ожидаемых операций, id по типу и валюте —
+    отсортированные массивы; по дате и сумме — отсортированные ключи и
+    параллельный массив id; по словам названий и комментариев — TokenIndex.
+    """
+    
+    def __init__(self, operations=()):
+        self.types = Categories()
+        self.names = Categories()
+        self.currencies = Categories()
+        self.comments = Categories()
+        self.name_tokens = TokenIndex(self.names)
+        self.comment_tokens = TokenIndex(self.comments)
+        self.version = 0
+        self.clear()
+        self.next_id = 1
+        self.extend(operations)
+            
+    def clear(self):
+        self.version += 1
+        self.filter_cache = {}
+        # Валюты, которым понадобилось больше знаков, чем minor_units
+        self.minor_units = {}
+        self.op_ids = array('q')
+        self.amounts = array('q')
+        self.timestamps = array('q')
+        self.type_codes = array('b')
+        self.name_codes = array('i')
+        self.currency_codes = array('h')
+        self.comment_codes = array('i')
+        self.pending_bits = bytearray()
+        
+        self.actual_ids = SortedIds()
+        self.pending_ids = SortedIds()
+        self.by_type = {}
+        self.by_currency = {}
+        self.by_date = SortedIndex('q')
+        self.by_amount = SortedIndex('d')
+            
+    def __len__(self):
+        return len(self.op_ids)
+    
+    def __iter__(self):
+        return (OperationView(self, op_id) for op_id in self.op_ids)
+    
+    def __contains__(self, op_id):
+        row = bisect_left(self.op_ids, op_id)
+        return row < len(self.op_ids) and self.op_ids[row] == op_id
+    
+    def row(self, op_id):
+        row = bisect_left(self.op_ids, op_id)
+        if row == len(self.op_ids) or self.op_ids[row] != op_id:
+            raise KeyError(op_id)
+        return row
+    
+    def get(self, op_id):
+        self.row(op_id)
+        return OperationView(self, op_id)
+    
+    def field(self, row, key):
+        if key == 'amount':
+            return self.amounts[row] / 10 ** self.digits(self.currencies.values[self.currency_codes[row]])
+        if key == 'name':
+            return self.names.values[self.name_codes[row]]
+        if key == 'currency':
+            return self.currencies.values[self.currency_codes[row]]
+        if key == 'type':
+            return self.types.values[self.type_codes[row]]
+        if key == 'datetime':
+            return format_timestamp(self.timestamps[row])
+        if key == 'comment':
+            return self.comments.values[self.comment_codes[row]]
+        if key == 'is_pending':
+            return self.is_pending_row(row)
+        if key == 'id':
+            return self.op_ids[row]
+        raise KeyError(key)
+    
+    def is_pending_row(self, row):
+        return bool(self.pending_bits[row >> 3] >> (row & 7) & 1)
+    
+    def ids(self, pending):
+        return (self.pending_ids if pending else self.actual_ids).ids
+    
+    def id_at(self, index):
+        """id операции по ее номеру в общем порядке (для старых записей журнала)"""
+        return self.op_ids[index]
+    
+    def row_of(self, op_id):
+        """Номер строки операции в таблице фактических или ожидаемых"""
+        pending = self.is_pending_row(self.row(op_id))
+        return (self.pending_ids if pending else self.actual_ids).index(op_id)
+    
+    def filtered_ids(self, pending, op_type=None, currency=None, start=None, end=None,
+                     min_amount=None, max_amount=None, text=None):
+        """id фактических или ожидаемых операций, подходящих под фильтры, по возрастанию.
+        
+        text — слова, с которых должны начинаться слова названия или комментария.
+        Каждый фильтр дает маску по строкам, маски складываются через И.
+        Результат кэшируется до следующего изменения хранилища.
+        """
+        ids = self.ids(pending)
+        words = search_words(text)
+        ranges = (start, end, min_amount, max_amount)
+        if op_type is None and currency is None and not words and all(value is None for value in ranges):
+            return ids
+        key = (pending, op_type, currency, ranges, tuple(words))
+        cached = self.filter_cache.get(key)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        
+        mask = self.pending_mask()
+        if not pending:
+            mask = ~mask
+        if op_type is not None:
+            mask &= self.numpy_column(self.type_codes) == self.types.codes.get(op_type, -1)
+        if currency is not None:
+            mask &= self.numpy_column(self.currency_codes) == self.currencies.codes.get(currency, -1)
+        if start is not None or end is not None:
+            mask &= self.range_mask(self.by_date, self.numpy_column(self.timestamps),
+                                    None if start is None else parse_timestamp(start),
+                                    None if end is None else parse_timestamp(end))
+        if min_amount is not None or max_amount is not None:
+            mask &= self.range_mask(self.by_amount, self.amount_values, min_amount, max_amount)
+        for word in words:
+            mask &= (self.name_tokens.matches(word)[self.numpy_column(self.name_codes)]
+                     | self.comment_tokens.matches(word)[self.numpy_column(self.comment_codes)])
+        result = array('q', self.numpy_column(self.op_ids)[mask].tobytes())
+        if len(self.filter_cache) > 16:
+            self.filter_cache.clear()
+        self.filter_cache[key] = (self.version, result)
+        return result
+    
+    def chunks(self, size, pending=None, **filters):
+        """Операции словарями пачками не больше size, по возрастанию id (для выгрузки).
+        
+        Фильтры те же, что у filtered_ids, и отбирают строки по колонкам, так что
+        словари создаются только для подходящих операций и только для текущей
+        пачки. pending=None — и фактические, и ожидаемые.
+        """
+        import numpy as np
+        if pending is None and all(value is None for value in filters.values()):
+            rows = None
+            total = len(self.op_ids)
+        else:
+            if pending is None:
+                ids = np.concatenate([self.numpy_column(self.filtered_ids(False, **filters)),
+                                      self.numpy_column(self.filtered_ids(True, **filters))])
+                ids.sort()
+            else:
+                ids = self.numpy_column(self.filtered_ids(pending, **filters))
+            rows = np.searchsorted(self.numpy_column(self.op_ids), ids)
+            total = len(rows)
+        for start in range(0, total, size):
+            stop = min(start + size, total)
+            yield self.operations_at(np.arange(start, stop) if rows is None else rows[start:stop])
+            
+    def prepare_search(self):
+        """Дописывает в индексы слов новые строки заранее, чтобы первый поиск не ждал"""
+        self.name_tokens.update()
+        self.comment_tokens.update()
+        
+    def count(self, pending, **filters):
+        return len(self.filtered_ids(pending, **filters))
+    
+    def page(self, pending, offset, limit, **filters):
+        """Страница операций для таблицы: не больше limit штук начиная с offset"""
+        return [OperationView(self, op_id) for op_id in self.filtered_ids(pending, **filters)[offset:offset + limit]]
+    
+    def extend(self, operations):
+        """Пакетное добавление.
+        
+        Если хранилище пусто и id идут по возрастанию (обычная загрузка снапшота),
+        колонки собираются целиком, без поштучной вставки. Индексы по дате
+        и сумме в любом случае обновляются один раз на всю пачку.
+        """
+        operations = list(operations)
+        if not operations:
+            # Пустое хранилище создает каждый Ledger(): без операций numpy не импортируем
+            return
+        ids = [op.get('id') for op in operations]
+        was_empty = not self.op_ids
+        if was_empty and ids and None not in ids and all(a < b for a, b in zip(ids, ids[1:])):
+            self._load_columns(operations, ids)
+        elif len(ids) >= self.MERGE_BATCH and None not in ids:
+            self._merge_columns(operations, ids)
+        else:
+            for op in operations:
+                self.add(op, index_sorted=False)
+        
+        if was_empty:
+            self.by_date.rebuild(self.timestamps, self.op_ids)
+            self.by_amount.rebuild(self.amount_values(), self.op_ids)
+        else:
+            new_ids = [op['id'] for op in operations]
+            rows = [self.row(op_id) for op_id in new_ids]
+            self.by_date.merge([self.timestamps[row] for row in rows], new_ids)
+            self.by_amount.merge(self.amount_values(rows), new_ids)
+        
+    def _load_columns(self, operations, ids):
+        self.op_ids = array('q', ids)
+        self.timestamps = array('q', [parse_timestamp(op['datetime']) for op in operations])
+        self.type_codes = array('b', self.types.encode(op['type'] for op in operations))
+        self.name_codes = array('i', self.names.encode(op['name'] for op in operations))
+        self.currency_codes = array('h', self.currencies.encode(op['currency'] for op in operations))
+        self.amounts = array('q', self.to_units([op['amount'] for op in operations],
+                                                self.numpy_column(self.currency_codes)).tobytes())
+        self.comment_codes = array('i', self.comments.encode(op.get('comment', '') for op in operations))
+        self.next_id = ids[-1] + 1
+        self.version += 1
+        
+        self.pending_bits = bytearray((len(ids) + 7) // 8)
+        pending_ids = []
+        actual_ids = []
+        for row, op in enumerate(operations):
+            if op.get('is_pending', False):
+                self.pending_bits[row >> 3] |= 1 << (row & 7)
+                pending_ids.append(ids[row])
+            else:
+                actual_ids.append(ids[row])
+        self.pending_ids.ids = array('q', pending_ids)
+        self.actual_ids.ids = array('q', actual_ids)
+        
+        for codes, indexes in ((self.type_codes, self.by_type), (self.currency_codes, self.by_currency)):
+            groups = {}
+            for op_id, code in zip(ids, codes):
+                groups.setdefault(code, []).append(op_id)
+            for code, group in groups.items():
+                indexes[code] = SortedIds()
+                indexes[code].ids = array('q', group)
+    
+    MERGE_BATCH = 1000
+    
+    def _merge_columns(self, operations, ids):
+        """Большая пачка с готовыми id в непустое хранилище (например, отмена
+        удаления): колонки сливаются сортировкой numpy вместо вставки по одной"""
+        import numpy as np
+        currency_codes = array('h', self.currencies.encode(op['currency'] for op in operations))
+        units = self.to_units([op['amount'] for op in operations], self.numpy_column(currency_codes))
+        added = (array('q', ids), array('q', units.tobytes()),
+                 array('q', [parse_timestamp(op['datetime']) for op in operations]),
+                 array('b', self.types.encode(op['type'] for op in operations)),
+                 array('i', self.names.encode(op['name'] for op in operations)),
+                 currency_codes,
+                 array('i', self.comments.encode(op.get('comment', '') for op in operations)))
+        pending = np.concatenate([self.pending_mask(),
+                                  np.array([bool(op.get('is_pending', False)) for op in operations], dtype=bool)])
+        order = np.argsort(np.concatenate([self.numpy_column(self.op_ids), self.numpy_column(added[0])]), kind='stable')
+        for name, column, new in zip(self.COLUMN_NAMES, self.columns(), added):
+            merged = np.concatenate([self.numpy_column(column), self.numpy_column(new)])[order]
+            setattr(self, name, array(column.typecode, merged.tobytes()))
+        self.pending_bits = bytearray(np.packbits(pending[order], bitorder='little').tobytes())
+        self.next_id = max(self.next_id, max(ids) + 1)
+        self.version += 1
+        self._index_columns()
+    
+    def _index_columns(self):
+        """Списки ожидаемых и фактических и индексы по типу и валюте заново по колонкам"""
+        import numpy as np
+        ids = self.numpy_column(self.op_ids)
+        pending = self.pending_mask()
+        self.pending_ids.ids = array('q', ids[pending].tobytes())
+        self.actual_ids.ids = array('q', ids[~pending].tobytes())
+        for codes, indexes in ((self.type_codes, self.by_type), (self.currency_codes, self.by_currency)):
+            codes = self.numpy_column(codes)
+            indexes.clear()
+            for code in np.unique(codes).tolist():
+                indexes[code] = SortedIds()
+                indexes[code].ids = array('q', ids[codes == code].tobytes())
+    
+    def add(self, op, index_sorted=True):
+        """Добавляет операцию (присваивает id, если его нет) и возвращает ее id"""
+        op_id = op.get('id')
+        if op_id is None:
+            op_id = op['id'] = self.next_id
+        if op_id >= self.next_id:
+            self.next_id = op_id + 1
+        self.version += 1
+        
+        pending = bool(op.get('is_pending', False))
+        type_code = self.types.code(op['type'])
+        currency_code = self.currencies.code(op['currency'])
+        timestamp = parse_timestamp(op['datetime'])
+        values = (op_id, self.unit(op['amount'], op['currency']), timestamp, type_code, self.names.code(op['name']),
+                  currency_code, self.comments.code(op.get('comment', '')))
+        
+        row = len(self.op_ids)
+        if row and self.op_ids[-1] > op_id:
+            row = bisect_left(self.op_ids, op_id)
+            for column, value in zip(self.columns(), values):
+                column.insert(row, value)
+            self._insert_bit(row, pending)
+        else:
+            for column, value in zip(self.columns(), values):
+                column.append(value)
+            if row & 7 == 0:
+                self.pending_bits.append(0)
+            if pending:
+                self.pending_bits[row >> 3] |= 1 << (row & 7)
+        
+        (self.pending_ids if pending else self.actual_ids).add(op_id)
+        index = self.by_type.get(type_code)
+        if index is None:
+            index = self.by_type[type_code] = SortedIds()
+        index.add(op_id)
+        index = self.by_currency.get(currency_code)
+        if index is None:
+            index = self.by_currency[currency_code] = SortedIds()
+        index.add(op_id)
+        
+        if index_sorted:
+            self.by_date.add(timestamp, op_id)
+            self.by_amount.add(values[1] / 10 ** self.digits(op['currency']), op_id)
+        return op_id
+    
+    def digits(self, currency):
+        """Знаков после запятой в суммах валюты: как в minor_units, если в данных
+        не встретились более точные"""
+        return self.minor_units.get(currency, minor_units(currency))
+    
+    def unit(self, amount, currency):
+        """Сумма в минимальных единицах валюты; если их мало для этой суммы,
+        точность валюты повышается (widen), а не округляется"""
+        scaled = amount * 10 ** self.digits(currency)
+        if abs(scaled - round(scaled)) > abs(scaled) * 1e-12 + 1e-6:
+            self.widen(currency, minor_digits(amount, self.digits(currency)))
+            scaled = amount * 10 ** self.digits(currency)
+        return round(scaled)
+    
+    def to_units(self, amounts, codes):
+        """unit для пачки: суммы (float) и коды их валют -> массив int64"""
+        import numpy as np
+        amounts = np.asarray(amounts, dtype=np.float64)
+        scales = np.ones(len(amounts))
+        for code in np.unique(codes).tolist():
+            currency = self.currencies.values[code]
+            mask = codes == code
+            digits = minor_digits(amounts[mask], self.digits(currency))
+            if digits > self.digits(currency):
+                self.widen(currency, digits)
+            scales[mask] = 10.0 ** digits
+        return np.rint(amounts * scales).astype(np.int64)
+    
+    def widen(self, currency, digits):
+        """Повышает точность валюты до digits знаков, домножая ее суммы в колонке
+        (индекс по сумме хранит сами суммы и не меняется)"""
+        factor = 10 ** (digits - self.digits(currency))
+        code = self.currencies.codes.get(currency)
+        if code is not None and len(self.amounts):
+            units = self.numpy_column(self.amounts).copy()
+            units[self.numpy_column(self.currency_codes) == code] *= factor
+            self.amounts = array('q', units.tobytes())
+        self.minor_units[currency] = digits
+        self.version += 1
+    
+    def scales(self):
+        """10**знаков для каждого кода валюты"""
+        import numpy as np
+        return np.array([10.0 ** self.digits(currency) for currency in self.currencies.values])
+    
+    def amount_values(self, rows=None):
+        """Суммы как float (всей колонкой или по строкам rows) — для показа,
+        фильтров и пересчета по курсам; из целых они получаются одним делением"""
+        units = self.numpy_column(self.amounts)
+        codes = self.numpy_column(self.currency_codes)
+        if rows is not None:
+            units, codes = units[rows], codes[rows]
+        return units / self.scales()[codes] if len(units) else units.astype(float)
+    
+    def columns(self):
+        return (self.op_ids, self.amounts, self.timestamps, self.type_codes,
+                self.name_codes, self.currency_codes, self.comment_codes)
+    
+    COLUMN_NAMES = ('op_ids', 'amounts', 'timestamps', 'type_codes', 'name_codes', 'currency_codes', 'comment_codes')
+    TABLE_NAMES = ('types', 'names', 'currencies', 'comments')
+    
+    def dump_columns(self):
+        """Таблицы строк и колонки (вместе с индексами по дате и сумме) как есть —
+        для двоичного снапшота. Возвращает ({таблица: строки}, {колонка: array})"""
+        tables = {name: getattr(self, name).values for name in self.TABLE_NAMES}
+        tables['minor_units'] = self.minor_units
+        columns = dict(zip(self.COLUMN_NAMES, self.columns()))
+        columns['pending_bits'] = array('B', self.pending_bits)
+        columns['date_keys'], columns['date_ids'] = self.by_date.keys, self.by_date.ids
+        columns['amount_keys'], columns['amount_ids'] = self.by_amount.keys, self.by_amount.ids
+        return tables, columns
+    
+    def snapshot_copy(self):
+        """Копия для записи снапшота в другом потоке: колонки, таблицы строк и
+        индексы по дате и сумме копируются целыми кусками, так что дальнейшие
+        изменения хранилища ее не задевают. Остальные индексы у копии пусты —
+        для записи снапшота они не нужны."""
+        store = OperationStore()
+        for name in self.TABLE_NAMES:
+            getattr(store, name).values = list(getattr(self, name).values)
+        store.minor_units = dict(self.minor_units)
+        for name, column in zip(self.COLUMN_NAMES, self.columns()):
+            setattr(store, name, column[:])
+        store.pending_bits = bytearray(self.pending_bits)
+        store.by_date.keys, store.by_date.ids = self.by_date.keys[:], self.by_date.ids[:]
+        store.by_amount.keys, store.by_amount.ids = self.by_amount.keys[:], self.by_amount.ids[:]
+        store.next_id = self.next_id
+        return store
+    
+    @classmethod
+    def from_columns(cls, tables, columns, byteswap=False):
+        """Хранилище из готовых таблиц и колонок (см. dump_columns) без разбора операций.
+        
+        columns — {колонка: (typecode, буфер)}; буфер копируется в array одним
+        куском (byteswap — с другим порядком байт), остальные индексы строятся
+        по колонкам numpy. Суммы в float (снапшоты прежних версий) переводятся
+        в минимальные единицы валют.
+        """
+        store = cls()
+        for name in cls.TABLE_NAMES:
+            table = getattr(store, name)
+            table.values = list(tables[name])
+            table.codes = {value: code for code, value in enumerate(table.values)}
+        store.minor_units = dict(tables.get('minor_units', {}))
+        arrays = {}
+        for name, (typecode, buffer) in columns.items():
+            arrays[name] = array(typecode)
+            arrays[name].frombytes(buffer)
+            if byteswap:
+                arrays[name].byteswap()
+        if arrays['amounts'].typecode == 'd':
+            arrays['amounts'] = array('q', store.to_units(store.numpy_column(arrays['amounts']),
+                                                          store.numpy_column(arrays['currency_codes'])).tobytes())
+        (store.op_ids, store.amounts, store.timestamps, store.type_codes,
+         store.name_codes, store.currency_codes, store.comment_codes) = (arrays[name] for name in cls.COLUMN_NAMES)
+        store.pending_bits = bytearray(arrays['pending_bits'])
+        store.by_date.keys, store.by_date.ids = arrays['date_keys'], arrays['date_ids']
+        store.by_amount.keys, store.by_amount.ids = arrays['amount_keys'], arrays['amount_ids']
+        if not len(store.op_ids):
+            return store
+        store.next_id = store.op_ids[-1] + 1
+        store.version += 1
+        store._index_columns()
+        return store
+    
+    def confirm(self, op_id):
+        """Переводит ожидаемую операцию в фактические, возвращает ее новую строку"""
+        row = self.row(op_id)
+        self.version += 1
+        self.pending_bits[row >> 3] &= ~(1 << (row & 7))
+        self.pending_ids.remove(op_id)
+        return self.actual_ids.add(op_id)
+    
+    def unconfirm(self, op_id):
+        """Обратное confirm: операция снова ожидаемая, возвращает ее строку среди ожидаемых"""
+        row = self.row(op_id)
+        self.version += 1
+        self.pending_bits[row >> 3] |= 1 << (row & 7)
+        self.actual_ids.remove(op_id)
+        return self.pending_ids.add(op_id)
+    
+    def delete_many(self, op_ids):
+        """Удаляет пачку операций одним проходом numpy по колонкам и индексам;
+        возвращает их словари"""
+        import numpy as np
+        op_ids = np.unique(np.asarray(op_ids, dtype=np.int64))
+        ids = self.numpy_column(self.op_ids)
+        rows = np.searchsorted(ids, op_ids)
+        found = rows < len(ids)
+        found[found] = ids[rows[found]] == op_ids[found]
+        if not found.all():
+            raise KeyError(int(op_ids[~found][0]))
+        operations = self.operations_at(rows)
+        self.version += 1
+        
+        keep = np.ones(len(self.op_ids), dtype=bool)
+        keep[rows] = False
+        pending = self.pending_mask()[keep]
+        for name, column in zip(self.COLUMN_NAMES, self.columns()):
+            setattr(self, name, array(column.typecode, self.numpy_column(column)[keep].tobytes()))
+        self.pending_bits = bytearray(np.packbits(pending, bitorder='little').tobytes())
+        
+        for index in [self.actual_ids, self.pending_ids, *self.by_type.values(), *self.by_currency.values()]:
+            ids = self.numpy_column(index.ids)
+            index.ids = array('q', ids[~np.isin(ids, op_ids)].tobytes())
+        for index in (self.by_date, self.by_amount):
+            left = ~np.isin(self.numpy_column(index.ids), op_ids)
+            index.keys = array(index.keys.typecode, self.numpy_column(index.keys)[left].tobytes())
+            index.ids = array('q', self.numpy_column(index.ids)[left].tobytes())
+        return operations
+    
+    def operations_at(self, rows):
+        """Словари операций по массиву номеров строк, колонками сразу, без поиска по id"""
+        pending = self.pending_mask()[rows].tolist()
+        columns = (
+            self.numpy_column(self.type_codes)[rows].tolist(),
+            self.numpy_column(self.name_codes)[rows].tolist(),
+            self.amount_values(rows).tolist(),
+            self.numpy_column(self.currency_codes)[rows].tolist(),
+            self.numpy_column(self.comment_codes)[rows].tolist(),
+            format_timestamps(self.numpy_column(self.timestamps)[rows]),
+            self.numpy_column(self.op_ids)[rows].tolist(),
+        )
+        return [
+            {'type': self.types.values[op_type], 'name': self.names.values[name], 'amount': amount,
+             'currency': self.currencies.values[currency], 'comment': self.comments.values[comment],
+             'datetime': timestamp, 'is_pending': is_pending, 'id': op_id}
+            for op_type, name, amount, currency, comment, timestamp, op_id, is_pending in zip(*columns, pending)
+        ]
+    
+    def detach(self):
+        """Очищает хранилище за O(1): колонки и индексы не копируются, а отдаются
+        целиком (для отмены clear). Вернуть их — attach."""
+        saved = dict(self.__dict__)
+        self.clear()
+        return saved
+    
+    def attach(self, saved):
+        """Возвращает отданное detach; к этому моменту хранилище снова пусто"""
+        version = max(self.version, saved['version']) + 1
+        next_id = max(self.next_id, saved['next_id'])
+        self.__dict__.update(saved)
+        self.version = version
+        self.next_id = next_id
+        
+    def discard(self, saved):
+        """Отданное detach больше не понадобится; освобождать нечего, кроме ссылки"""
+        
+    def delete(self, op_id):
+        """Удаляет операцию и возвращает ее данные в виде словаря"""
+        row = self.row(op_id)
+        op = dict(OperationView(self, op_id))
+        self.version += 1
+        
+        (self.pending_ids if op['is_pending'] else self.actual_ids).remove(op_id)
+        self.by_type[self.type_codes[row]].remove(op_id)
+        self.by_currency[self.currency_codes[row]].remove(op_id)
+        self.by_date.remove(self.timestamps[row], op_id)
+        self.by_amount.remove(op['amount'], op_id)
+        
+        for column in self.columns():
+            del column[row]
+        self._delete_bit(row)
+        return op
+    
+    def _insert_bit(self, row, value):
+        """Вставляет бит в маску со сдвигом хвоста (хвост сдвигается как одно целое)"""
+        start, offset = row >> 3, row & 7
+        tail = int.from_bytes(self.pending_bits[start:], 'little')
+        low = tail & ((1 << offset) - 1)
+        tail = low | (int(value) << offset) | ((tail >> offset) << (offset + 1))
+        size = (len(self.op_ids) + 7) // 8 - start
+        self.pending_bits[start:] = tail.to_bytes(size, 'little')
+        
+    def _delete_bit(self, row):
+        start, offset = row >> 3, row & 7
+        tail = int.from_bytes(self.pending_bits[start:], 'little')
+        low = tail & ((1 << offset) - 1)
+        tail = low | ((tail >> (offset + 1)) << offset)
+        size = (len(self.op_ids) + 7) // 8 - start
+        self.pending_bits[start:] = tail.to_bytes(size, 'little')
+        
+    def ids_by_type(self, op_type):
+        index = self.by_type.get(self.types.codes.get(op_type))
+        return index.ids if index else array('q')
+    
+    def ids_by_currency(self, currency):
+        index = self.by_currency.get(self.currencies.codes.get(currency))
+        return index.ids if index else array('q')
+    
+    def ids_between(self, start, end):
+        """id операций с start <= datetime <= end (строки в формате '%Y-%m-%d %H:%M:%S')"""
+        return self.by_date.between(parse_timestamp(start), parse_timestamp(end))
+    
+    def numpy_column(self, column):
+        """Колонка как массив numpy без копирования"""
+        import numpy as np
+        return np.frombuffer(column, dtype=column.typecode) if len(column) else np.array([], dtype=column.typecode)
+    
+    def rows_mask(self, ids):
+        """Маска по строкам для набора id"""
+        import numpy as np
+        mask = np.zeros(len(self.op_ids), dtype=bool)
+        mask[np.searchsorted(self.numpy_column(self.op_ids), self.numpy_column(ids))] = True
+        return mask
+    
+    def range_mask(self, index, values, low, high):
+        """Маска low <= значение <= high: узкий диапазон берется из индекса,
+        широкий быстрее сравнить со всей колонкой (values — массив или функция,
+        которая его возвращает)"""
+        lo, hi = index.bounds(low, high)
+        if (hi - lo) * 8 < len(self.op_ids):
+            return self.rows_mask(index.ids[lo:hi])
+        if callable(values):
+            values = values()
+        if low is None:
+            return values <= high
+        if high is None:
+            return values >= low
+        return (values >= low) & (values <= high)
+    
+    def pending_mask(self):
+        import numpy as np
+        bits = np.frombuffer(bytes(self.pending_bits), dtype=np.uint8)
+        return np.unpackbits(bits, bitorder='little')[:len(self.op_ids)].astype(bool)
+    
+    def signed_amounts(self):
+        """Суммы со знаком (float): расходы отрицательные"""
+        return self.signed(self.amount_values())
+    
+    def signed_units(self):
+        """Суммы со знаком в минимальных единицах валют (int64)"""
+        return self.signed(self.numpy_column(self.amounts))
+    
+    def signed(self, amounts):
+        import numpy as np
+        expense = self.types.codes.get('expense')
+        if expense is None:
+            return amounts.copy()
+        return np.where(self.numpy_column(self.type_codes) == expense, -amounts, amounts)
+    
+    def balances(self):
+        return Balances.rebuild(self)
+    
+    def rollup_rows(self):
+        """Суммы фактических операций, сгруппированные для Rollups.rebuild.
+        
+        Возвращает строки (день, тип, валюта, сумма) и (месяц, название, валюта, сумма
+        расходов); суммы — точные, в единицах 10**-MAX_MINOR_UNITS (exact_sums по
+        целым units). Группировка — np.unique по составному коду, без цикла по операциям.
+        """
+        import numpy as np
+        actual = ~self.pending_mask()
+        amounts = self.numpy_column(self.amounts)[actual]
+        days = self.numpy_column(self.timestamps)[actual] // 86400
+        types = self.numpy_column(self.type_codes)[actual].astype(np.int64)
+        currencies = self.numpy_column(self.currency_codes)[actual].astype(np.int64)
+        names = self.numpy_column(self.name_codes)[actual].astype(np.int64)
+        
+        def grouped(amounts, *columns):
+            key = np.zeros(len(amounts), dtype=np.int64)
+            for column in columns:
+                column = column - column.min(initial=0)
+                key = key * (int(column.max(initial=0)) + 1) + column
+            keys, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+            return first, exact_sums(inverse.ravel(), amounts, len(keys))
+        
+        # units каждой валюты — в своих знаках, в строках — в общих
+        scales = [10 ** (MAX_MINOR_UNITS - self.digits(currency)) for currency in self.currencies.values]
+        first, sums = grouped(amounts, days, types, currencies)
+        day_rows = [
+            (str(np.datetime64(int(days[row]), 'D')), self.types.values[types[row]],
+             self.currencies.values[currencies[row]], units * scales[currencies[row]])
+            for row, units in zip(first.tolist(), sums.tolist())
+        ]
+        
+        expense = self.types.codes.get('expense')
+        category_rows = []
+        if expense is not None:
+            mask = types == expense
+            months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+            months, names, currencies = months[mask], names[mask], currencies[mask]
+            first, sums = grouped(amounts[mask], months, names, currencies)
+            category_rows = [
+                (str(np.datetime64(int(months[row]), 'M')), self.names.values[names[row]],
+                 self.currencies.values[currencies[row]], units * scales[currencies[row]])
+                for row, units in zip(first.tolist(), sums.tolist())
+            ]
+        return day_rows, category_rows
+    
+    def group_codes(self, by):
+        """Коды групп и их подписи для 'currency', 'name', 'type', 'month' или 'day'"""
+        import numpy as np
+        if by == 'currency':
+            return self.numpy_column(self.currency_codes), list(self.currencies.values)
+        if by == 'name':
+            return self.numpy_column(self.name_codes), list(self.names.values)
+        if by == 'type':
+            return self.numpy_column(self.type_codes), list(self.types.values)
+        unit = {'month': 'M', 'day': 'D'}[by]
+        buckets = self.numpy_column(self.timestamps).astype('datetime64[s]').astype(f'datetime64[{unit}]')
+        labels, codes = np.unique(buckets, return_inverse=True)
+        return codes, [str(label) for label in labels]
+    
+    def totals(self, converter, target, by='currency', pending=None, historical=False, interpolate=False):
+        """Итоги по группам в валюте target за один векторный проход.
+        
+        pending: None — все операции, True/False — только ожидаемые/фактические.
+        historical — по курсам на дату каждой операции, а не по текущим.
+        Возвращает ({группа: сумма}, [валюты без курса]).
+        """
+        amounts = self.signed_amounts()
+        currency_codes = self.numpy_column(self.currency_codes)
+        timestamps = self.numpy_column(self.timestamps)
+        group_codes, groups = self.group_codes(by)
+        if pending is not None:
+            mask = self.pending_mask() == pending
+            amounts, currency_codes, group_codes = amounts[mask], currency_codes[mask], group_codes[mask]
+            timestamps = timestamps[mask]
+        return converter.grouped_totals(amounts, currency_codes, self.currencies.values, group_codes, groups,
+                                        target, timestamps if historical else None, interpolate)
+    
+    def memory_usage(self):
+        """Приблизительный объем колонок и индексов в байтах (без таблиц строк)"""
+        arrays = list(self.columns()) + [self.actual_ids.ids, self.pending_ids.ids, self.by_date.keys,
+                                         self.by_date.ids, self.by_amount.keys, self.by_amount.ids]
+        arrays += [index.ids for index in self.by_type.values()]
+        arrays += [index.ids for index in self.by_currency.values()]
+        return sum(a.itemsize * len(a) for a in arrays) + len(self.pending_bits)
+
+
+def record_rate(history, rates, currency, day, rate):
+    """Курс currency с даты day ('%Y-%m-%d') в истории {валюта: [[день, курс], ...]}.
+    Курс за тот же день заменяется, текущим (rates) становится последний по дате."""
+    points = history.setdefault(currency, [])
+    position = bisect_left(points, [day])
+    if position < len(points) and points[position][0] == day:
+        points[position][1] = rate
+    else:
+        points.insert(position, [day, rate])
+    rates[currency] = points[-1][1]
+
+
+class CurrencyConverter:
+    """Кросс-курсы всех валют через опорную в виде плотной матрицы.
+    
+    rates — стоимость единицы валюты в опорной (как в настройках: 1 USD = 90 RUB).
+    matrix[i, j] — сколько единиц валюты j дают за единицу валюты i, так что
+    пересчет в любую основную валюту — одно умножение на столбец матрицы.
+    Валюты без курса не отбрасываются молча, а возвращаются списком.
+    Матрица (и numpy) нужны только пакетным пересчетам и строятся при первом
+    обращении, итог по словарю балансов считается без них.
+    
+    history — курсы по датам (см. record_rate). Курс действует с своей даты до
+    следующей (или, с interpolate, линейно меняется между ними); до первой даты
+    действует самый ранний. Валюты без истории пересчитываются по текущему курсу.
+    """
+    
+    def __init__(self, rates, pivot='RUB', history=None):
+        self.to_pivot = dict(rates)
+        self.to_pivot.setdefault(pivot, 1.0)
+        self.pivot = pivot
+        self.currencies = list(self.to_pivot)
+        self.index = {currency: i for i, currency in enumerate(self.currencies)}
+        self._matrix = None
+        self.history = {currency: points for currency, points in (history or {}).items() if points}
+        self.series = {}
+        
+    def rate_on(self, currency, day):
+        """Курс валюты в опорной, действовавший в день day, или None"""
+        points = self.history.get(currency)
+        if points is None:
+            return self.to_pivot.get(currency)
+        position = max(bisect_right(points, [day, float('inf')]) - 1, 0)
+        return points[position][1]
+    
+    def dated(self, currency):
+        """История курса как массивы numpy (секунды даты, курс); строится один раз"""
+        import numpy as np
+        series = self.series.get(currency)
+        if series is None:
+            points = self.history[currency]
+            series = self.series[currency] = (
+                np.array([parse_timestamp(day) for day, _ in points], dtype=np.int64),
+                np.array([rate for _, rate in points], dtype=float))
+        return series
+    
+    def rates_at(self, currency, timestamps, interpolate=False):
+        """Курсы валюты в опорной на моменты timestamps (секунды) одним проходом (nan — курса нет)"""
+        import numpy as np
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if currency not in self.history:
+            return np.full(len(timestamps), self.to_pivot.get(currency, np.nan), dtype=float)
+        days, rates = self.dated(currency)
+        if interpolate:
+            return np.interp(timestamps, days, rates)
+        positions = np.maximum(np.searchsorted(days, timestamps, side='right') - 1, 0)
+        return rates[positions]
+        
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            import numpy as np
+            to_pivot = np.array([self.to_pivot[currency] for currency in self.currencies], dtype=float)
+            self._matrix = to_pivot[:, None] / to_pivot[None, :]
+        return self._matrix
+        
+    def rate(self, source, target):
+        return self.to_pivot[source] / self.to_pivot[target]
+    
+    def factors(self, currencies, target):
+        """Множители пересчета в target для списка валют (nan — курса нет)"""
+        import numpy as np
+        result = np.full(len(currencies), np.nan)
+        column = self.index.get(target)
+        if column is None:
+            return result
+        rows = np.array([self.index.get(currency, -1) for currency in currencies], dtype=np.intp)
+        known = rows >= 0
+        result[known] = self.matrix[rows[known], column]
+        return result
+    
+    def convert(self, amounts, currency_codes, currencies, target):
+        """Пересчитывает массив сумм в target.
+        
+        currency_codes — номера валют в списке currencies. Возвращает суммы
+        (0 там, где курса нет) и список валют без курса среди ненулевых сумм.
+        """
+        import numpy as np
+        amounts = np.asarray(amounts, dtype=float)
+        currency_codes = np.asarray(currency_codes, dtype=np.intp)
+        factors = self.factors(currencies, target)
+        unknown = np.isnan(factors)
+        missing = []
+        if unknown.any():
+            used = np.unique(currency_codes[amounts != 0])
+            missing = [currencies[code] for code in used if unknown[code]]
+            factors = np.where(unknown, 0.0, factors)
+        return amounts * factors[currency_codes], missing
+    
+    def convert_at(self, amounts, currency_codes, currencies, timestamps, target, interpolate=False):
+        """Как convert, но каждая сумма пересчитывается по курсам на свой момент timestamps.
+        
+        Курсы ищутся бинпоиском по истории сразу для всех операций одной валюты.
+        """
+        import numpy as np
+        amounts = np.asarray(amounts, dtype=float)
+        currency_codes = np.asarray(currency_codes, dtype=np.intp)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        factors = np.full(len(amounts), np.nan)
+        target_rates = self.rates_at(target, timestamps, interpolate)
+        for code in np.unique(currency_codes):
+            rows = currency_codes == code
+            factors[rows] = self.rates_at(currencies[code], timestamps[rows], interpolate) / target_rates[rows]
+        unknown = np.isnan(factors)
+        missing = []
+        if unknown.any():
+            missing = sorted({currencies[code] for code in np.unique(currency_codes[unknown & (amounts != 0)])})
+            factors = np.where(unknown, 0.0, factors)
+        return amounts * factors, missing
+    
+    def total(self, balances, target, day=None):
+        """Сумма словаря {валюта: сумма} в target и список валют без курса.
+        day — пересчитать по курсам на эту дату, а не по текущим."""
+        total = 0.0
+        missing = []
+        for currency, amount in balances.items():
+            if currency in self.to_pivot and target in self.to_pivot:
+                if day is None or not self.history:
+                    total += amount * self.rate(currency, target)
+                else:
+                    total += amount * self.rate_on(currency, day) / self.rate_on(target, day)
+            elif amount:
+                missing.append(currency)
+        return total, missing
+    
+    def grouped_totals(self, amounts, currency_codes, currencies, group_codes, groups, target,
+                       timestamps=None, interpolate=False):
+        """Суммы в target по группам (категориям, месяцам, валютам) одним вызовом bincount.
+        С timestamps — по курсам на дату каждой операции."""
+        import numpy as np
+        if timestamps is None:
+            converted, missing = self.convert(amounts, currency_codes, currencies, target)
+        else:
+            converted, missing = self.convert_at(amounts, currency_codes, currencies, timestamps, target, interpolate)
+        sums = np.bincount(np.asarray(group_codes, dtype=np.intp), weights=converted, minlength=len(groups))
+        return dict(zip(groups, sums.tolist())), missing
+
+
+def exact_sums(keys, values, size):
+    """Суммы целых values (int64) по ключам keys — как np.bincount с весами, но без
+    округления. Значения делятся на младшие 26 бит и старшую часть; bincount
+    суммирует каждую в float точно, пока сумма меньше 2**53, так что это почти
+    так же быстро, как сумма float. Если суммы больше, складывается np.add.at."""
+    import numpy as np
+    high = values >> 26
+    if len(values) < 2 ** 27 and int(np.abs(high).max(initial=0)) * len(values) < 2 ** 53:
+        low = np.bincount(keys, weights=values & 0x3FFFFFF, minlength=size)
+        return np.bincount(keys, weights=high, minlength=size).astype(np.int64) * 2 ** 26 + low.astype(np.int64)
+    sums = np.zeros(size, dtype=np.int64)
+    np.add.at(sums, keys, values)
+    return sums
+
+
+class Balances:
+    """Балансы по валютам как материализованный агрегат журнала операций.
+    
+    Обновляются по одной операции при каждом изменении; rebuild() пересчитывает
+    их с нуля одним векторным проходом по колонкам OperationStore, а verify()
+    сравнивает текущие значения с пересчитанными.
+    
+    Точные значения — целые числа единиц 10**-MAX_MINOR_UNITS (actual_units,
+    pending_units): сложение и вычитание не копят погрешность float, и баланс,
+    который должен стать нулем, становится ровно нулем. actual и pending — те же
+    значения во float для показа и пересчета по курсам.
+    """
+    
+    SCALE = 10 ** MAX_MINOR_UNITS
+    
+    def __init__(self, actual=None, pending=None):
+        self.actual = {}
+        self.pending = {}
+        self.actual_units = {}
+        self.pending_units = {}
+        for is_pending, values in ((False, actual), (True, pending)):
+            for currency, amount in (values or {}).items():
+                self.shift(is_pending, currency, exact_units(amount))
+        
+    def shift(self, pending, currency, units):
+        """Меняет баланс валюты на units (целые единицы 10**-MAX_MINOR_UNITS)"""
+        exact, values = (self.pending_units, self.pending) if pending else (self.actual_units, self.actual)
+        value = exact.get(currency, 0) + units
+        if value:
+            exact[currency] = value
+            values[currency] = value / self.SCALE
+        else:
+            exact.pop(currency, None)
+            values.pop(currency, None)
+            
+    def set(self, pending, currency, amount):
+        """Задает баланс валюты (None — убирает его)"""
+        exact = self.pending_units if pending else self.actual_units
+        self.shift(pending, currency, (0 if amount is None else exact_units(amount)) - exact.get(currency, 0))
+    
+    @staticmethod
+    def signed_units(op):
+        units = exact_units(op['amount'])
+        return units if op['type'] == 'income' else -units
+    
+    def add(self, op, sign=1):
+        self.shift(op.get('is_pending', False), op['currency'], self.signed_units(op) * sign)
+            
+    def remove(self, op):
+        self.add(op, sign=-1)
+        
+    def add_many(self, operations):
+        """Пачка операций: суммы копятся по валютам, каждый баланс меняется один раз"""
+        deltas = {}
+        for op in operations:
+            key = (op.get('is_pending', False), op['currency'])
+            deltas[key] = deltas.get(key, 0) + self.signed_units(op)
+        for (pending, currency), delta in deltas.items():
+            self.shift(pending, currency, delta)
+        
+    def confirm(self, op, sign=1):
+        """Ожидаемая операция стала фактической (sign=-1 — наоборот)"""
+        units = sign * self.signed_units(op)
+        self.shift(True, op['currency'], -units)
+        self.shift(False, op['currency'], units)
+        
+    def unconfirm(self, op):
+        self.confirm(op, sign=-1)
+        
+    def clear(self):
+        for values in (self.actual, self.pending, self.actual_units, self.pending_units):
+            values.clear()
+        
+    @classmethod
+    def rebuild(cls, store):
+        """Пересчет балансов по всем операциям: точные суммы целых единиц
+        по кодам валют (exact_sums)"""
+        import numpy as np
+        balances = cls()
+        if not len(store):
+            return balances
+        # Ключ — код валюты и признак ожидаемой операции, один проход на обе группы
+        keys = store.numpy_column(store.currency_codes).astype(np.intp) * 2 + store.pending_mask()
+        sums = exact_sums(keys, store.signed_units(), 2 * len(store.currencies))
+        for key, value in enumerate(sums.tolist()):
+            currency = store.currencies.values[key // 2]
+            balances.shift(bool(key % 2), currency, value * 10 ** (MAX_MINOR_UNITS - store.digits(currency)))
+        return balances
+    
+    def differences(self, other):
+        """Расхождения с другими балансами по точным суммам: {(вид, валюта): (наше, их)}
+        в единицах 10**-MAX_MINOR_UNITS"""
+        result = {}
+        for kind in ('actual', 'pending'):
+            ours, theirs = getattr(self, kind + '_units'), getattr(other, kind + '_units')
+            for currency in set(ours) | set(theirs):
+                a, b = ours.get(currency, 0), theirs.get(currency, 0)
+                if a != b:
+                    result[(kind, currency)] = (a, b)
+        return result
+    
+    def verify(self, store):
+        """Сверка с пересчетом по операциям; пустой словарь — все сходится"""
+        return self.differences(store.balances())
+
+
+def week_start(day):
+    """'2024-03-14' -> понедельник этой недели в том же формате"""
+    moment = date.fromisoformat(day)
+    return (moment - timedelta(days=moment.weekday())).isoformat()
+
+
+def shift_month(month, delta):
+    year, number = divmod(int(month[:4]) * 12 + int(month[5:7]) - 1 + delta, 12)
+    return f'{year:04d}-{number + 1:02d}'
+
+
+def bucket_days(unit, bucket):
+    """Дни корзины: сам день, семь дней недели или все дни месяца"""
+    if unit == 'day':
+        return [bucket]
+    first = date.fromisoformat(bucket if unit == 'week' else bucket + '-01')
+    last = first + timedelta(days=7) if unit == 'week' else date.fromisoformat(shift_month(bucket, 1) + '-01')
+    return [(first + timedelta(days=i)).isoformat() for i in range((last - first).days)]
+
+
+class Rollups:
+    """Предрасчитанные итоги фактических операций по периодам для аналитики.
+    
+    flows[период][корзина][тип][валюта] — доходы и расходы за день, неделю
+    (ключ — понедельник) или месяц; categories[месяц][название][валюта] —
+    расходы по категориям. Как и Balances, обновляются по одной операции,
+    поэтому графики строятся по последним N корзинам, а не проходом по истории.
+    Суммы в листьях — точные, целые единицы 10**-MAX_MINOR_UNITS (в валюту
+    переводит amounts). Валюты хранятся раздельно и пересчитываются при отображении: если у
+    конвертера есть история курсов, доходы и расходы — по курсу каждого дня,
+    категории — по курсу на начало месяца.
+    """
+    
+    UNITS = ('day', 'week', 'month')
+    
+    def __init__(self):
+        self.flows = {unit: {} for unit in self.UNITS}
+        self.categories = {}
+        self.latest_day = None
+        
+    @staticmethod
+    def _shift(tree, keys, currency, delta):
+        """Меняет лист tree[keys...][currency] на delta единиц, по пути удаляя опустевшие узлы"""
+        path = [tree]
+        for key in keys:
+            path.append(path[-1].setdefault(key, {}))
+        leaf = path[-1]
+        value = leaf.get(currency, 0) + delta
+        if not value:
+            leaf.pop(currency, None)
+        else:
+            leaf[currency] = value
+        for node, key in zip(reversed(path[:-1]), reversed(keys)):
+            if node[key]:
+                break
+            del node[key]
+            
+    @staticmethod
+    def amounts(values):
+        """Лист {валюта: единицы} -> {валюта: сумма}, как их ждет CurrencyConverter.total"""
+        return {currency: units / Balances.SCALE for currency, units in values.items()}
+    
+    def add_day(self, day, op_type, currency, units):
+        if units == 0:
+            return
+        for unit, bucket in (('day', day), ('week', week_start(day)), ('month', day[:7])):
+            self._shift(self.flows[unit], (bucket, op_type), currency, units)
+        if self.latest_day is None or day > self.latest_day:
+            self.latest_day = day
+            
+    def add_category(self, month, name, currency, units):
+        if units:
+            self._shift(self.categories, (month, name), currency, units)
+            
+    def add(self, op, sign=1):
+        if op.get('is_pending', False):
+            return
+        day = str(op['datetime'])[:10]
+        units = sign * exact_units(op['amount'])
+        self.add_day(day, op['type'], op['currency'], units)
+        if op['type'] == 'expense':
+            self.add_category(day[:7], op['name'], op['currency'], units)
+            
+    def remove(self, op):
+        self.add(op, sign=-1)
+        
+    def add_many(self, operations):
+        for op in operations:
+            self.add(op)
+            
+    def confirm(self, op):
+        """Ожидаемая операция стала фактической и попадает в итоги"""
+        self.add(dict(op, is_pending=False))
+        
+    def unconfirm(self, op):
+        self.remove(dict(op, is_pending=False))
+        
+    @classmethod
+    def rebuild(cls, store):
+        """Итоги с нуля по сгруппированным хранилищем строкам (см. rollup_rows)"""
+        rollups = cls()
+        day_rows, category_rows = store.rollup_rows()
+        for row in day_rows:
+            rollups.add_day(*row)
+        for row in category_rows:
+            rollups.add_category(*row)
+        return rollups
+    
+    def buckets(self, unit, count):
+        """Ключи последних count корзин по последнюю операцию включительно, от старых к новым"""
+        if self.latest_day is None:
+            return []
+        if unit == 'day':
+            latest = date.fromisoformat(self.latest_day)
+            return [(latest - timedelta(days=i)).isoformat() for i in range(count - 1, -1, -1)]
+        if unit == 'week':
+            latest = date.fromisoformat(week_start(self.latest_day))
+            return [(latest - timedelta(weeks=i)).isoformat() for i in range(count - 1, -1, -1)]
+        return [shift_month(self.latest_day[:7], -i) for i in range(count - 1, -1, -1)]
+    
+    def flow_series(self, unit, count, converter, target):
+        """(корзины, доходы, расходы, валюты без курса) за последние count корзин в target"""
+        buckets = self.buckets(unit, count)
+        income, expense, missing = [], [], set()
+        for bucket in buckets:
+            if converter.history:
+                days = [(day, self.flows['day'].get(day, {})) for day in bucket_days(unit, bucket)]
+            else:
+                days = [(None, self.flows[unit].get(bucket, {}))]
+            for values, op_type in ((income, 'income'), (expense, 'expense')):
+                bucket_total = 0.0
+                for day, flows in days:
+                    if op_type in flows:
+                        total, not_converted = converter.total(self.amounts(flows[op_type]), target, day)
+                        bucket_total += total
+                        missing.update(not_converted)
+                values.append(bucket_total)
+        return buckets, income, expense, sorted(missing)
+    
+    def category_spending(self, months, converter, target):
+        """Расходы по категориям за указанные месяцы, по убыванию, и валюты без курса"""
+        totals, missing = {}, set()
+        for month in months:
+            for name, values in self.categories.get(month, {}).items():
+                total, not_converted = converter.total(self.amounts(values), target, month + '-01')
+                totals[name] = totals.get(name, 0.0) + total
+                missing.update(not_converted)
+        result = sorted(totals.items(), key=lambda item: -item[1])
+        return result, sorted(missing)
+    
+    def currency_trends(self, count):
+        """Чистый поток (доходы минус расходы) по валютам за последние count месяцев"""
+        months = self.buckets('month', count)
+        trends = {}
+        for i, month in enumerate(months):
+            flows = self.flows['month'].get(month, {})
+            for op_type, sign in (('income', 1), ('expense', -1)):
+                for currency, units in flows.get(op_type, {}).items():
+                    trends.setdefault(currency, [0] * len(months))[i] += sign * units
+        return months, {currency: [units / Balances.SCALE for units in values] for currency, values in trends.items()}
+
+
+class BudgetTracker:
+    """Счетчики расходов по категориям для месячных бюджетов.
+    
+    spent[название][валюта] — фактические расходы текущего месяца month,
+    previous — прошлого, upcoming[месяц][название][валюта] — операции,
+    датированные следующими месяцами; суммы, как в Rollups, — целые единицы. Как и Balances, меняются по одной
+    операции; при смене месяца счетчики сдвигаются (текущие становятся
+    прошлыми, следующий месяц берется из upcoming), а не пересчитываются.
+    """
+    
+    WARNING_SHARE = 0.8
+    
+    def __init__(self, month):
+        self.month = month
+        self.spent = {}
+        self.previous = {}
+        self.upcoming = {}
+    
+    def add(self, op, sign=1):
+        if op.get('is_pending', False) or op['type'] != 'expense':
+            return
+        self.add_units(str(op['datetime'])[:7], op['name'], op['currency'], sign * exact_units(op['amount']))
+        
+    def add_units(self, month, name, currency, units):
+        if month == self.month:
+            Rollups._shift(self.spent, (name,), currency, units)
+        elif month == shift_month(self.month, -1):
+            Rollups._shift(self.previous, (name,), currency, units)
+        elif month > self.month:
+            Rollups._shift(self.upcoming, (month, name), currency, units)
+    
+    def remove(self, op):
+        self.add(op, sign=-1)
+    
+    def add_many(self, operations):
+        for op in operations:
+            self.add(op)
+    
+    def confirm(self, op):
+        self.add(dict(op, is_pending=False))
+    
+    def unconfirm(self, op):
+        self.remove(dict(op, is_pending=False))
+    
+    def rotate(self, month):
+        """Переходит к месяцу month (не раньше текущего)"""
+        if month <= self.month:
+            return
+        if month == shift_month(self.month, 1):
+            self.previous = self.spent
+        else:
+            self.previous = self.upcoming.get(shift_month(month, -1), {})
+        self.spent = self.upcoming.pop(month, {})
+        self.upcoming = {key: value for key, value in self.upcoming.items() if key > month}
+        self.month = month
+    
+    @classmethod
+    def rebuild(cls, store, month):
+        """Счетчики с нуля по сгруппированным хранилищем строкам (см. rollup_rows)"""
+        tracker = cls(month)
+        previous = shift_month(month, -1)
+        for row_month, name, currency, units in store.rollup_rows()[1]:
+            if row_month >= previous:
+                tracker.add_units(row_month, name, currency, units)
+        return tracker
+    
+    def status(self, budgets, converter):
+        """Строки (название, лимит, потрачено, потрачено в прошлом месяце, валюта,
+        валюты без курса) по бюджетам; суммы — в валюте бюджета по текущим курсам"""
+        rows = []
+        for name, budget in sorted(budgets.items()):
+            spent, missing = converter.total(Rollups.amounts(self.spent.get(name, {})), budget['currency'])
+            previous, previous_missing = converter.total(Rollups.amounts(self.previous.get(name, {})),
+                                                         budget['currency'])
+            rows.append((name, budget['limit'], spent, previous, budget['currency'],
+                         sorted(set(missing) | set(previous_missing))))
+        return rows
+
+
+RECURRENCE_UNITS = ('day', 'week', 'month', 'year')
+
+
+def add_months(moment, months):
+    """Сдвиг на months месяцев; 31-е число в коротком месяце становится последним днем"""
+    year, month = divmod(moment.year * 12 + moment.month - 1 + months, 12)
+    day = min(moment.day, calendar.monthrange(year, month + 1)[1])
+    return moment.replace(year=year, month=month + 1, day=day)
+
+
+def occurrence(rule, number):
+    """Дата number-го повторения правила (0 — первое) в формате '%Y-%m-%d %H:%M:%S'.
+    Считается от начала правила, поэтому 31-е не съезжает на 28-е после февраля."""
+    start = datetime.fromisoformat(rule['start'])
+    steps = number * rule.get('interval', 1)
+    unit = rule['every']
+    if unit == 'day':
+        moment = start + timedelta(days=steps)
+    elif unit == 'week':
+        moment = start + timedelta(weeks=steps)
+    elif unit == 'month':
+        moment = add_months(start, steps)
+    else:
+        moment = add_months(start, 12 * steps)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class RecurringSchedule:
+    """Правила повторяющихся операций и очередь по времени следующего повторения.
+    
+    Правило — словарь: operation (шаблон операции: тип, название, сумма, валюта,
+    комментарий, is_pending), every (день, неделя, месяц, год), interval, start,
+    until (необязательно) и count — сколько повторений уже создано. Очередь —
+    куча (время, id правила), поэтому проверка «что наступило» смотрит только
+    на ее вершину, а не на все правила.
+    """
+    
+    def __init__(self, rules=()):
+        self.rules = {rule['id']: rule for rule in rules}
+        self.queue = []
+        for rule in self.rules.values():
+            self.push(rule)
+        
+    def next_time(self, rule):
+        moment = occurrence(rule, rule['count'])
+        if rule.get('until') and moment > rule['until']:
+            return None
+        return moment
+    
+    def push(self, rule):
+        moment = self.next_time(rule)
+        if moment is not None:
+            heapq.heappush(self.queue, (moment, rule['id']))
+            
+    def add(self, rule):
+        rule['id'] = max(self.rules, default=0) + 1
+        rule.setdefault('count', 0)
+        rule.setdefault('interval', 1)
+        self.rules[rule['id']] = rule
+        self.push(rule)
+        return rule['id']
+    
+    def remove(self, rule_id):
+        # Запись в очереди останется и будет пропущена при извлечении
+        return self.rules.pop(rule_id)
+    
+    def due(self, now):
+        """Операции всех повторений с датой не позже now, по порядку дат.
+        
+        После долгого перерыва здесь окажутся все пропущенные повторения сразу,
+        чтобы добавить их одной пачкой.
+        """
+        operations = []
+        while self.queue and self.queue[0][0] <= now:
+            moment, rule_id = heapq.heappop(self.queue)
+            rule = self.rules.get(rule_id)
+            if rule is None or self.next_time(rule) != moment:
+                continue
+            operations.append(dict(rule['operation'], datetime=moment))
+            rule['count'] += 1
+            self.push(rule)
+        return operations
+    
+    def upcoming(self, rule_id):
+        """Дата следующего повторения правила или None, если повторения закончились"""
+        return self.next_time(self.rules[rule_id])
+
+
+def record_operations(record):
+    """Сколько операций несет запись журнала (для порога снапшота)"""
+    return len(record.get('ops') or record.get('ids') or ()) or 1
+
+
+def apply_journal_record(data, record):
+    """Применяет одну запись журнала к данным.
+    
+    data['operations'] — OperationStore, data['balances'] — сохраненные балансы
+    (Balances или None), которые ведутся параллельно только для сверки.
+    """
+    action = record['a']
+    operations = data['operations']
+    balances = data['balances'] or Balances()
+    
+    if action == 'add':
+        operations.add(record['op'])
+        balances.add(record['op'])
+    elif action == 'add_many':
+        operations.extend(record['ops'])
+        balances.add_many(record['ops'])
+    elif action in ('confirm', 'delete'):
+        # Старые записи журнала ссылались на номер операции, а не на id
+        op_id = record['id'] if 'id' in record else operations.id_at(record['i'])
+        if action == 'confirm':
+            operations.confirm(op_id)
+            balances.confirm(operations.get(op_id))
+        else:
+            balances.remove(operations.delete(op_id))
+    elif action == 'unconfirm':
+        operations.unconfirm(record['id'])
+        balances.unconfirm(operations.get(record['id']))
+    elif action == 'delete_many':
+        for op in operations.delete_many(record['ids']):
+            balances.remove(op)
+    elif action == 'adjust':
+        # Корректировки расхождения (Ledger.add_balance_adjustments): сохраненные
+        # балансы их уже включают. Те же корректировки, добавленные этим процессом
+        # при загрузке того же файла, не повторяются
+        operations.extend([op for op in record['ops'] if op['id'] not in operations])
+    elif action == 'clear':
+        operations.clear()
+        balances.clear()
+    elif action == 'balance':
+        # Старые версии писали в журнал абсолютные значения балансов
+        balances.set(record['k'] == 'pending_currencies', record['c'], record['v'])
+    elif action == 'rate':
+        # Записи старых версий — курс без даты
+        data.setdefault('exchange_rates', {})[record['c']] = record['v']
+    elif action == 'rates':
+        rates = data.setdefault('exchange_rates', {})
+        history = data.setdefault('rate_history', {})
+        for currency, points in record['v'].items():
+            for day, rate in points:
+                record_rate(history, rates, currency, day, rate)
+    elif action == 'set':
+        data[record['k']] = record['v']
+
+
+class FileLock:
+    """Межпроцессная блокировка учета: файл <данные>.lock, занятый через
+    fcntl.flock (msvcrt.locking в Windows). Ждет, пока другой процесс ее отпустит.
+    Повторный вход в том же потоке только увеличивает счетчик depth; другой
+    поток того же процесса (фоновая запись снапшота) ждет на thread_lock.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.depth = 0
+        self._file = None
+        self.thread_lock = threading.RLock()
+        
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if not self.depth:
+            try:
+                f = open(self.path, 'a+b')
+            except OSError:
+                self.thread_lock.release()
+                raise
+            try:
+                if os.name == 'nt':
+                    import msvcrt
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                else:
+                    import fcntl
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            except OSError:
+                f.close()
+                self.thread_lock.release()
+                raise
+            self._file = f
+        self.depth += 1
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if not self.depth:
+            f, self._file = self._file, None
+            if os.name == 'nt':
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            f.close()
+        self.thread_lock.release()
+
+
+class OperationJournal:
+    """Хранилище: снапшот finance_data.json + дописываемый журнал изменений.
+    
+    Каждое изменение — одна компактная строка в журнале, fsync делается пачками.
+    Когда журнал вырастает (см. needs_snapshot), состояние целиком пишется
+    в снапшот (через временный файл и атомарный os.replace), а журнал обнуляется.
+    Номер последней учтенной записи хранится в снапшоте, поэтому падение
+    между заменой снапшота и обнулением журнала не приводит к двойному применению.
+    
+    С одним файлом могут работать несколько процессов: запись идет под file_lock,
+    а changes() отдает то, что другие успели дописать после нас (по смещению
+    в журнале и по номерам записей), или None, если они заменили снапшот.
+    
+    Снапшот можно писать и в фоновом потоке: begin_snapshot запоминает, до
+    какого места журнала дошли данные, finish_snapshot пишет файл без блокировки,
+    а потом под ней заменяет снапшот и вырезает из журнала только учтенную в
+    нем часть — записи, сделанные за это время, остаются в журнале.
+    """
+    
+    # Доля от числа операций в снапшоте, до которой журнал может расти
+    SNAPSHOT_RATIO = 0.5
+    
+    def __init__(self, data_path=DATA_FILE, journal_path=JOURNAL_FILE, sync_every=32, snapshot_every=5000):
+        self.data_path = data_path
+        self.journal_path = journal_path
+        # None — fsync делает только sync() (например, из BackgroundFlusher)
+        self.sync_every = sync_every
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        # Операций в снапшоте и в записях журнала после него
+        self.snapshot_operations = 0
+        self.journal_operations = 0
+        self.unsynced = 0
+        self._file = None
+        # Запись идет из потока окна, fsync — из фонового потока
+        self.lock = threading.RLock()
+        # Другие процессы с тем же файлом: блокировка и то, что мы уже прочитали
+        self.file_lock = FileLock(data_path + '.lock')
+        self.journal_end = 0
+        self.snapshot_stamp = None
+        # Фоновые снапшоты: сколько еще не дописано, сколько байт уже вырезано
+        # из начала журнала и номер загрузки (после нее начатые снапшоты устарели)
+        self.snapshot_jobs = 0
+        self.journal_cut = 0
+        self.generation = 0
+        
+    def load(self):
+        """Читает снапшот и доигрывает поверх него хвост журнала.
+        
+        Операции возвращаются в data['operations'] уже в виде OperationStore,
+        сохраненные в файле балансы — в data['balances'] (None, если их не было).
+        """
+        with self.file_lock:
+            data = self.read_snapshot()
+            self.snapshot_stamp = self.stamp()
+            self.seq = data.pop('journal_seq', 0)
+            self.snapshot_operations = len(data['operations'])
+            self.journal_operations = 0
+            self.journal_end = 0
+            self.journal_cut = 0
+            self.generation += 1
+            data['balances'] = None
+            if 'currencies' in data or 'pending_currencies' in data:
+                data['balances'] = Balances(data.pop('currencies', None), data.pop('pending_currencies', None))
+            for record in self.read_journal():
+                apply_journal_record(data, record)
+        return data
+    
+    def read_journal(self):
+        """Записи журнала после journal_end с номерами больше seq (по одной, без
+        чтения всего журнала в память). Вызывается под file_lock."""
+        if not os.path.exists(self.journal_path):
+            return
+        good_end = self.journal_end
+        torn = False
+        with open(self.journal_path, 'rb') as f:
+            f.seek(good_end)
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    torn = True
+                    break
+                if not line.endswith(b'\n'):
+                    torn = True
+                    break
+                good_end += len(line)
+                if record['n'] <= self.seq:
+                    continue
+                self.seq = record['n']
+                self.journal_operations += record_operations(record)
+                yield record
+        
+        # Оборванную при падении запись отрезаем, иначе следующая склеится с ней
+        if torn:
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good_end)
+        self.journal_end = good_end
+        
+    def stamp(self):
+        """Отметка снапшота: по ней видно, что его заменил другой процесс"""
+        try:
+            info = os.stat(self.data_path)
+        except FileNotFoundError:
+            return None
+        return info.st_mtime_ns, info.st_size, info.st_ino
+    
+    def changed(self):
+        """Дописал ли кто-то журнал или заменил снапшот (без блокировки, только stat)"""
+        if self.stamp() != self.snapshot_stamp:
+            return True
+        try:
+            return os.path.getsize(self.journal_path) != self.journal_end
+        except FileNotFoundError:
+            return self.journal_end != 0
+    
+    def position(self):
+        """Что сейчас на диске: отметка снапшота и длина журнала — метка для
+        кэша итогов (см. Ledger.save_summary)"""
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            journal_size = 0
+        stamp = self.stamp()
+        return [list(stamp) if stamp else None, journal_size]
+    
+    def changes(self):
+        """Записи других процессов после наших или None, если они заменили снапшот
+        и данные нужно загрузить заново. Вызывается под file_lock."""
+        if self.stamp() != self.snapshot_stamp:
+            return None
+        try:
+            if os.path.getsize(self.journal_path) < self.journal_end:
+                return None
+        except FileNotFoundError:
+            return None if self.journal_end else []
+        return list(self.read_journal())
+    
+    def read_snapshot(self):
+        """Содержимое снапшота; операции — уже в виде OperationStore"""
+        data = {}
+        if os.path.exists(self.data_path):
+            with open(self.data_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        data['operations'] = OperationStore(data.get('operations', []))
+        return data
+    
+    def write_snapshot(self, data, path):
+        data = dict(data, operations=[dict(op) for op in data['operations']])
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def write(self, records, defer=False):
+        """Дописывает записи в журнал; False — журнал вырос и пора делать снапшот
+        (defer — снапшот сделают позже, см. Ledger.bulk). Записи попадают в журнал
+        и тогда: фоновый снапшот может не дописаться, а изменение не должно
+        жить только в памяти до его конца"""
+        for record in records:
+            self.append(record)
+        return defer or not self.needs_snapshot()
+    
+    def append(self, record):
+        with self.lock:
+            if self._file is None:
+                self._file = open(self.journal_path, 'a', encoding='utf-8')
+            self.seq += 1
+            record['n'] = self.seq
+            self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+            self._file.flush()
+            self.journal_end = self._file.tell()
+            self.unsynced += 1
+            self.journal_operations += record_operations(record)
+            if self.sync_every and self.unsynced >= self.sync_every:
+                self.sync()
+    
+    def sync(self):
+        """fsync журнала; возвращает True, если было что сбрасывать"""
+        with self.lock:
+            if self._file is None or not self.unsynced:
+                return False
+            os.fsync(self._file.fileno())
+            self.unsynced = 0
+            return True
+    
+    def needs_snapshot(self):
+        """Журнал пора свернуть в снапшот: в нем не меньше snapshot_every операций
+        и не меньше доли SNAPSHOT_RATIO от снапшота. Считаются операции, а не
+        записи — одна запись пачки несет тысячи; порог от размера снапшота не дает
+        большому импорту переписывать весь учет после каждой пачки"""
+        # Пока фоновый снапшот пишется, журнал растет, но второй по порогу не нужен
+        if self.snapshot_jobs:
+            return False
+        return self.journal_operations >= max(self.snapshot_every, self.snapshot_operations * self.SNAPSHOT_RATIO)
+    
+    def snapshot(self, data):
+        """Атомарно записывает полное состояние и начинает журнал заново"""
+        tmp_path = self.data_path + '.tmp'
+        self.write_snapshot(dict(data, journal_seq=self.seq), tmp_path)
+        os.replace(tmp_path, self.data_path)
+        self.snapshot_stamp = self.stamp()
+        self.snapshot_operations = len(data['operations'])
+        
+        with self.lock:
+            self.close()
+            with open(self.journal_path, 'w', encoding='utf-8'):
+                pass
+            self.journal_operations = 0
+            self.journal_end = 0
+            self.journal_cut = 0
+            self.generation += 1
+    
+    def begin_snapshot(self, data):
+        """Начало фонового снапшота (под file_lock): данные data (уже копия,
+        см. Ledger.snapshot_data) и место журнала, до которого они дошли.
+        Возвращает задание для finish_snapshot."""
+        with self.lock:
+            self.snapshot_jobs += 1
+            return {'data': dict(data, journal_seq=self.seq), 'seq': self.seq,
+                    'end': self.journal_cut + self.journal_end, 'operations': self.journal_operations,
+                    'generation': self.generation}
+    
+    def finish_snapshot(self, job):
+        """Вторая половина фонового снапшота, в рабочем потоке. Файл пишется без
+        блокировки; если тем временем данные загружены заново или снапшот
+        заменил другой процесс, записанное выбрасывается (False) — журнал
+        по-прежнему полный. Задания выполняются в порядке begin_snapshot."""
+        tmp_path = f'{self.data_path}.{os.getpid()}.tmp'
+        try:
+            self.write_snapshot(job['data'], tmp_path)
+            with self.file_lock, self.lock:
+                if job['generation'] != self.generation or self.stamp() != self.snapshot_stamp:
+                    return False
+                os.replace(tmp_path, self.data_path)
+                self.snapshot_stamp = self.stamp()
+                self.close()
+                cut = job['end'] - self.journal_cut
+                if cut:
+                    self.cut_journal(cut)
+                self.journal_cut += cut
+                self.journal_end -= cut
+                self.snapshot_operations = len(job['data']['operations'])
+                self.journal_operations -= job['operations']
+                return True
+        finally:
+            with self.lock:
+                self.snapshot_jobs -= 1
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def cut_journal(self, size):
+        """Убирает из начала журнала size байт — записи, которые уже есть в снапшоте.
+        Падение до замены журнала не страшно: старые записи отсеются по номерам."""
+        tmp_path = self.journal_path + '.tmp'
+        with open(self.journal_path, 'rb') as source, open(tmp_path, 'wb') as target:
+            source.seek(size)
+            shutil.copyfileobj(source, target)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(tmp_path, self.journal_path)
+    
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+
+
+class BackgroundFlusher:
+    """Фоновый поток, который сбрасывает журнал на диск (fsync) вне потока окна.
+    
+    request() только ставит флажок; поток ждет не дольше delay секунд, так что
+    частые изменения сливаются в один fsync. stop() делает последний сброс.
+    """
+    
+    def __init__(self, storage, delay=1.0):
+        self.storage = storage
+        self.delay = delay
+        self.requests = 0
+        self.flushes = 0
+        self.inline_sync_every = None
+        self.requested = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='finance-flush', daemon=True)
+        
+    def start(self):
+        # Пока поток жив, fsync в потоке окна не нужен
+        self.inline_sync_every = getattr(self.storage, 'sync_every', None)
+        self.storage.sync_every = None
+        self.thread.start()
+        
+    def request(self):
+        self.requests += 1
+        self.requested.set()
+        
+    def run(self):
+        while not self.stopping.is_set():
+            self.requested.wait()
+            self.stopping.wait(self.delay)
+            self.requested.clear()
+            if self.storage.sync():
+                self.flushes += 1
+            
+    def stop(self):
+        if self.thread.is_alive():
+            self.stopping.set()
+            self.requested.set()
+            self.thread.join()
+            self.storage.sync_every = self.inline_sync_every
+        if self.storage.sync():
+            self.flushes += 1
+
+
+def default_data_path(directory=''):
+    """База SQLite или двоичный снапшот, если они уже созданы (finance_cli.py migrate
+    или convert), иначе JSON; directory — папка учета (см. finance_ledgers)"""
+    for path in (SQLITE_FILE, BINARY_FILE):
+        path = os.path.join(directory, path)
+        if os.path.exists(path):
+            return path
+    return os.path.join(directory, DATA_FILE)
+
+
+def open_storage(data_path):
+    """Хранилище по расширению файла: SQLite для .sqlite/.db, двоичный снапшот для .bin,
+    иначе JSON; у двух последних — общий журнал изменений.
+    
+    У всех один набор методов: load, write, sync, snapshot, close.
+    """
+    base_path, extension = os.path.splitext(data_path)
+    if extension.lower() in SQLITE_EXTENSIONS:
+        from finance_sqlite import SqliteStorage
+        return SqliteStorage(data_path)
+    if extension.lower() in BINARY_EXTENSIONS:
+        # Свой журнал, чтобы не пересечься с JSON-снапшотом того же имени
+        from finance_binary import BinaryJournal
+        return BinaryJournal(data_path, data_path + '.journal')
+    journal_path = JOURNAL_FILE if data_path == DATA_FILE else base_path + '.journal'
+    return OperationJournal(data_path, journal_path)
+
+
+OPERATION_FIELDS = ('type', 'name', 'amount', 'currency', 'comment', 'datetime', 'is_pending')
+TRUE_STRINGS = {'1', 'true', 'yes', 'y', 'да', 'истина'}
+
+
+def now_string():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def parse_amount(value):
+    """Число из строки выписки: '1 234,50', '-350.00', '1\xa0000' и т.п."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value or '').replace('\xa0', '').replace(' ', '').replace(',', '.')
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError(f'сумма не число: {value!r}') from None
+
+
+def normalize_operation(row):
+    """Приводит строку импорта (словарь из JSON или CSV) к формату операции.
+    
+    Проверяет тип, сумму, валюту и дату; при ошибке бросает ValueError с понятным текстом.
+    """
+    op_type = str(row.get('type', '')).strip().lower()
+    if op_type not in ('income', 'expense'):
+        raise ValueError(f'неизвестный тип операции: {row.get("type")!r}')
+    
+    amount = parse_amount(row.get('amount'))
+    if not amount > 0:
+        raise ValueError(f'сумма должна быть положительной: {row.get("amount")!r}')
+    
+    currency = str(row.get('currency', '')).strip().upper()
+    if not currency:
+        raise ValueError('не указана валюта')
+    
+    moment = str(row.get('datetime') or '').strip() or now_string()
+    try:
+        moment = datetime.fromisoformat(moment).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise ValueError(f'дата не распознана: {row.get("datetime")!r}') from None
+    
+    is_pending = row.get('is_pending', False)
+    if isinstance(is_pending, str):
+        is_pending = is_pending.strip().lower() in TRUE_STRINGS
+    
+    return {
+        'type': op_type,
+        'name': str(row.get('name') or '').strip() or 'Другое',
+        'amount': amount,
+        'currency': currency,
+        'comment': str(row.get('comment') or ''),
+        'datetime': moment,
+        'is_pending': bool(is_pending)
+    }
+
+
+class UndoHistory:
+    """Ограниченные стеки отмены и повтора изменений операций.
+    
+    Команда — название и список шагов (функция, аргументы, освобождение),
+    которые ее отменяют. Шаги хранят только то, что нужно для обратного
+    действия (id, удаленные операции, отданные detach колонки), поэтому память
+    растет с размером изменения, а не журнала. Обратное действие само
+    записывает свою отмену — она и становится командой на другом стеке.
+    """
+    
+    LIMIT = 100
+    
+    def __init__(self, limit=LIMIT):
+        self.limit = limit
+        self.done = deque()
+        self.undone = []
+        self.group = None
+        
+    def record(self, title, function, *args, release=None):
+        """Записывает отмену только что сделанного изменения"""
+        step = (function, args, release)
+        if self.group is not None:
+            self.group['steps'].insert(0, step)
+            return
+        self.push({'title': title, 'steps': [step]})
+        
+    @contextmanager
+    def grouped(self, title):
+        """Изменения внутри блока отменяются одной командой (например, импорт пачками)"""
+        if self.group is not None:
+            yield
+            return
+        self.group = {'title': title, 'steps': []}
+        try:
+            yield
+        finally:
+            command, self.group = self.group, None
+            if command['steps']:
+                self.push(command)
+                
+    def push(self, command):
+        self.done.append(command)
+        if len(self.done) > self.limit:
+            self.release(self.done.popleft())
+        while self.undone:
+            self.release(self.undone.pop())
+            
+    def release(self, command):
+        for _, args, release in command['steps']:
+            if release is not None:
+                release(*args)
+                
+    def replay(self, command):
+        """Выполняет шаги команды и возвращает записанную ими обратную команду"""
+        self.group = {'title': command['title'], 'steps': []}
+        try:
+            for function, args, _ in command['steps']:
+                function(*args)
+        finally:
+            inverse, self.group = self.group, None
+        return inverse
+    
+    def undo(self):
+        """Отменяет последнюю команду; возвращает ее название или None"""
+        if not self.done:
+            return None
+        command = self.done.pop()
+        self.undone.append(self.replay(command))
+        return command['title']
+    
+    def redo(self):
+        if not self.undone:
+            return None
+        command = self.undone.pop()
+        self.done.append(self.replay(command))
+        return command['title']
+    
+    def titles(self):
+        """Названия команд, которые сейчас отменит undo и повторит redo"""
+        return (self.done[-1]['title'] if self.done else None,
+                self.undone[-1]['title'] if self.undone else None)
+    
+    def clear(self):
+        """Забывает все команды (данные загружены заново, старые шаги к ним не подходят)"""
+        for commands in (self.done, self.undone):
+            while commands:
+                self.release(commands.pop())
+
+
+class Ledger:
+    """Учет без GUI: операции, балансы, настройки и их хранение.
+    
+    Каждое изменение сразу попадает в хранилище (журнал JSON или SQLite).
+    Окно приложения и командная строка работают с данными только через этот класс.
+    """
+    
+    def __init__(self, data_path=None):
+        data_path = data_path or default_data_path()
+        if data_path == DATA_FILE:
+            self.summary_path = SUMMARY_FILE
+        else:
+            self.summary_path = os.path.splitext(data_path)[0] + '.summary.json'
+        self.storage = open_storage(data_path)
+        
+        self.operations = OperationStore()
+        self.balances = Balances()
+        self.base_currency = 'RUB'
+        self.exchange_rates = {
+            'USD': 90.0,
+            'EUR': 100.0,
+            'RUB': 1.0,
+            'KZT': 0.2,
+            'UAH': 2.3,
+            'BYN': 28.0
+        }
+        self.rate_history = {}
+        self.pending_rates = {}
+        self.recurring = []
+        self.schedule = None
+        self.budgets = {}
+        self.budget_tracker = None
+        self.predefined_expense_names = ['Ашан', 'Аптека', 'Вайлдберриз', 'Магнит', 'Пятерочка', 'Такси', 'Кафе', 'Другое']
+        self.predefined_income_names = ['Зарплата', 'Фриланс', 'Инвестиции', 'Подарок', 'Возврат долга', 'Другое']
+        self.converter = None
+        self.rollups = None
+        self.history = UndoHistory()
+        self.settings_dirty = False
+        # Корректировки балансов, найденные при загрузке и еще не записанные
+        self.unsaved_adjustments = None
+        # Вложенность bulk(): пока больше нуля, снапшот по порогу журнала откладывается
+        self.bulk_depth = 0
+        self.loaded = False
+        # Изменения из других процессов, подхваченные с последнего refresh()
+        self.outside_changes = False
+        # background(функция, *аргументы, done=...) ставит запись снапшота в очередь
+        # рабочего потока (см. snapshot), done(результат) вызывается потом в потоке
+        # учета; None — писать сразу
+        self.background = None
+        
+    def load(self):
+        with self.storage.file_lock:
+            self._load()
+        
+    def _load(self):
+        data = self.storage.load()
+        self.loaded = True
+        self.operations = data['operations']
+        self.base_currency = data.get('base_currency', 'RUB')
+        self.exchange_rates = data.get('exchange_rates', self.exchange_rates)
+        self.rate_history = data.get('rate_history', {})
+        self.recurring = data.get('recurring', [])
+        self.schedule = None
+        self.budgets = data.get('budgets', {})
+        self.budget_tracker = None
+        self.predefined_expense_names = data.get('predefined_expense_names', self.predefined_expense_names)
+        self.predefined_income_names = data.get('predefined_income_names', self.predefined_income_names)
+        self.converter = None
+        self.rollups = None
+        self.history.clear()
+        
+        # Балансы всегда выводятся из операций; сохраненные служат только для сверки
+        self.balances = self.operations.balances()
+        self.unsaved_adjustments = None
+        if data['balances'] is not None:
+            differences = data['balances'].differences(self.balances)
+            if differences:
+                self.add_balance_adjustments(differences)
+    
+    def add_balance_adjustments(self, differences):
+        """Переносит расхождение сохраненных балансов с операциями в корректирующие операции.
+        
+        Старые версии хранили балансы отдельно от операций, и они могли разойтись.
+        Чтобы показанные пользователю суммы не изменились, разница становится
+        явными операциями — доходом или расходом по знаку, датой не позже самой
+        ранней операции, чтобы не попасть в текущие бюджеты и аналитику. Загрузка
+        ничего не пишет: корректировки уходят на диск с первым настоящим
+        изменением (см. save), а просто прочитанный учет остается как был.
+        """
+        moment = format_timestamp(min(self.operations.timestamps)) if len(self.operations) else now_string()
+        operations = []
+        for (kind, currency), (stored, derived) in sorted(differences.items()):
+            digits = self.operations.digits(currency)
+            # Расхождение меньше копейки — погрешность float в старом файле, а не деньги
+            step = 10 ** (MAX_MINOR_UNITS - digits)
+            minor, rest = divmod(abs(stored - derived), step)
+            minor += 2 * rest >= step
+            if not minor:
+                continue
+            delta = minor / 10 ** digits if stored > derived else -minor / 10 ** digits
+            operations.append({
+                'type': 'income' if delta > 0 else 'expense',
+                'name': 'Корректировка баланса',
+                'amount': abs(delta),
+                'currency': currency,
+                'comment': f'Баланс в файле расходился с операциями на {delta:+.{digits}f} {currency}',
+                'datetime': moment,
+                'is_pending': kind == 'pending'
+            })
+        if operations:
+            self.operations.extend(operations)
+            self.balances.add_many(operations)
+            self.unsaved_adjustments = operations
+        
+    @contextmanager
+    def exclusive(self):
+        """Изменение под блокировкой файла данных. Перед ним доигрываются изменения,
+        которые тот же учет получил из другого окна или командной строки, — так
+        ничьи записи не теряются, а новые id не совпадают с чужими."""
+        with self.storage.file_lock as lock:
+            if lock.depth == 1:
+                self.merge_outside_changes()
+            yield
+            
+    def merge_outside_changes(self):
+        records = self.storage.changes()
+        if records == []:
+            return
+        self.outside_changes = True
+        # Отложенные настройки этого окна новее записанных другими
+        kept = {'base_currency': self.base_currency, 'budgets': self.budgets} if self.settings_dirty else {}
+        if records is None:
+            # Другой процесс заменил снапшот: только загрузить заново
+            self.load()
+        else:
+            if any(record['a'] == 'adjust' for record in records):
+                # Те же корректировки уже записал другой процесс
+                self.unsaved_adjustments = None
+            data = {key: getattr(self, key) for key in SETTINGS}
+            data['operations'] = self.operations
+            data['balances'] = self.balances
+            for record in records:
+                apply_journal_record(data, record)
+            for key in SETTINGS:
+                setattr(self, key, data[key])
+            # Производные данные строятся заново при первом обращении, шаги отмены устарели
+            self.schedule = None
+            self.rollups = None
+            self.budget_tracker = None
+            self.history.clear()
+        for key, value in kept.items():
+            setattr(self, key, value)
+        for currency, days in self.pending_rates.items():
+            for day, rate in days.items():
+                record_rate(self.rate_history, self.exchange_rates, currency, day, rate)
+        self.converter = None
+        
+    def refresh(self):
+        """Подхватывает изменения других процессов; True — данные изменились
+        (сейчас или при одном из изменений после прошлого refresh)"""
+        if self.storage.changed():
+            with self.exclusive():
+                pass
+        changed, self.outside_changes = self.outside_changes, False
+        return changed
+    
+    def save(self, *records):
+        """Дописывает изменения в хранилище; без записей или по порогу — делает снапшот"""
+        if records and self.unsaved_adjustments:
+            records = ({'a': 'adjust', 'ops': self.unsaved_adjustments},) + records
+            self.unsaved_adjustments = None
+        if records and self.storage.write(records, defer=self.bulk_depth > 0):
+            return
+        self.snapshot()
+        
+    @contextmanager
+    def bulk(self):
+        """Пакетная запись (импорт): пачки только дописываются в журнал, а снапшот
+        по его порогу делается один раз в конце, а не после каждой пачки"""
+        self.bulk_depth += 1
+        try:
+            yield
+        finally:
+            self.bulk_depth -= 1
+        if not self.bulk_depth and getattr(self.storage, 'needs_snapshot', bool)():
+            self.snapshot()
+    
+    def snapshot(self):
+        """Полное состояние — в хранилище. С заданным background (очередь фоновых
+        задач окна) файл пишется там по копии данных, а журнал до конца записи
+        остается источником истины"""
+        with self.exclusive():
+            # Корректировки попадают в снапшот вместе с остальными операциями
+            self.unsaved_adjustments = None
+            if self.background is None or not hasattr(self.storage, 'begin_snapshot'):
+                self.storage.snapshot(self.snapshot_data())
+            else:
+                job = self.storage.begin_snapshot(self.snapshot_data(frozen=True))
+                self.background(self.storage.finish_snapshot, job, done=self.snapshot_finished)
+            self.save_summary()
+    
+    def snapshot_finished(self, written):
+        """Фоновый снапшот заменил файл и вырезал журнал — место в хранилище
+        сдвинулось, и записанный до этого кэш итогов больше не подходит"""
+        if written and self.loaded:
+            self.save_summary()
+    
+    def snapshot_data(self, frozen=False):
+        """Полное состояние для снапшота: операции и все настройки;
+        frozen — копия, которую можно писать в другом потоке"""
+        if frozen:
+            data = copy.deepcopy({key: value for key, value in self.snapshot_data().items() if key != 'operations'})
+            data['operations'] = self.operations.snapshot_copy()
+            return data
+        return {
+            'operations': self.operations,
+            'currencies': self.balances.actual,
+            'pending_currencies': self.balances.pending,
+            'base_currency': self.base_currency,
+            'exchange_rates': self.exchange_rates,
+            'rate_history': self.rate_history,
+            'recurring': self.recurring,
+            'budgets': self.budgets,
+            'predefined_expense_names': self.predefined_expense_names,
+            'predefined_income_names': self.predefined_income_names
+        }
+    
+    def save_summary(self):
+        """Маленький кэш итогов, чтобы при запуске показать суммы до загрузки операций.
+        
+        Вместе с итогами запоминается место в хранилище, до которого они дошли
+        (storage.position). Если другой процесс уже что-то записал, а мы это еще
+        не подхватили, места нет — такой кэш при чтении не примется.
+        """
+        with self.storage.file_lock:
+            position = None if self.storage.changed() else self.storage.position()
+        summary = {
+            'currencies': self.balances.actual,
+            'pending_currencies': self.balances.pending,
+            'base_currency': self.base_currency,
+            'exchange_rates': self.exchange_rates,
+            'position': position
+        }
+        tmp_path = self.summary_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+        os.replace(tmp_path, self.summary_path)
+        
+    def load_summary(self):
+        """Читает кэш итогов; возвращает False, если его нет, он поврежден или
+        отстал от данных (после него учет менялся, а кэш записать не успели)"""
+        if not os.path.exists(self.summary_path):
+            return False
+        try:
+            with open(self.summary_path, 'r', encoding='utf-8') as f:
+                summary = json.load(f)
+        except ValueError:
+            return False
+        if summary.get('position') is None or summary['position'] != self.storage.position():
+            return False
+        self.balances = Balances(summary.get('currencies'), summary.get('pending_currencies'))
+        self.base_currency = summary.get('base_currency', self.base_currency)
+        self.exchange_rates = summary.get('exchange_rates', self.exchange_rates)
+        self.converter = None
+        return True
+    
+    def sync(self):
+        self.storage.sync()
+    
+    def close(self):
+        self.save_settings()
+        # Кэш итогов нужен и следующему запуску, и сводке по всем учетам;
+        # пишется до закрытия хранилища, пока место в нем можно узнать
+        if self.loaded:
+            self.save_summary()
+        self.storage.close()
+    
+    def add(self, operation):
+        """Добавляет операцию и возвращает ее id"""
+        with self.exclusive():
+            op_id = self.operations.add(operation)
+            self.balances.add(operation)
+            if self.rollups is not None:
+                self.rollups.add(operation)
+            if self.budget_tracker is not None:
+                self.budget_tracker.add(operation)
+            self.save({'a': 'add', 'op': operation})
+            self.history.record('добавление операции', self.delete, op_id)
+            return op_id
+    
+    def add_many(self, operations, *records):
+        """Пакетное добавление: одно обновление индексов и одна запись в журнал
+        (records — изменения, которые должны попасть на диск вместе с ней)"""
+        with self.exclusive():
+            operations = list(operations)
+            self.operations.extend(operations)
+            self.balances.add_many(operations)
+            if self.rollups is not None:
+                self.rollups.add_many(operations)
+            if self.budget_tracker is not None:
+                self.budget_tracker.add_many(operations)
+            self.save({'a': 'add_many', 'ops': operations}, *records)
+            ids = [operation['id'] for operation in operations]
+            self.history.record('добавление операций', self.delete_many, ids)
+            return ids
+    
+    def confirm(self, op_id):
+        """Подтверждает ожидаемую операцию, возвращает ее строку среди фактических"""
+        with self.exclusive():
+            position = self.operations.confirm(op_id)
+            operation = self.operations.get(op_id)
+            self.balances.confirm(operation)
+            if self.rollups is not None:
+                self.rollups.confirm(operation)
+            if self.budget_tracker is not None:
+                self.budget_tracker.confirm(operation)
+            self.save({'a': 'confirm', 'id': op_id})
+            self.history.record('подтверждение операции', self.unconfirm, op_id)
+            return position
+    
+    def unconfirm(self, op_id):
+        """Обратное confirm: операция снова ожидаемая"""
+        with self.exclusive():
+            position = self.operations.unconfirm(op_id)
+            operation = self.operations.get(op_id)
+            self.balances.unconfirm(operation)
+            if self.rollups is not None:
+                self.rollups.unconfirm(operation)
+            if self.budget_tracker is not None:
+                self.budget_tracker.unconfirm(operation)
+            self.save({'a': 'unconfirm', 'id': op_id})
+            self.history.record('подтверждение операции', self.confirm, op_id)
+            return position
+    
+    def delete(self, op_id):
+        with self.exclusive():
+            op = self.operations.delete(op_id)
+            self.balances.remove(op)
+            if self.rollups is not None:
+                self.rollups.remove(op)
+            if self.budget_tracker is not None:
+                self.budget_tracker.remove(op)
+            self.save({'a': 'delete', 'id': op_id})
+            self.history.record('удаление операции', self.add, op)
+            return op
+    
+    def delete_many(self, op_ids):
+        """Пакетное удаление одной записью в журнал; возвращает удаленные операции"""
+        with self.exclusive():
+            operations = self.operations.delete_many(op_ids)
+            for op in operations:
+                self.balances.remove(op)
+                if self.rollups is not None:
+                    self.rollups.remove(op)
+                if self.budget_tracker is not None:
+                    self.budget_tracker.remove(op)
+            self.save({'a': 'delete_many', 'ids': [op['id'] for op in operations]})
+            self.history.record('удаление операций', self.add_many, operations)
+            return operations
+    
+    def clear(self):
+        """Удаляет все операции. Колонки и итоги не копируются, а откладываются
+        для отмены (см. OperationStore.detach)"""
+        with self.exclusive():
+            saved = (self.operations.detach(), self.balances, self.rollups, self.budget_tracker)
+            self.balances = Balances()
+            if self.rollups is not None:
+                self.rollups = Rollups()
+            if self.budget_tracker is not None:
+                self.budget_tracker = BudgetTracker(self.budget_tracker.month)
+            self.save({'a': 'clear'})
+            self.history.record('удаление всех операций', self.restore, saved, release=self.release_cleared)
+        
+    def restore(self, saved):
+        """Отмена clear: возвращает отложенные операции и итоги"""
+        with self.exclusive():
+            detached, self.balances, self.rollups, self.budget_tracker = saved
+            self.operations.attach(detached)
+            # Одной записью журнала всю историю не описать — состояние пишется снапшотом
+            self.snapshot()
+            self.history.record('удаление всех операций', self.clear)
+        
+    def release_cleared(self, saved):
+        self.operations.discard(saved[0])
+        
+    def undo(self):
+        """Отменяет последнее изменение операций; возвращает его название или None"""
+        with self.exclusive():
+            return self.history.undo()
+    
+    def redo(self):
+        with self.exclusive():
+            return self.history.redo()
+        
+    def set_base_currency(self, currency, defer=False):
+        """defer=True — только в памяти, на диск попадет при save_settings()"""
+        with self.exclusive():
+            self.base_currency = currency
+            if defer:
+                self.settings_dirty = True
+            else:
+                self.save({'a': 'set', 'k': 'base_currency', 'v': currency})
+        
+    def set_rate(self, currency, rate, defer=False, day=None):
+        """Курс с даты day (по умолчанию сегодня); операции до нее считаются по прежним курсам"""
+        with self.exclusive():
+            points = [[day or date.today().isoformat(), rate]]
+            # Первое изменение курса без истории: прежний курс остается у всех более ранних операций
+            previous = self.exchange_rates.get(currency)
+            if currency not in self.rate_history and previous is not None and previous != rate:
+                points.insert(0, [RATES_START, previous])
+            for point_day, point_rate in points:
+                record_rate(self.rate_history, self.exchange_rates, currency, point_day, point_rate)
+            self.converter = None
+            if defer:
+                self.pending_rates.setdefault(currency, {}).update(points)
+                self.settings_dirty = True
+            else:
+                self.save({'a': 'rates', 'v': {currency: points}})
+            
+    def add_rates(self, points):
+        """Пакет курсов по датам [(день, валюта, курс), ...] одной записью в журнал"""
+        with self.exclusive():
+            added = {}
+            for day, currency, rate in points:
+                record_rate(self.rate_history, self.exchange_rates, currency, day, rate)
+                added.setdefault(currency, []).append([day, rate])
+            self.converter = None
+            if added:
+                self.save({'a': 'rates', 'v': added})
+            return sum(len(values) for values in added.values())
+            
+    def save_settings(self):
+        """Записывает отложенные изменения настроек не больше чем тремя записями,
+        сколько бы раз их ни меняли: основная валюта, бюджеты и последние курсы по дням"""
+        if not self.settings_dirty:
+            return False
+        with self.exclusive():
+            self.settings_dirty = False
+            records = [{'a': 'set', 'k': 'base_currency', 'v': self.base_currency}, self.budgets_record()]
+            if self.pending_rates:
+                records.append({'a': 'rates', 'v': {currency: sorted([day, rate] for day, rate in days.items())
+                                                    for currency, days in self.pending_rates.items()}})
+            self.pending_rates = {}
+            self.save(*records)
+            return True
+    
+    def get_converter(self):
+        if self.converter is None:
+            self.converter = CurrencyConverter(self.exchange_rates, history=self.rate_history)
+        return self.converter
+    
+    def get_schedule(self):
+        if self.schedule is None:
+            self.schedule = RecurringSchedule(self.recurring)
+        return self.schedule
+    
+    def recurring_record(self):
+        return {'a': 'set', 'k': 'recurring', 'v': self.recurring}
+    
+    def add_recurring(self, operation, every, interval=1, start=None, until=None, created=1):
+        """Правило повторения по образцу operation; возвращает его id.
+        
+        start — дата первого повторения (по умолчанию дата самой операции),
+        created — сколько повторений уже есть (1: сама operation уже добавлена).
+        """
+        with self.exclusive():
+            if every not in RECURRENCE_UNITS:
+                raise ValueError(f'неизвестный период повторения: {every!r}')
+            rule = {
+                'operation': {field: operation[field] for field in OPERATION_FIELDS if field != 'datetime'},
+                'every': every,
+                'interval': interval,
+                'start': start or operation['datetime'],
+                'count': created
+            }
+            if until:
+                rule['until'] = until
+            rule_id = self.get_schedule().add(rule)
+            self.recurring.append(rule)
+            self.save(self.recurring_record())
+            return rule_id
+    
+    def remove_recurring(self, rule_id):
+        """Удаляет правило; уже созданные по нему операции остаются"""
+        with self.exclusive():
+            rule = self.get_schedule().remove(rule_id)
+            self.recurring.remove(rule)
+            self.save(self.recurring_record())
+        
+    def run_schedule(self, now=None):
+        """Добавляет все наступившие повторения одной пачкой вместе с новыми счетчиками правил"""
+        with self.exclusive():
+            operations = self.get_schedule().due(now or now_string())
+            if operations:
+                self.add_many(operations, self.recurring_record())
+            return operations
+    
+    def prepare(self):
+        """Строит производные данные заранее — итоги по периодам, счетчики
+        бюджетов, индекс поиска, — чтобы после загрузки в рабочем потоке
+        окно получило учет готовым"""
+        self.get_rollups()
+        self.get_budget_tracker()
+        self.operations.prepare_search()
+        
+    def get_rollups(self):
+        """Итоги по периодам для аналитики; считаются при первом обращении"""
+        if self.rollups is None:
+            self.rollups = Rollups.rebuild(self.operations)
+        return self.rollups
+    
+    def set_budget(self, name, limit, currency=None, defer=False):
+        """Месячный лимит расходов категории name (в currency, по умолчанию основной);
+        limit 0 или None снимает бюджет. defer=True — на диск при save_settings()"""
+        with self.exclusive():
+            if limit:
+                self.budgets[name] = {'limit': limit, 'currency': currency or self.base_currency}
+            else:
+                self.budgets.pop(name, None)
+            if defer:
+                self.settings_dirty = True
+            else:
+                self.save(self.budgets_record())
+            
+    def budgets_record(self):
+        return {'a': 'set', 'k': 'budgets', 'v': self.budgets}
+    
+    def get_budget_tracker(self, month=None):
+        """Счетчики бюджетов, сдвинутые на текущий (или указанный) месяц;
+        строятся при первом обращении"""
+        month = month or now_string()[:7]
+        if self.budget_tracker is None:
+            self.budget_tracker = BudgetTracker.rebuild(self.operations, month)
+        else:
+            self.budget_tracker.rotate(month)
+        return self.budget_tracker
+    
+    def budget_status(self, month=None):
+        """Состояние каждого бюджета, см. BudgetTracker.status"""
+        return self.get_budget_tracker(month).status(self.budgets, self.get_converter())
+    
+    def total(self, balances, currency=None):
+        """Сумма словаря балансов в основной (или указанной) валюте и валюты без курса"""
+        return self.get_converter().total(balances, currency or self.base_currency)
+    
+    def totals(self, by='currency', pending=None, currency=None, historical=False, interpolate=False):
+        """Итоги по группам операций в основной (или указанной) валюте;
+        historical — по курсам на дату каждой операции"""
+        return self.operations.totals(self.get_converter(), currency or self.base_currency, by, pending,
+                                      historical, interpolate)
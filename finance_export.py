@@ -0,0 +1,329 @@
+"""Потоковая выгрузка операций (CSV, XLSX, JSON, JSON Lines) и месячного отчета.
+
+Операции берутся из хранилища пачками (OperationStore.chunks или
+SqliteOperations.chunks): фильтры по датам, типу, валюте и признаку
+ожидаемой операции отбирают строки еще в колонках или в WHERE, словари
+создаются только для текущей пачки, и она сразу дописывается в файл.
+Поэтому память не зависит от числа операций, а ход выгрузки виден по
+ExportStats (строк в секунду).
+
+XLSX пишется без сторонних библиотек: это zip с XML-листами, строки
+в ячейках — inline, без общей таблицы строк, которую пришлось бы держать
+в памяти. На лист помещается XLSX_ROWS строк, дальше начинается новый.
+Файл появляется под своим именем только целиком.
+"""
+import csv
+import json
+import operator
+import os
+import re
+import time
+import zipfile
+from xml.sax.saxutils import escape
+
+from finance_core import OPERATION_FIELDS, parse_timestamp
+
+CHUNK_SIZE = 10000
+FIELDS = ('id',) + OPERATION_FIELDS
+FORMATS = ('.csv', '.xlsx', '.json', '.jsonl')
+# Лимит строк листа Excel, одна строка — заголовок
+XLSX_ROWS = 1048576 - 1
+# Дата в Excel — дни от 1899-12-30, а parse_timestamp считает секунды от 1970-01-01
+EXCEL_EPOCH_DAYS = 25569
+# Сколько разных строк на колонку помнить готовыми ячейками (названия, валюты, типы)
+XLSX_CACHE = 10000
+# Управляющие символы, которых не может быть в XML
+XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+REPORT_FIELDS = ('month', 'currency', 'operations', 'income', 'expense', 'pending', 'net')
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{sheets}</Types>'
+)
+SHEET_TYPE = ('<Override PartName="/xl/worksheets/sheet{number}.xml" '
+              'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>')
+ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/></Relationships>'
+)
+WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets></workbook>'
+)
+WORKBOOK_SHEET = '<sheet name="{name}" sheetId="{number}" r:id="rId{number}"/>'
+WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '{sheets}<Relationship Id="rId{styles}" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/></Relationships>'
+)
+WORKBOOK_SHEET_REL = ('<Relationship Id="rId{number}" '
+                      'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                      'Target="worksheets/sheet{number}.xml"/>')
+# Стиль 1 — дата со временем (встроенный формат 22), стиль 2 — жирный заголовок
+STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '</styleSheet>'
+)
+SHEET_START = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+               '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+SHEET_END = '</sheetData></worksheet>'
+
+
+class ExportStats:
+    """Итог выгрузки: сколько операций прочитано, сколько строк записано и как быстро"""
+    def __init__(self, path):
+        self.path = path
+        self.operations = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.started = time.perf_counter()
+
+    @property
+    def rows_per_second(self):
+        return self.operations / self.seconds if self.seconds else 0.0
+
+    def read(self, chunks, progress=None):
+        """Пачки операций как есть, со счетом; progress(stats) — после каждой"""
+        for chunk in chunks:
+            self.operations += len(chunk)
+            self.seconds = time.perf_counter() - self.started
+            if progress:
+                progress(self)
+            yield chunk
+
+    def summary(self):
+        speed = f'{self.rows_per_second:,.0f}'.replace(',', ' ')
+        return (f'Выгружено в {self.path}: строк {self.rows}, операций {self.operations} '
+                f'за {self.seconds:.2f} с ({speed} строк/с)')
+
+
+def export_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f'выгрузка умеет {", ".join(FORMATS)}, а не {extension or "файл без расширения"}')
+    return extension
+
+
+def xlsx_cell(value, style=0):
+    """Ячейка без адреса (Excel ставит их по порядку): да/нет, число или строка"""
+    style = f' s="{style}"' if style else ''
+    if value is True or value is False:
+        return f'<c t="b"{style}><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c{style}><v>{value!r}</v></c>'
+    text = escape(XML_INVALID.sub('', str(value)))
+    return f'<c t="inlineStr"{style}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def xlsx_cells(values, cache, date=False):
+    """Ячейки одной колонки пачки. Повторяющиеся строки берутся из cache,
+    date — дата 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' числом дней Excel в формате даты"""
+    if date:
+        return [f'<c s="1"><v>{parse_timestamp(value) / 86400 + EXCEL_EPOCH_DAYS!r}</v></c>' for value in values]
+    cells = []
+    for value in values:
+        if isinstance(value, str):
+            cell = cache.get(value)
+            if cell is None:
+                cell = xlsx_cell(value)
+                if len(cache) < XLSX_CACHE:
+                    cache[value] = cell
+        elif value is True or value is False:
+            cell = xlsx_cell(value)
+        else:
+            cell = f'<c><v>{value!r}</v></c>'
+        cells.append(cell)
+    return cells
+
+
+def write_xlsx(path, header, chunks, stats, dates=()):
+    """XLSX из пачек строк-кортежей; dates — номера колонок с датой 'ГГГГ-ММ-ДД ЧЧ:ММ:СС'.
+    Пачка переводится в ячейки по колонкам, а не по одной"""
+    header_row = '<row>' + ''.join(xlsx_cell(name, 2) for name in header) + '</row>'
+    caches = [{} for _ in header]
+    sheets = 0
+    sheet = None
+    rows_in_sheet = XLSX_ROWS
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        try:
+            for chunk in chunks:
+                count = len(chunk)
+                while chunk:
+                    if rows_in_sheet == XLSX_ROWS:
+                        # Лист заполнен (или его еще нет) — начинаем следующий
+                        if sheet is not None:
+                            sheet.write(SHEET_END.encode())
+                            sheet.close()
+                        sheets += 1
+                        sheet = archive.open(f'xl/worksheets/sheet{sheets}.xml', 'w', force_zip64=True)
+                        sheet.write((SHEET_START + header_row).encode('utf-8'))
+                        rows_in_sheet = 0
+                    part, chunk = chunk[:XLSX_ROWS - rows_in_sheet], chunk[XLSX_ROWS - rows_in_sheet:]
+                    columns = [xlsx_cells(values, caches[index], index in dates)
+                               for index, values in enumerate(zip(*part))]
+                    rows = ''.join('<row>' + ''.join(cells) + '</row>' for cells in zip(*columns))
+                    sheet.write(rows.encode('utf-8'))
+                    rows_in_sheet += len(part)
+                stats.rows += count
+            if sheet is None:
+                sheets = 1
+                sheet = archive.open('xl/worksheets/sheet1.xml', 'w')
+                sheet.write((SHEET_START + header_row).encode('utf-8'))
+            sheet.write(SHEET_END.encode())
+        finally:
+            if sheet is not None:
+                sheet.close()
+        numbers = range(1, sheets + 1)
+        names = ['Лист' if sheets == 1 else f'Лист {number}' for number in numbers]
+        archive.writestr('[Content_Types].xml',
+                         CONTENT_TYPES.format(sheets=''.join(SHEET_TYPE.format(number=n) for n in numbers)))
+        archive.writestr('_rels/.rels', ROOT_RELS)
+        archive.writestr('xl/workbook.xml', WORKBOOK.format(sheets=''.join(
+            WORKBOOK_SHEET.format(name=name, number=n) for n, name in zip(numbers, names))))
+        archive.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS.format(
+            sheets=''.join(WORKBOOK_SHEET_REL.format(number=n) for n in numbers), styles=sheets + 1))
+        archive.writestr('xl/styles.xml', STYLES)
+
+
+def write_csv(path, header, chunks, stats):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            stats.rows += len(chunk)
+
+
+def write_json(path, chunks, stats, lines=False):
+    """JSON — тот же вид, что у json.dump(список, indent=2), но по пачкам;
+    JSON Lines — объект в строке (его понимает импорт)"""
+    with open(path, 'w', encoding='utf-8') as f:
+        if not lines:
+            f.write('[')
+        separator = '\n'
+        for chunk in chunks:
+            if lines:
+                f.write(''.join(json.dumps(op, ensure_ascii=False) + '\n' for op in chunk))
+            else:
+                for op in chunk:
+                    f.write(separator + '  ' + json.dumps(op, ensure_ascii=False, indent=2).replace('\n', '\n  '))
+                    separator = ',\n'
+            stats.rows += len(chunk)
+        if not lines:
+            f.write('\n]' if stats.rows else ']')
+
+
+def write_file(path, write):
+    """write(временный файл), затем переименование в path: недописанного файла не остается"""
+    tmp_path = path + '.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def export_operations(ledger, path, chunk_size=CHUNK_SIZE, progress=None, pending=None, **filters):
+    """Выгружает операции (фильтры — как у filtered_ids) в CSV, XLSX, JSON или
+    JSON Lines по расширению path. progress(stats) вызывается после каждой пачки."""
+    extension = export_format(path)
+    stats = ExportStats(path)
+    chunks = stats.read(ledger.operations.chunks(chunk_size, pending, **filters), progress)
+    row = operator.itemgetter(*FIELDS)
+    rows = (list(map(row, chunk)) for chunk in chunks)
+    if extension == '.xlsx':
+        date_column = FIELDS.index('datetime')
+        write_file(path, lambda tmp_path: write_xlsx(tmp_path, FIELDS, rows, stats, [date_column]))
+    elif extension == '.csv':
+        write_file(path, lambda tmp_path: write_csv(tmp_path, FIELDS, rows, stats))
+    else:
+        write_file(path, lambda tmp_path: write_json(tmp_path, chunks, stats, extension == '.jsonl'))
+    stats.seconds = time.perf_counter() - stats.started
+    return stats
+
+
+def monthly_report(ledger, chunk_size=CHUNK_SIZE, stats=None, pending=None, progress=None, **filters):
+    """Итоги по месяцам и валютам одним проходом по операциям: строки
+    (месяц, валюта, операций, доходы, расходы, ожидается, итог), а если
+    в месяце есть другие валюты — еще строка в основной по курсу на начало
+    месяца. В памяти — только суммы по группам.
+    Возвращает строки и валюты без курса; stats считает прочитанные операции
+    (progress(stats) — после каждой пачки)."""
+    # Суммы копятся целыми минимальными единицами валюты (ее digits знаков)
+    groups, scales = {}, {}
+    chunks = ledger.operations.chunks(chunk_size, pending, **filters)
+    for chunk in (stats.read(chunks, progress) if stats else chunks):
+        for op in chunk:
+            currency = op['currency']
+            group = groups.setdefault((str(op['datetime'])[:7], currency), [0, 0, 0, 0])
+            scale = scales.get(currency)
+            if scale is None:
+                scale = scales[currency] = 10 ** ledger.operations.digits(currency)
+            group[0] += 1
+            units = round(op['amount'] * scale)
+            if op['is_pending']:
+                group[3] += units
+            else:
+                group[1 if op['type'] == 'income' else 2] += units
+
+    converter = ledger.get_converter()
+    base = ledger.base_currency
+    rows = []
+    missing = set()
+    for month in sorted({month for month, _ in groups}):
+        currencies = sorted(currency for group_month, currency in groups if group_month == month)
+        count, totals = 0, ({}, {}, {})
+        for currency in currencies:
+            count_in_group, income, expense, expected = groups[(month, currency)]
+            amounts = [units / scales[currency] for units in (income, expense, expected, income - expense)]
+            rows.append((month, currency, count_in_group, *amounts))
+            count += count_in_group
+            for values, value in zip(totals, amounts):
+                values[currency] = value
+        if currencies != [base]:
+            income, expense, expected = [], [], []
+            for values, result in zip(totals, (income, expense, expected)):
+                total, not_converted = converter.total(values, base, month + '-01')
+                result.append(total)
+                missing.update(not_converted)
+            rows.append((month, f'все в {base}', count, round(income[0], 2), round(expense[0], 2),
+                         round(expected[0], 2), round(income[0] - expense[0], 2)))
+    return rows, sorted(missing)
+
+
+def export_report(ledger, path, chunk_size=CHUNK_SIZE, progress=None, pending=None, **filters):
+    """Месячный отчет (см. monthly_report) в CSV или XLSX по расширению path;
+    возвращает статистику и валюты без курса. progress(stats) — после каждой пачки."""
+    extension = export_format(path)
+    if extension not in ('.csv', '.xlsx'):
+        raise ValueError('отчет выгружается в .csv или .xlsx')
+    stats = ExportStats(path)
+    rows, missing = monthly_report(ledger, chunk_size, stats, pending, progress, **filters)
+    writer = write_xlsx if extension == '.xlsx' else write_csv
+    write_file(path, lambda tmp_path: writer(tmp_path, REPORT_FIELDS, [rows], stats))
+    stats.seconds = time.perf_counter() - stats.started
+    return stats, missing
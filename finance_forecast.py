@@ -0,0 +1,146 @@
+"""Прогноз баланса на несколько месяцев вперед методом Монте-Карло.
+
+Основа прогноза — история по категориям из Rollups: для каждой категории
+расходов и для нерегулярных доходов считаются среднее и разброс по месяцам.
+Повторяющиеся операции (RecurringSchedule) и ожидаемые доходы известны
+заранее и добавляются как есть, а их прошлые повторения вычитаются из
+истории, чтобы не учесть их дважды. Случайные месяцы всех путей
+генерируются массивами NumPy: цикл идет только по категориям.
+"""
+import time
+from datetime import date
+
+from finance_core import occurrence, shift_month
+
+PERCENTILES = (5, 25, 50, 75, 95)
+HISTORY_MONTHS = 12
+PATHS = 10000
+
+
+class ForecastResult:
+    """Прогноз: месяцы, процентили баланса на конец каждого месяца и ожидаемый путь"""
+
+    def __init__(self, months, start, percentiles, expected, currency, missing, seconds):
+        self.months = months
+        self.start = start
+        self.percentiles = percentiles  # процентиль -> список балансов по месяцам
+        self.expected = expected
+        self.currency = currency
+        self.missing = missing
+        self.seconds = seconds
+
+
+def month_range(first, count):
+    return [shift_month(first, i) for i in range(count)]
+
+
+def rule_amounts(rules, months, converter, target, numbers):
+    """Суммы повторений правил по месяцам: {(тип, название): [сумма по месяцам]}.
+    numbers(rule) — какие номера повторений учитывать (уже созданные или будущие)."""
+    index = {month: i for i, month in enumerate(months)}
+    amounts = {}
+    missing = set()
+    for rule in rules:
+        operation = rule['operation']
+        try:
+            rate = converter.rate(operation['currency'], target)
+        except KeyError:
+            missing.add(operation['currency'])
+            continue
+        values = amounts.setdefault((operation['type'], operation['name']), [0.0] * len(months))
+        for number in numbers(rule):
+            moment = occurrence(rule, number)
+            if rule.get('until') and moment > rule['until']:
+                break
+            if moment[:7] > months[-1]:
+                break
+            if moment[:7] in index:
+                values[index[moment[:7]]] += operation['amount'] * rate
+    return amounts, missing
+
+
+def past_numbers(rule):
+    return range(rule['count'])
+
+
+def future_numbers(rule):
+    number = rule['count']
+    while True:
+        yield number
+        number += 1
+
+
+def sample_months(rng, mean, std, shape, volatility):
+    """Случайные месячные суммы с заданными средним и разбросом (логнормально, не меньше нуля)"""
+    import numpy as np
+    std = std * volatility
+    if mean <= 0:
+        return np.zeros(shape)
+    if std <= 0:
+        return np.full(shape, mean)
+    sigma2 = np.log1p((std / mean) ** 2)
+    return rng.lognormal(np.log(mean) - sigma2 / 2, np.sqrt(sigma2), shape)
+
+
+def project(ledger, months=12, paths=PATHS, history=HISTORY_MONTHS, volatility=1.0, seed=0, today=None):
+    """Прогноз баланса в основной валюте на months месяцев вперед по paths случайным путям.
+
+    volatility — множитель разброса расходов и нерегулярных доходов (сценарии
+    «спокойный» и «нервный» год). seed фиксирован, чтобы график не дрожал при
+    каждом обновлении.
+    """
+    import numpy as np
+    started = time.perf_counter()
+    target = ledger.base_currency
+    converter = ledger.get_converter()
+    rollups = ledger.get_rollups()
+    rules = ledger.recurring
+    current = (today or date.today()).isoformat()[:7]
+    past = month_range(shift_month(current, -history), history)
+    future = month_range(shift_month(current, 1), months)
+
+    start, missing = converter.total(ledger.balances.actual, target)
+    pending, pending_missing = converter.total(ledger.balances.pending, target)
+    missing = set(missing) | set(pending_missing)
+
+    # Прошлое без повторяющихся операций: по категориям расходов и доходы целиком
+    recurring_past, not_converted = rule_amounts(rules, past, converter, target, past_numbers)
+    missing |= not_converted
+    expenses = {}
+    income = np.zeros(history)
+    for i, month in enumerate(past):
+        for name, values in rollups.categories.get(month, {}).items():
+            total, not_converted = converter.total(rollups.amounts(values), target)
+            missing.update(not_converted)
+            expenses.setdefault(name, np.zeros(history))[i] += total
+        total, not_converted = converter.total(rollups.amounts(rollups.flows['month'].get(month, {}).get('income', {})),
+                                               target)
+        missing.update(not_converted)
+        income[i] += total
+    for (op_type, name), values in recurring_past.items():
+        if op_type == 'expense' and name in expenses:
+            expenses[name] -= values
+        elif op_type == 'income':
+            income -= values
+
+    # Будущее: повторения по расписанию и ожидаемые доходы — в первом месяце
+    recurring_future, not_converted = rule_amounts(rules, future, converter, target, future_numbers)
+    missing |= not_converted
+    known = np.zeros(months)
+    for (op_type, _), values in recurring_future.items():
+        known += np.array(values) * (1 if op_type == 'income' else -1)
+    known[0] += pending
+
+    rng = np.random.default_rng(seed)
+    flows = np.broadcast_to(known, (paths, months)).copy()
+    expected = known.copy()
+    series = [(np.clip(income, 0, None), 1)] + [(np.clip(values, 0, None), -1) for values in expenses.values()]
+    for values, sign in series:
+        mean, std = float(values.mean()), float(values.std())
+        flows += sign * sample_months(rng, mean, std, (paths, months), volatility)
+        expected += sign * mean
+    balances = start + np.cumsum(flows, axis=1)
+    bands = np.percentile(balances, PERCENTILES, axis=0)
+    return ForecastResult(future, start, {p: band.tolist() for p, band in zip(PERCENTILES, bands)},
+                          (start + np.cumsum(expected)).tolist(), target, sorted(missing),
+                          time.perf_counter() - started)
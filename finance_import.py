@@ -0,0 +1,336 @@
+"""Потоковый импорт выписок (CSV, JSON, JSON Lines) в Ledger.
+
+Файл читается по строкам, в памяти держится только текущая пачка:
+каждая пачка проверяется normalize_operation и добавляется одним
+Ledger.add_many — одна запись в журнал и одно обновление балансов.
+Колонки банковской выписки сопоставляются с полями операции через
+ColumnMapping; готовые сопоставления лежат в PRESETS.
+
+Здесь же импорт курсов валют по датам из CSV (import_rates).
+"""
+import codecs
+import csv
+import json
+import time
+from datetime import datetime
+
+from finance_core import OPERATION_FIELDS, normalize_operation, parse_amount
+
+BATCH_SIZE = 5000
+CHUNK_SIZE = 1 << 16
+MAX_ERRORS = 20
+
+
+class ColumnMapping:
+    """Какая колонка выписки какое поле операции заполняет"""
+    def __init__(self, name, columns, date_format=None, signed_amount=False,
+                 skip_column=None, skip_values=(), delimiter=None, encoding=None):
+        self.name = name
+        self.columns = columns  # поле операции -> колонка выписки
+        self.date_format = date_format
+        # В выписках расход обычно со знаком минус, а колонки типа нет
+        self.signed_amount = signed_amount
+        self.skip_column = skip_column
+        self.skip_values = set(skip_values)
+        self.delimiter = delimiter
+        self.encoding = encoding
+
+    def matches(self, header):
+        required = [self.columns[field] for field in ('amount', 'datetime') if field in self.columns]
+        return all(column in header for column in required)
+
+    def skip(self, row):
+        return self.skip_column is not None and row.get(self.skip_column) in self.skip_values
+
+    def map(self, row):
+        result = {field: row.get(column) for field, column in self.columns.items()}
+        if self.signed_amount:
+            amount = parse_amount(result.get('amount'))
+            result['type'] = 'expense' if amount < 0 else 'income'
+            result['amount'] = abs(amount)
+        if self.date_format and result.get('datetime'):
+            try:
+                moment = datetime.strptime(str(result['datetime']).strip(), self.date_format)
+            except ValueError:
+                raise ValueError(f'дата не в формате {self.date_format}: {result["datetime"]!r}') from None
+            result['datetime'] = moment.strftime('%Y-%m-%d %H:%M:%S')
+        return result
+
+
+FINANCE_MAPPING = ColumnMapping('finance', {field: field for field in OPERATION_FIELDS})
+
+PRESETS = {
+    'finance': FINANCE_MAPPING,
+    'tinkoff': ColumnMapping(
+        'tinkoff',
+        {'datetime': 'Дата операции', 'amount': 'Сумма операции', 'currency': 'Валюта операции',
+         'name': 'Описание', 'comment': 'Категория'},
+        date_format='%d.%m.%Y %H:%M:%S', signed_amount=True,
+        skip_column='Статус', skip_values=('FAILED',), delimiter=';', encoding='cp1251'),
+}
+
+
+class ImportStats:
+    """Итог импорта: сколько строк прочитано, добавлено, пропущено и как быстро"""
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.errors = []  # первые MAX_ERRORS сообщений вида (номер строки, текст)
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def add_error(self, number, error):
+        self.invalid += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((number, str(error)))
+
+    def summary(self):
+        speed = f'{self.rows_per_second:,.0f}'.replace(',', ' ')
+        return (f'Импортировано операций: {self.imported}, пропущено: {self.skipped}, '
+                f'с ошибками: {self.invalid} ({self.rows} строк за {self.seconds:.2f} с, {speed} строк/с)')
+
+
+def detect_encoding(path):
+    """utf-8 (с BOM или без), иначе cp1251 — так выгружают большинство банков"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as f:
+        head = f.read(CHUNK_SIZE)
+    try:
+        decoder.decode(head)
+    except UnicodeDecodeError:
+        return 'cp1251'
+    return 'utf-8-sig'
+
+
+def iter_csv(path, mapping=None, encoding=None, delimiter=None):
+    """(mapping, строки-словари) CSV-файла; формат угадывается по заголовку"""
+    encoding = encoding or (mapping and mapping.encoding) or detect_encoding(path)
+    f = open(path, 'r', encoding=encoding, newline='')
+    header_line = f.readline()
+    delimiter = delimiter or (mapping and mapping.delimiter) or (
+        ';' if header_line.count(';') > header_line.count(',') else ',')
+    header = next(csv.reader([header_line], delimiter=delimiter), [])
+    if mapping is None:
+        mapping = next((preset for preset in PRESETS.values() if preset.matches(header)), None)
+        if mapping is None:
+            f.close()
+            raise ValueError(f'не удалось определить формат выписки по колонкам: {", ".join(header)}')
+
+    def rows():
+        with f:
+            for values in csv.reader(f, delimiter=delimiter):
+                if values:
+                    yield dict(zip(header, values))
+    return mapping, rows()
+
+
+def iter_json_values(f, decoder=json.JSONDecoder()):
+    """Элементы JSON-массива по одному; {'operations': [...]} тоже понимается.
+    Файл читается кусками по CHUNK_SIZE, целиком в память не попадает."""
+    buffer = ''
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = f.read(CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+        return not eof
+
+    def skip_space():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n':
+                position += 1
+            if position < len(buffer) or not fill():
+                return buffer[position] if position < len(buffer) else ''
+
+    def expect(char):
+        nonlocal position
+        if skip_space() != char:
+            raise ValueError(f'в JSON ожидался символ {char!r}')
+        position += 1
+
+    def value():
+        nonlocal position
+        while True:
+            skip_space()
+            try:
+                result, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if not fill():
+                    raise
+                continue
+            # Число на границе куска могло оборваться — дочитываем и разбираем заново
+            if end == len(buffer) and not eof:
+                fill()
+                continue
+            position = end
+            return result
+
+    def array():
+        nonlocal position
+        expect('[')
+        if skip_space() == ']':
+            position += 1
+            return
+        while True:
+            yield value()
+            char = skip_space()
+            position += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError('в JSON ожидалась запятая или ]')
+
+    start = skip_space()
+    if start == '[':
+        yield from array()
+    elif start == '{':
+        position += 1
+        while skip_space() not in ('}', ''):
+            key = value()
+            expect(':')
+            if key == 'operations':
+                yield from array()
+            else:
+                value()
+            if skip_space() == ',':
+                position += 1
+    else:
+        raise ValueError('JSON-файл должен содержать список операций')
+
+
+def iter_json_lines(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def open_rows(path, mapping=None):
+    """(mapping, итератор строк) для CSV, JSON или JSON Lines (.jsonl, .ndjson)"""
+    lower = path.lower()
+    if lower.endswith('.csv'):
+        return iter_csv(path, mapping)
+
+    def rows():
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            yield from (iter_json_lines(f) if lower.endswith(('.jsonl', '.ndjson')) else iter_json_values(f))
+    return mapping or FINANCE_MAPPING, rows()
+
+
+def iter_operations(path, mapping, stats):
+    """Проверенные операции из файла; ошибки и пропуски попадают в stats"""
+    mapping, rows = open_rows(path, mapping)
+    for number, row in enumerate(rows, 1):
+        stats.rows += 1
+        if not isinstance(row, dict):
+            stats.add_error(number, 'строка не является объектом')
+            continue
+        if mapping.skip(row):
+            stats.skipped += 1
+            continue
+        try:
+            yield normalize_operation(mapping.map(row))
+        except ValueError as error:
+            stats.add_error(number, error)
+
+
+# Варианты названий колонок файла курсов (в нижнем регистре)
+RATE_COLUMNS = {
+    'date': ('date', 'дата'),
+    'currency': ('currency', 'code', 'валюта', 'код'),
+    'rate': ('rate', 'value', 'курс'),
+    'nominal': ('nominal', 'номинал'),
+}
+RATE_DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y')
+
+
+def parse_rate_day(value):
+    for date_format in RATE_DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip()[:10], date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise ValueError(f'неизвестный формат даты: {value!r}')
+
+
+def iter_rates(path):
+    """(день, валюта, курс в рублях за единицу) из CSV с колонками дата, валюта, курс
+    и необязательным номиналом (как в выгрузках ЦБ: 100 KZT = 18,5 RUB)"""
+    encoding = detect_encoding(path)
+    with open(path, 'r', encoding=encoding, newline='') as f:
+        header_line = f.readline()
+        delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+        header = [column.strip().lower() for column in next(csv.reader([header_line], delimiter=delimiter), [])]
+        positions = {}
+        for field, names in RATE_COLUMNS.items():
+            position = next((header.index(name) for name in names if name in header), None)
+            if position is not None:
+                positions[field] = position
+        absent = [field for field in ('date', 'currency', 'rate') if field not in positions]
+        if absent:
+            raise ValueError(f'в файле курсов нет колонок: {", ".join(absent)}')
+        for number, values in enumerate(csv.reader(f, delimiter=delimiter), 2):
+            if not values:
+                continue
+            try:
+                rate = parse_amount(values[positions['rate']])
+                if 'nominal' in positions:
+                    rate /= parse_amount(values[positions['nominal']])
+                if not rate > 0:
+                    raise ValueError(f'курс должен быть положительным: {values[positions["rate"]]!r}')
+                yield parse_rate_day(values[positions['date']]), values[positions['currency']].strip().upper(), rate
+            except (ValueError, IndexError, ZeroDivisionError) as error:
+                raise ValueError(f'строка {number}: {error}') from None
+
+
+def import_rates(ledger, path):
+    """Добавляет курсы из CSV в историю курсов; возвращает их число.
+    Файл сначала разбирается целиком, поэтому при ошибке ничего не добавляется."""
+    return ledger.add_rates(list(iter_rates(path)))
+
+
+def validate_file(path, mapping=None):
+    """Проход по файлу без записи — чтобы не импортировать половину до первой ошибки"""
+    stats = ImportStats()
+    started = time.perf_counter()
+    for _ in iter_operations(path, mapping, stats):
+        pass
+    stats.seconds = time.perf_counter() - started
+    return stats
+
+
+def import_file(ledger, path, mapping=None, batch_size=BATCH_SIZE, progress=None):
+    """Добавляет операции из файла пачками по batch_size.
+    progress(stats) вызывается после каждой пачки."""
+    stats = ImportStats()
+    started = time.perf_counter()
+    batch = []
+    # Весь импорт отменяется одной командой, сколько бы пачек в нем ни было,
+    # и сворачивается в снапшот (если журнал вырос) один раз в конце
+    with ledger.bulk(), ledger.history.grouped('импорт выписки'):
+        for operation in iter_operations(path, mapping, stats):
+            batch.append(operation)
+            if len(batch) >= batch_size:
+                ledger.add_many(batch)
+                stats.imported += len(batch)
+                batch = []
+                stats.seconds = time.perf_counter() - started
+                if progress:
+                    progress(stats)
+        if batch:
+            ledger.add_many(batch)
+            stats.imported += len(batch)
+    ledger.sync()
+    stats.seconds = time.perf_counter() - started
+    if progress:
+        progress(stats)
+    return stats
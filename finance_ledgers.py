@@ -0,0 +1,77 @@
+"""Несколько учетов (личный, семейный, рабочий) с отдельными данными.
+
+Основной учет — файлы в текущей папке, как и раньше; остальные лежат
+в папках ledgers/<название>/ с теми же именами файлов (finance_data.json,
+.sqlite или .bin), так что у каждого свои операции, журнал, настройки и
+блокировка. Сводка по всем учетам берется из их кэшей итогов
+(*.summary.json, см. Ledger.save_summary): пока кэш не отстал от данных,
+операции для нее не загружаются.
+"""
+import os
+
+from finance_core import CurrencyConverter, Ledger, default_data_path
+
+LEDGERS_DIR = 'ledgers'
+DEFAULT_LEDGER = 'Основной'
+FORBIDDEN_CHARACTERS = set('/\\:*?"<>|')
+
+
+def ledger_names():
+    """Основной учет и все созданные, по алфавиту"""
+    names = []
+    if os.path.isdir(LEDGERS_DIR):
+        names = sorted(name for name in os.listdir(LEDGERS_DIR) if os.path.isdir(os.path.join(LEDGERS_DIR, name)))
+    return [DEFAULT_LEDGER] + names
+
+
+def ledger_path(name):
+    """Файл данных учета (для Ledger(path))"""
+    if name == DEFAULT_LEDGER:
+        return default_data_path()
+    return default_data_path(os.path.join(LEDGERS_DIR, name))
+
+
+def create_ledger(name):
+    """Создает папку нового учета и возвращает его название без лишних пробелов"""
+    name = name.strip()
+    if not name or name in ('.', '..') or FORBIDDEN_CHARACTERS & set(name):
+        raise ValueError(f'недопустимое название учета: {name!r}')
+    if name in ledger_names():
+        raise ValueError(f'учет «{name}» уже есть')
+    os.makedirs(os.path.join(LEDGERS_DIR, name))
+    return name
+
+
+def ledger_totals(name, current=None):
+    """Балансы учета и его курсы: у открытого сейчас (current) — из памяти,
+    у остальных — из кэша итогов. Учет без кэша или с кэшем, отставшим от
+    данных (например, после падения), загружается — только для чтения, — и
+    при закрытии кэш записывается заново"""
+    if current is not None:
+        return current.balances, current.exchange_rates
+    ledger = Ledger(ledger_path(name))
+    try:
+        if not ledger.load_summary():
+            ledger.load()
+    finally:
+        ledger.close()
+    return ledger.balances, ledger.exchange_rates
+
+
+def consolidated(currency, current_name=None, current=None):
+    """Сводка по всем учетам в валюте currency, каждый по своим курсам.
+
+    Возвращает список (название, фактическая сумма, ожидаемая, валюты без курса)
+    и итоговые фактическую и ожидаемую суммы.
+    """
+    rows = []
+    actual_total = pending_total = 0.0
+    for name in ledger_names():
+        balances, rates = ledger_totals(name, current if name == current_name else None)
+        converter = CurrencyConverter(rates)
+        actual, missing = converter.total(balances.actual, currency)
+        pending, pending_missing = converter.total(balances.pending, currency)
+        rows.append((name, actual, pending, sorted(set(missing) | set(pending_missing))))
+        actual_total += actual
+        pending_total += pending
+    return rows, actual_total, pending_total
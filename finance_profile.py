@@ -0,0 +1,183 @@
+"""Замеры обработчиков окна: сколько раз вызван, сколько времени занял и
+сколько памяти выделил.
+
+Profiler.instrument один раз при импорте оборачивает перечисленные методы
+класса. Пока замеры выключены, обертка только проверяет флаг и вызывает
+метод, так что окно работает с прежней скоростью. Включенные замеры (start)
+запускают tracemalloc и cProfile: по каждому обработчику копятся вызовы,
+время (вместе с вложенными вызовами) и прирост занятой памяти, а полный
+профиль сохраняется в .prof (dump) — его открывают python -m pstats,
+snakeviz и другие инструменты, понимающие формат cProfile. cProfile видит
+только поток окна: запись снапшотов в рабочем потоке в профиль не попадает.
+
+Замеры включаются переменной окружения FINANCE_PROFILE или переключателем
+на вкладке настроек.
+"""
+import functools
+import os
+import time
+
+PROFILE_ENV = 'FINANCE_PROFILE'
+# inspect.CO_VARARGS: у функции есть *args
+VARARGS_FLAG = 0x04
+
+
+def profile_setting():
+    """FINANCE_PROFILE: пусто или 0 — выключено, 1 — включено, любое другое
+    значение — включено, и при выходе профиль пишется в этот файл.
+    Возвращает (включено, путь или None)"""
+    value = os.environ.get(PROFILE_ENV, '').strip()
+    if value in ('', '0'):
+        return False, None
+    if value == '1':
+        return True, None
+    return True, value
+
+
+def positional_limit(function):
+    """Сколько позиционных аргументов принимает функция (None — сколько угодно);
+    по коду функции, без inspect — его импорт заметен при запуске окна"""
+    code = function.__code__
+    if code.co_flags & VARARGS_FLAG:
+        return None
+    return code.co_argcount
+
+
+def function_label(key):
+    """Имя функции из профиля: файл:строка(функция) или {встроенная}"""
+    filename, line, name = key
+    if filename == '~':
+        return name
+    return f'{os.path.basename(filename)}:{line}({name})'
+
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.memory = 0
+
+    @property
+    def average(self):
+        return self.seconds / self.calls if self.calls else 0.0
+
+    def add(self, seconds, memory):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.memory += memory
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.handlers = {}
+        self.profile = None
+        self.tracing = False
+
+    def instrument(self, cls, names):
+        for name in names:
+            setattr(cls, name, self.wrap(getattr(cls, name), name))
+
+    def wrap(self, method, name):
+        # Слоту без обертки Qt сам отбрасывает лишние аргументы сигнала
+        # (clicked передает checked), а обертке — уже нет: срезаем их здесь
+        limit = positional_limit(method)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return method(*args[:limit], **kwargs)
+            return self.call(name, method, args[:limit], kwargs)
+        return wrapper
+
+    def call(self, name, method, args, kwargs):
+        import tracemalloc
+        memory = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            stats = self.handlers.get(name)
+            if stats is None:
+                stats = self.handlers[name] = HandlerStats()
+            stats.add(seconds, tracemalloc.get_traced_memory()[0] - memory)
+
+    def start(self):
+        import cProfile
+        import tracemalloc
+        if self.enabled:
+            return
+        # Уже запущенный кем-то tracemalloc не останавливаем в stop()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+        try:
+            self.profile.enable()
+        except ValueError:
+            # Под внешним профилировщиком (python -m cProfile) второй не включится
+            self.profile = None
+        self.enabled = True
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.profile is not None:
+            self.profile.disable()
+        if self.tracing:
+            import tracemalloc
+            tracemalloc.stop()
+            self.tracing = False
+
+    def reset(self):
+        import cProfile
+        if self.profile is not None:
+            self.profile.disable()
+        self.handlers = {}
+        self.profile = None
+        if self.enabled:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def rows(self):
+        """Обработчики, самые долгие в сумме — первыми"""
+        return sorted(self.handlers.items(), key=lambda item: item[1].seconds, reverse=True)
+
+    def profile_stats(self):
+        """Снимок профиля cProfile; снимок выключает профиль, поэтому он включается снова"""
+        import pstats
+        if self.profile is None:
+            return None
+        stats = pstats.Stats(self.profile)
+        if self.enabled:
+            self.profile.enable()
+        return stats
+
+    def functions(self, limit=20):
+        """Функции с наибольшим собственным временем: (имя, вызовов, свое время, с вложенными)"""
+        stats = self.profile_stats()
+        if stats is None:
+            return []
+        rows = [(function_label(key), calls, own, total)
+                for key, (_, calls, own, total, _) in stats.stats.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
+
+    def dump(self, path):
+        """Пишет профиль в формате pstats (.prof)"""
+        stats = self.profile_stats()
+        if stats is None:
+            raise ValueError('профиль не собран: замеры не включались')
+        stats.dump_stats(path)
+
+    def report(self):
+        lines = ['Обработчики окна (время вместе с вложенными вызовами):']
+        for name, stats in self.rows():
+            lines.append(f'  {name:<32} вызовов {stats.calls:6}  всего {stats.seconds * 1000:9.1f} мс  '
+                         f'макс {stats.max_seconds * 1000:8.1f} мс  память {stats.memory / 1024:+10.1f} КБ')
+        return '\n'.join(lines)
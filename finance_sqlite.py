@@ -0,0 +1,466 @@
+"""Хранение операций в SQLite вместо finance_data.json.
+
+Операции лежат в таблице operations с индексами по дате, сумме, типу,
+валюте и признаку ожидаемой операции, поиск по словам названий и
+комментариев идет по полнотекстовой таблице FTS5, которую ведут
+триггеры. Каждое изменение — отдельная транзакция,
+журнал базы — WAL. Целиком в память ничего не читается: таблицы окна
+берут операции страницами (count/page), балансы и итоги считает GROUP BY.
+Кроме amount каждая сумма хранится точно — целым числом минимальных единиц
+валюты (units, точность валют — таблица currency_units), по нему считаются
+балансы. Переход с JSON — migrate_json (python finance_cli.py migrate).
+"""
+import json
+import os
+import sqlite3
+from array import array
+from contextlib import contextmanager
+
+from finance_core import (DATA_FILE, MAX_MINOR_UNITS, SETTINGS, SQLITE_FILE, Balances, FileLock, Ledger,
+                          format_timestamp, minor_digits, minor_units, parse_timestamp, search_words)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    amount REAL NOT NULL,
+    currency TEXT NOT NULL,
+    comment TEXT NOT NULL DEFAULT '',
+    datetime TEXT NOT NULL,
+    is_pending INTEGER NOT NULL DEFAULT 0,
+    units INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS operations_pending ON operations (is_pending, id);
+CREATE INDEX IF NOT EXISTS operations_type ON operations (type, is_pending, id);
+CREATE INDEX IF NOT EXISTS operations_currency ON operations (currency, is_pending, id);
+CREATE INDEX IF NOT EXISTS operations_datetime ON operations (datetime);
+CREATE INDEX IF NOT EXISTS operations_amount ON operations (amount);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS currency_units (
+    currency TEXT PRIMARY KEY,
+    digits INTEGER NOT NULL
+);
+'''
+
+COLUMNS = ('id', 'type', 'name', 'amount', 'currency', 'comment', 'datetime', 'is_pending')
+SELECT = f'SELECT {", ".join(COLUMNS)} FROM operations'
+INSERT = f'INSERT INTO operations ({", ".join(COLUMNS)}, units) VALUES ({", ".join("?" * len(COLUMNS))}, ?)'
+SIGNED_UNITS = "CASE WHEN type = 'expense' THEN -units ELSE units END"
+GROUPS = {
+    'currency': 'currency',
+    'name': 'name',
+    'type': 'type',
+    'month': 'substr(datetime, 1, 7)',
+    'day': 'substr(datetime, 1, 10)'
+}
+# Токенизатор без снятия диакритики, чтобы «й» и «ё» не совпадали с «и» и «е»,
+# как и у OperationStore
+SEARCH_SCHEMA = '''
+CREATE VIRTUAL TABLE operations_fts USING fts5(
+    name, comment, content='operations', content_rowid='id', tokenize='unicode61 remove_diacritics 0'
+);
+CREATE TRIGGER operations_fts_insert AFTER INSERT ON operations BEGIN
+    INSERT INTO operations_fts (rowid, name, comment) VALUES (new.id, new.name, new.comment);
+END;
+CREATE TRIGGER operations_fts_delete AFTER DELETE ON operations BEGIN
+    INSERT INTO operations_fts (operations_fts, rowid, name, comment) VALUES ('delete', old.id, old.name, old.comment);
+END;
+CREATE TRIGGER operations_fts_update AFTER UPDATE OF name, comment ON operations BEGIN
+    INSERT INTO operations_fts (operations_fts, rowid, name, comment) VALUES ('delete', old.id, old.name, old.comment);
+    INSERT INTO operations_fts (rowid, name, comment) VALUES (new.id, new.name, new.comment);
+END;
+INSERT INTO operations_fts (operations_fts) VALUES ('rebuild');
+'''
+# Номер изменения базы: растет в той же транзакции, что и само изменение,
+# поэтому кэш итогов по нему видит любое изменение, в том числе чужое
+REVISION_KEY = 'revision'
+BUMP_REVISION = (f"INSERT INTO settings (key, value) VALUES ('{REVISION_KEY}', 1) "
+                 'ON CONFLICT (key) DO UPDATE SET value = value + 1')
+
+# Временные таблицы со строками, отложенными для отмены clear (видны только своему
+# соединению и исчезают вместе с ним); в основной базе их могли оставить прежние версии
+DETACHED_PREFIX = 'detached_operations_'
+
+
+def to_operation(row):
+    op = dict(zip(COLUMNS, row))
+    op['is_pending'] = bool(op['is_pending'])
+    return op
+
+
+def to_row(op, units, digits):
+    # Дата приводится к одному виду, чтобы сравнение строк совпадало со сравнением дат;
+    # amount — та же сумма, что и units, без хвоста погрешности float
+    return (op.get('id'), op['type'], op['name'], units / 10 ** digits, op['currency'], op.get('comment', ''),
+            format_timestamp(parse_timestamp(op['datetime'])), int(bool(op.get('is_pending', False))), units)
+
+
+def add_units(db):
+    """Базы прежних версий хранили только amount REAL: добавляет колонку units
+    и переводит суммы в минимальные единицы, для каждой валюты подбирая
+    точность так, чтобы ни одна сумма не округлилась"""
+    with db:
+        db.execute('ALTER TABLE operations ADD COLUMN units INTEGER NOT NULL DEFAULT 0')
+        for (currency,) in db.execute('SELECT DISTINCT currency FROM operations').fetchall():
+            amounts = [row[0] for row in db.execute('SELECT amount FROM operations WHERE currency = ?', (currency,))]
+            digits = minor_digits(amounts, minor_units(currency))
+            db.execute('UPDATE operations SET units = CAST(round(amount * ?) AS INTEGER), '
+                       'amount = round(amount * ?) / ? WHERE currency = ?',
+                       (10 ** digits, 10 ** digits, 10 ** digits, currency))
+            if digits != minor_units(currency):
+                db.execute('INSERT OR REPLACE INTO currency_units (currency, digits) VALUES (?, ?)', (currency, digits))
+
+
+def where(pending, op_type=None, currency=None, start=None, end=None,
+          min_amount=None, max_amount=None, text=None):
+    """Условие WHERE и параметры для тех же фильтров, что у OperationStore.filtered_ids;
+    pending=None — без условия на признак ожидаемой операции"""
+    clauses = []
+    params = []
+    if pending is not None:
+        clauses.append('is_pending = ?')
+        params.append(int(bool(pending)))
+    if op_type is not None:
+        clauses.append('type = ?')
+        params.append(op_type)
+    if currency is not None:
+        clauses.append('currency = ?')
+        params.append(currency)
+    if start is not None:
+        clauses.append('datetime >= ?')
+        params.append(format_timestamp(parse_timestamp(start)))
+    if end is not None:
+        clauses.append('datetime <= ?')
+        params.append(format_timestamp(parse_timestamp(end)))
+    if min_amount is not None:
+        clauses.append('amount >= ?')
+        params.append(min_amount)
+    if max_amount is not None:
+        clauses.append('amount <= ?')
+        params.append(max_amount)
+    words = search_words(text)
+    if words:
+        clauses.append('id IN (SELECT rowid FROM operations_fts WHERE operations_fts MATCH ?)')
+        params.append(' '.join(f'"{word}"*' for word in words))
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+
+class SqliteOperations:
+    """Операции в базе с тем же набором методов, что у OperationStore.
+
+    Операции отдаются обычными словарями; изменения сразу коммитятся.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.detached = 0
+        # Валюты, которым понадобилось больше знаков, чем minor_units
+        self.minor_units = dict(db.execute('SELECT currency, digits FROM currency_units'))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM operations').fetchone()[0]
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция, меняющая операции: вместе с ней растет номер изменения базы"""
+        with self.db:
+            yield
+            self.db.execute(BUMP_REVISION)
+
+    def __iter__(self):
+        return map(to_operation, self.db.execute(SELECT + ' ORDER BY id'))
+
+    def get(self, op_id):
+        row = self.db.execute(SELECT + ' WHERE id = ?', (op_id,)).fetchone()
+        if row is None:
+            raise KeyError(op_id)
+        return to_operation(row)
+
+    def ids(self, pending):
+        cursor = self.db.execute('SELECT id FROM operations WHERE is_pending = ? ORDER BY id', (int(pending),))
+        return array('q', (row[0] for row in cursor))
+
+    def prepare_search(self):
+        # Поисковую таблицу ведут триггеры
+        pass
+
+    def count(self, pending, **filters):
+        condition, params = where(pending, **filters)
+        return self.db.execute('SELECT COUNT(*) FROM operations' + condition, params).fetchone()[0]
+
+    def page(self, pending, offset, limit, **filters):
+        condition, params = where(pending, **filters)
+        cursor = self.db.execute(SELECT + condition + ' ORDER BY id LIMIT ? OFFSET ?', params + [limit, offset])
+        return [to_operation(row) for row in cursor]
+
+    def chunks(self, size, pending=None, **filters):
+        """Операции словарями пачками не больше size, по возрастанию id;
+        фильтры — в WHERE, курсор читается по пачке за раз"""
+        condition, params = where(pending, **filters)
+        cursor = self.db.execute(SELECT + condition + ' ORDER BY id', params)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            yield [to_operation(row) for row in rows]
+
+    def row_of(self, op_id):
+        """Номер строки операции в таблице фактических или ожидаемых"""
+        pending = self.get(op_id)['is_pending']
+        return self.db.execute('SELECT COUNT(*) FROM operations WHERE is_pending = ? AND id < ?',
+                               (int(pending), op_id)).fetchone()[0]
+
+    def add(self, op):
+        """Добавляет операцию (присваивает id, если его нет) и возвращает ее id"""
+        with self.transaction():
+            op['id'] = self.db.execute(INSERT, self.row(op)).lastrowid
+        return op['id']
+
+    def extend(self, operations):
+        """Пакетное добавление одной транзакцией; operations может быть генератором"""
+        with self.transaction():
+            for op in operations:
+                op['id'] = self.db.execute(INSERT, self.row(op)).lastrowid
+
+    def row(self, op):
+        currency = op['currency']
+        scaled = op['amount'] * 10 ** self.digits(currency)
+        if abs(scaled - round(scaled)) > abs(scaled) * 1e-12 + 1e-6:
+            self.widen(currency, minor_digits(op['amount'], self.digits(currency)))
+            scaled = op['amount'] * 10 ** self.digits(currency)
+        return to_row(op, round(scaled), self.digits(currency))
+
+    def digits(self, currency):
+        """Знаков после запятой в units валюты (см. OperationStore.digits)"""
+        return self.minor_units.get(currency, minor_units(currency))
+
+    def widen(self, currency, digits):
+        """Повышает точность валюты, домножая ее units, в том числе у строк,
+        отложенных detach; вызывается внутри транзакции добавления"""
+        factor = 10 ** (digits - self.digits(currency))
+        tables = [row[0] for row in self.db.execute('SELECT name FROM sqlite_temp_master WHERE type = ? AND name LIKE ?',
+                                                    ('table', DETACHED_PREFIX + '%'))]
+        for table in ['operations'] + tables:
+            self.db.execute(f'UPDATE {table} SET units = units * ? WHERE currency = ?', (factor, currency))
+        self.db.execute('INSERT OR REPLACE INTO currency_units (currency, digits) VALUES (?, ?)', (currency, digits))
+        self.minor_units[currency] = digits
+
+    def confirm(self, op_id):
+        """Переводит ожидаемую операцию в фактические, возвращает ее новую строку"""
+        with self.transaction():
+            cursor = self.db.execute('UPDATE operations SET is_pending = 0 WHERE id = ? AND is_pending = 1', (op_id,))
+        if not cursor.rowcount:
+            raise KeyError(op_id)
+        return self.row_of(op_id)
+
+    def unconfirm(self, op_id):
+        """Обратное confirm: операция снова ожидаемая, возвращает ее строку среди ожидаемых"""
+        with self.transaction():
+            cursor = self.db.execute('UPDATE operations SET is_pending = 1 WHERE id = ? AND is_pending = 0', (op_id,))
+        if not cursor.rowcount:
+            raise KeyError(op_id)
+        return self.row_of(op_id)
+
+    def delete_many(self, op_ids):
+        """Удаляет пачку операций одной транзакцией и возвращает их данные"""
+        operations = [self.get(op_id) for op_id in sorted(set(op_ids))]
+        with self.transaction():
+            self.db.executemany('DELETE FROM operations WHERE id = ?', [(op['id'],) for op in operations])
+        return operations
+
+    def detach(self):
+        """Очищает таблицу, перенося строки во временную таблицу этого соединения,
+        а не в память (для отмены clear); возвращает ее имя для attach"""
+        self.detached += 1
+        table = f'{DETACHED_PREFIX}{self.detached}'
+        with self.transaction():
+            self.db.execute(f'DROP TABLE IF EXISTS {table}')
+            self.db.execute(f'CREATE TEMP TABLE {table} AS SELECT * FROM operations')
+            self.db.execute('DELETE FROM operations')
+        return table
+
+    def attach(self, table):
+        """Возвращает строки, отложенные detach; к этому моменту таблица снова пуста"""
+        with self.transaction():
+            self.db.execute(f'INSERT INTO operations SELECT * FROM {table}')
+            self.db.execute(f'DROP TABLE {table}')
+
+    def discard(self, table):
+        with self.db:
+            self.db.execute(f'DROP TABLE IF EXISTS {table}')
+
+    def delete(self, op_id):
+        """Удаляет операцию и возвращает ее данные"""
+        op = self.get(op_id)
+        with self.transaction():
+            self.db.execute('DELETE FROM operations WHERE id = ?', (op_id,))
+        return op
+
+    def clear(self):
+        with self.transaction():
+            self.db.execute('DELETE FROM operations')
+
+    def balances(self):
+        """Балансы из точных сумм: SUM по целым units"""
+        balances = Balances()
+        cursor = self.db.execute(f'SELECT is_pending, currency, SUM({SIGNED_UNITS}) FROM operations '
+                                 'GROUP BY is_pending, currency')
+        for pending, currency, units in cursor:
+            balances.shift(bool(pending), currency, units * 10 ** (MAX_MINOR_UNITS - self.digits(currency)))
+        return balances
+
+    def rollup_rows(self):
+        """Суммы фактических операций по дням и по категориям расходов за месяц для Rollups:
+        SUM по целым units, в строках — единицы 10**-MAX_MINOR_UNITS"""
+        day_rows = self.db.execute('SELECT substr(datetime, 1, 10), type, currency, SUM(units) FROM operations '
+                                   'WHERE is_pending = 0 GROUP BY 1, 2, 3')
+        category_rows = self.db.execute('SELECT substr(datetime, 1, 7), name, currency, SUM(units) FROM operations '
+                                        "WHERE is_pending = 0 AND type = 'expense' GROUP BY 1, 2, 3")
+        return tuple([row[:3] + (row[3] * 10 ** (MAX_MINOR_UNITS - self.digits(row[2])),) for row in rows]
+                     for rows in (day_rows, category_rows))
+
+    def totals(self, converter, target, by='currency', pending=None, historical=False, interpolate=False):
+        """Итоги по группам в валюте target; суммы по валютам внутри групп считает база"""
+        condition, params = '', []
+        if pending is not None:
+            condition, params = ' WHERE is_pending = ?', [int(pending)]
+        if historical:
+            return self.dated_totals(converter, target, by, condition, params, interpolate)
+        cursor = self.db.execute(f'SELECT {GROUPS[by]} AS grp, currency, SUM({SIGNED_UNITS}) FROM operations'
+                                 f'{condition} GROUP BY grp, currency ORDER BY grp', params)
+        groups = {}
+        for group, currency, units in cursor:
+            groups.setdefault(group, {})[currency] = units / 10 ** self.digits(currency)
+
+        result = {}
+        missing = set()
+        for group, amounts in groups.items():
+            result[group], not_converted = converter.total(amounts, target)
+            missing.update(not_converted)
+        return result, sorted(missing)
+
+    def dated_totals(self, converter, target, by, condition, params, interpolate):
+        """Итоги по курсам на дату операций: база суммирует по группе, валюте и дню,
+        пересчет всех строк — один векторный проход конвертера"""
+        cursor = self.db.execute(f'SELECT {GROUPS[by]} AS grp, currency, substr(datetime, 1, 10) AS day, '
+                                 f'SUM({SIGNED_UNITS}) FROM operations{condition} GROUP BY grp, currency, day '
+                                 'ORDER BY grp', params)
+        groups, currencies = {}, {}
+        group_codes, currency_codes, timestamps, amounts = [], [], [], []
+        for group, currency, day, units in cursor:
+            group_codes.append(groups.setdefault(group, len(groups)))
+            currency_codes.append(currencies.setdefault(currency, len(currencies)))
+            timestamps.append(parse_timestamp(day))
+            amounts.append(units / 10 ** self.digits(currency))
+        return converter.grouped_totals(amounts, currency_codes, list(currencies), group_codes, list(groups),
+                                        target, timestamps, interpolate)
+
+
+class SqliteStorage:
+    """Хранилище в файле SQLite с тем же набором методов, что у OperationJournal"""
+
+    def __init__(self, path=SQLITE_FILE):
+        self.path = path
+        self.db = None
+        # Операции и так общие для всех процессов; блокировка — для настроек и
+        # чтобы изменение делалось после того, как учтены чужие
+        self.file_lock = FileLock(path + '.lock')
+        self.data_version = None
+
+    def connect(self):
+        if self.db is None:
+            # Окно загружает учет в рабочем потоке, а работает с ним в своем;
+            # одновременно соединением пользуется только один из них
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(SCHEMA)
+            if 'units' not in [row[1] for row in self.db.execute('PRAGMA table_info(operations)')]:
+                add_units(self.db)
+            # Базы от прежних версий получают поисковую таблицу с уже проиндексированными операциями
+            if not self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'operations_fts'").fetchone():
+                with self.db:
+                    self.db.executescript(SEARCH_SCHEMA)
+        return self.db
+
+    def load(self):
+        db = self.connect()
+        tables = db.execute('SELECT name FROM sqlite_master WHERE type = ? AND name LIKE ?',
+                            ('table', DETACHED_PREFIX + '%')).fetchall()
+        with db:
+            for (table,) in tables:
+                db.execute(f'DROP TABLE {table}')
+        data = {key: json.loads(value) for key, value in db.execute('SELECT key, value FROM settings WHERE key != ?',
+                                                                    (REVISION_KEY,))}
+        data['operations'] = SqliteOperations(db)
+        data['balances'] = None
+        self.data_version = self.version()
+        return data
+    
+    def version(self):
+        """PRAGMA data_version меняется, когда базу изменило другое соединение"""
+        return self.connect().execute('PRAGMA data_version').fetchone()[0]
+    
+    def changed(self):
+        return self.version() != self.data_version
+
+    def position(self):
+        """Номер изменения базы — метка для кэша итогов (см. Ledger.save_summary)"""
+        row = self.connect().execute('SELECT value FROM settings WHERE key = ?', (REVISION_KEY,)).fetchone()
+        return int(row[0]) if row else 0
+    
+    def changes(self):
+        """None — другой процесс изменил базу и балансы с настройками нужно
+        прочитать заново (сами операции читаются из базы и так); [] — не изменял"""
+        return None if self.changed() else []
+
+    def write(self, records, defer=False):
+        """Операции уже закоммичены самим SqliteOperations; настройки пишутся снапшотом"""
+        return not any(record['a'] in ('set', 'rate', 'rates') for record in records)
+
+    def sync(self):
+        # Каждое изменение — завершенная транзакция, досбрасывать нечего
+        return False
+
+    def snapshot(self, data):
+        """Сохраняет настройки; операции в базе и так актуальны"""
+        with self.connect() as db:
+            db.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                           [(key, json.dumps(data[key], ensure_ascii=False)) for key in SETTINGS])
+            db.execute(BUMP_REVISION)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def migrate_json(json_path=DATA_FILE, sqlite_path=SQLITE_FILE):
+    """Одноразовый перенос finance_data.json (вместе с журналом) в базу SQLite.
+
+    База собирается во временном файле и появляется под своим именем только
+    целиком. Возвращает число перенесенных операций.
+    """
+    if os.path.exists(sqlite_path):
+        raise ValueError(f'{sqlite_path} уже существует')
+    tmp_path = sqlite_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    source = Ledger(json_path)
+    source.load()
+    storage = SqliteStorage(tmp_path)
+    try:
+        operations = storage.load()['operations']
+        operations.extend(dict(op) for op in source.operations)
+        storage.snapshot({key: getattr(source, key) for key in SETTINGS})
+        count = len(operations)
+    finally:
+        source.close()
+        storage.close()
+    os.replace(tmp_path, sqlite_path)
+    return count
@@ -0,0 +1,111 @@
+"""Журнал и восстановление: что записано, то переживает закрытие и падение."""
+import os
+
+from finance_core import Ledger
+
+
+def operation(amount):
+    return {'type': 'income', 'name': 'Зарплата', 'amount': amount, 'currency': 'RUB', 'comment': '',
+            'datetime': '2026-01-01 10:00:00', 'is_pending': False}
+
+
+def open_ledger(path):
+    ledger = Ledger(str(path))
+    ledger.load()
+    # Порог снапшота — после трех операций в журнале
+    ledger.storage.snapshot_every = 3
+    return ledger
+
+
+def reopened(path):
+    ledger = Ledger(str(path))
+    ledger.load()
+    amounts = sorted(op['amount'] for op in ledger.operations)
+    balances = dict(ledger.balances.actual)
+    ledger.storage.close()
+    return amounts, balances
+
+
+def test_queued_snapshot_that_never_runs_loses_nothing(tmp_path):
+    path = tmp_path / 'finance_data.json'
+    ledger = open_ledger(path)
+    queued = []
+    ledger.background = lambda function, *args, **kwargs: queued.append((function, args))
+    for amount in range(1, 6):
+        ledger.add(operation(amount))
+    assert queued
+    # Процесс убит до того, как рабочий поток взялся за снапшот
+    ledger.storage.close()
+    assert reopened(path) == ([1, 2, 3, 4, 5], {'RUB': 15.0})
+
+
+def test_stale_background_snapshot_keeps_journal(tmp_path):
+    path = tmp_path / 'finance_data.json'
+    ledger = open_ledger(path)
+    queued = []
+    ledger.background = lambda function, *args, **kwargs: queued.append((function, args))
+    for amount in range(1, 5):
+        ledger.add(operation(amount))
+    # Учет загружен заново — начатый снапшот устарел и выбрасывается
+    ledger.load()
+    for function, args in queued:
+        assert function(*args) is False
+    ledger.add(operation(5))
+    ledger.storage.close()
+    assert reopened(path) == ([1, 2, 3, 4, 5], {'RUB': 15.0})
+
+
+def test_background_snapshot_cuts_only_what_it_wrote(tmp_path):
+    path = tmp_path / 'finance_data.json'
+    ledger = open_ledger(path)
+    queued = []
+    ledger.background = lambda function, *args, **kwargs: queued.append((function, args))
+    for amount in range(1, 4):
+        ledger.add(operation(amount))
+    assert len(queued) == 1
+    # Пока снапшот ждет очереди, приходят новые изменения
+    ledger.add(operation(4))
+    ledger.add(operation(5))
+    for function, args in queued:
+        assert function(*args) is True
+    ledger.storage.close()
+    assert reopened(path) == ([1, 2, 3, 4, 5], {'RUB': 15.0})
+    # В журнале остались только записи после начала снапшота
+    with open(ledger.storage.journal_path, encoding='utf-8') as f:
+        assert [line.count('"amount":') for line in f] == [1, 1]
+
+
+def test_torn_journal_record_is_dropped(tmp_path):
+    path = tmp_path / 'finance_data.json'
+    ledger = Ledger(str(path))
+    ledger.load()
+    ledger.add(operation(1))
+    ledger.add(operation(2))
+    ledger.storage.close()
+    # Падение посреди записи: от последней строки осталась половина
+    journal_path = ledger.storage.journal_path
+    with open(journal_path, 'rb+') as f:
+        f.truncate(os.path.getsize(journal_path) - 10)
+    assert reopened(path) == ([1], {'RUB': 1.0})
+    ledger = Ledger(str(path))
+    ledger.load()
+    ledger.add(operation(3))
+    ledger.storage.close()
+    assert reopened(path) == ([1, 3], {'RUB': 4.0})
+
+
+def test_totals_cache_matches_after_background_snapshot(tmp_path):
+    path = tmp_path / 'finance_data.json'
+    ledger = open_ledger(path)
+    queued = []
+    ledger.background = lambda function, *args, done=None: queued.append((function, args, done))
+    for amount in range(1, 4):
+        ledger.add(operation(amount))
+    for function, args, done in queued:
+        done(function(*args))
+    ledger.storage.close()
+    # Кэш записан после замены снапшота и принимается без загрузки операций
+    cached = Ledger(str(path))
+    assert cached.load_summary()
+    assert cached.balances.actual == {'RUB': 6.0}
+    cached.storage.close()